@@ -1,52 +1,12 @@
 import chess
 import chess.engine
-import os
-import sys
-import traceback
 import math
 
-# Get Stockfish path with extensive logging
-
-# stockfish_path = os.getenv("STOCKFISH_PATH", "app/backend/stockfish/stockfish-ubuntu-x86-64-avx2")
-# stockfish_path = "/mnt/c/users/gagan/onedrive/desktop/chess/backend/stockfish/stockfish-ubuntu-x86-64-avx2"
-# stockfish_path = os.path.join(os.path.dirname(__file__), '..', 'stockfish', 'stockfish-ubuntu-x86-64-avx2')
-
-stockfish_path = "/usr/local/bin/stockfish"
-
-# Add extensive logging
-print("Stockfish Configuration:")
-print(f"STOCKFISH_PATH: {stockfish_path}")
-print(f"Current Working Directory: {os.getcwd()}")
-print(f"Stockfish exists: {os.path.exists(stockfish_path)}")
-print(f"Stockfish is executable: {os.access(stockfish_path, os.X_OK)}")
+from app.engine_pool import LIVE, PV, SUGGESTION, EnginePool, engine_pool
 
 class Game:
-    def __init__(self, game_id: int):
-        try:
-            # Add more detailed logging
-            print(f"Attempting to launch Stockfish from: {stockfish_path}")
-            
-        #     # Verify file exists and is executable
-            if not os.path.exists(stockfish_path):
-                raise FileNotFoundError(f"Stockfish not found at {stockfish_path}")
-            
-            if not os.access(stockfish_path, os.X_OK):
-                raise PermissionError(f"Stockfish at {stockfish_path} is not executable")
-            
-        #     # Attempt to launch Stockfish with verbose error handling
-            self.engine = chess.engine.SimpleEngine.popen_uci(stockfish_path)
-            print("Stockfish engine successfully launched")
-        
-        except Exception as e:
-            print(f"CRITICAL ERROR launching Stockfish: {e}")
-            traceback.print_exc()
-            
-        #     # Additional diagnostic information
-            print("\nDiagnostic Information:")
-            print(f"Current User: {os.getuid()}")
-            print(f"File Permissions: {oct(os.stat(stockfish_path).st_mode)[-3:]}")
-            
-            # raise
+    def __init__(self, game_id: int, engines: EnginePool = None):
+        self.engines = engines or engine_pool  # Shared with the worker's other games
         self.id = game_id
         self.player1 = None
         self.player2 = None
@@ -58,7 +18,6 @@ class Game:
         self.moves = None
         self.mate_score = 9999
         self.near_mate_threshold = 5.0
-        self.engine = chess.engine.SimpleEngine.popen_uci(stockfish_path)
         self.flag = False
 
     def start(self, player1: str, player2: str):
@@ -104,12 +63,19 @@ class Game:
         return self.moves 
 
     def suggest_move(self):
-        result = self.engine.play(self.board, chess.engine.Limit(time=0.5))
+        result = self.engines.call("play", self.board, chess.engine.Limit(time=0.5), priority=SUGGESTION, flow=self.id)
+        return result.move.uci()
+
+    async def suggest(self):
+        """suggest_move() for the event loop: waits for an engine without blocking it."""
+        result = await self.engines.run(
+            "play", self.board.copy(), chess.engine.Limit(time=0.5), priority=SUGGESTION, flow=self.id
+        )
         return result.move.uci()
 
 
     def get_pv_moves(self):
-        analysis = self.engine.analyse(self.board, chess.engine.Limit(time=1.0)) 
+        analysis = self.engines.call("analyse", self.board, chess.engine.Limit(time=1.0), priority=PV, flow=self.id)
         pv_moves = analysis.get("pv", [])
         return [move.uci() for move in pv_moves]
     
@@ -118,7 +84,21 @@ class Game:
         if self.board.is_checkmate():
             return -self.mate_score if self.board.turn else self.mate_score
             
-        analysis = self.engine.analyse(self.board, chess.engine.Limit(time=0.2))
+        analysis = self.engines.call("analyse", self.board, chess.engine.Limit(time=0.2), priority=LIVE, flow=self.id)
+        return self.score(analysis)
+
+    async def evaluate(self):
+        """get_evaluation() for the event loop: waits for an engine without blocking it."""
+        if self.board.is_checkmate():
+            return -self.mate_score if self.board.turn else self.mate_score
+
+        analysis = await self.engines.run(
+            "analyse", self.board.copy(), chess.engine.Limit(time=0.2), priority=LIVE, flow=self.id
+        )
+        return self.score(analysis)
+
+    def score(self, analysis):
+        """Engine output as an evaluation in pawns for the side to move, mates as +/-mate_score"""
         score = analysis['score'].relative
         
         if score.is_mate():
@@ -165,8 +145,3 @@ class Game:
             "best_move": best_move,
             "winning_chances": winning_chances
         }
-
-    def __del__(self):
-        """Cleanup engine when object is destroyed"""
-        if hasattr(self, 'engine'):
-            self.engine.quit()
\ No newline at end of file
@@ -1,6 +1,9 @@
+import logging
 from fastapi.websockets import WebSocket
 from typing import Dict, List
 
+logger = logging.getLogger(__name__)
+
 class Signaling:
     def __init__(self):
         self.connected_clients: Dict[str, WebSocket] = {}  # Map player names to WebSocket connections
@@ -8,14 +11,14 @@ class Signaling:
     async def register_client(self, player_name: str, websocket: WebSocket):
         """Register a new player connection."""
         self.connected_clients[player_name] = websocket
-        print(f"Player {player_name} connected.")
+        logger.info("Player %s connected", player_name)
         await websocket.send_json({"event": "REGISTERED", "data": {"message": f"Welcome, {player_name}!"}})
 
     async def unregister_client(self, player_name: str):
         """Remove a player connection."""
         if player_name in self.connected_clients:
             del self.connected_clients[player_name]
-            print(f"Player {player_name} disconnected.")
+            logger.info("Player %s disconnected", player_name)
 
     async def send_offer(self, from_player: str, to_player: str, offer: dict):
         """Send SDP offer to the target player."""
@@ -1,10 +1,18 @@
 import asyncio
+import logging
 import time
 import threading
 from app.Game import Game
-from db.db import get_db
+from app.log import game_id_var
+from app.metrics import Histogram
 from app.utils import save_game
 
+TICK_INTERVAL = 0.1  # Seconds between clock updates
+
+logger = logging.getLogger(__name__)
+
+TIMER_LAG_SECONDS = Histogram("timer_lag_seconds", "How late clock ticks run after their scheduled time")
+
 class TimeControl:
     def __init__(self, total_time=600, increment=10,game = None, active_games = None, game_id=None):
         self.total_time = total_time
@@ -39,23 +47,24 @@ class TimeControl:
         """
         Continuously check and update time
         """
+        # Threads do not inherit context variables
+        game_id_var.set(self.game_id)
         # Start a new asyncio event loop for the thread
-        print("Starting timer thread")
+        logger.debug("Starting timer thread")
         loop = asyncio.new_event_loop()
-        print("Setting event loop")
         asyncio.set_event_loop(loop)
-        print("Running timer thread")
         loop.run_until_complete(self._async_timer_thread(socket1, socket2))
-        print("Timer thread stopped")
+        logger.debug("Timer thread stopped")
         loop.close()
 
     async def _async_timer_thread(self, socket1, socket2):
         """
         Continuously check and update time asynchronously
         """
-        print("Starting async timer thread")
         while self.timer_active:
-            await asyncio.sleep(0.1)  # Non-blocking sleep
+            scheduled = time.perf_counter() + TICK_INTERVAL
+            await asyncio.sleep(TICK_INTERVAL)  # Non-blocking sleep
+            TIMER_LAG_SECONDS.observe(max(0.0, time.perf_counter() - scheduled))
             if self.game.get_status() != "ongoing":
                 break
             current_time = time.time()
@@ -81,12 +90,17 @@ class TimeControl:
 
             if message:
 
+                # Players may have reconnected on new sockets since the timer started
+                if self.game_id in self.active_games:
+                    players = self.active_games[self.game_id]["players"]
+                    socket1 = players[self.player1]["websocket"]
+                    socket2 = players[self.player2]["websocket"]
+
                 # Send the timeout message to both sockets
                 await socket1.send_json(message)
                 await socket2.send_json(message)
 
-                db = get_db()
-                save_game(self.game_id, self.player1, self.player2, self.game.get_moves(), message["data"]["winner"], "timeout", db)
+                save_game(self.game_id, self.player1, self.player2, self.game.get_moves(), message["data"]["winner"], "timeout", self.total_time, self.increment)
 
                 del self.active_games[self.game_id]
 
@@ -128,5 +142,9 @@ class TimeControl:
             self.player2: round(self.player2_time, 2)
         }
 
+    def remaining(self, player: str):
+        """Clock remaining for a player, in seconds"""
+        return round(self.player1_time if player == self.player1 else self.player2_time, 2)
+
     def is_timer_active(self):
         return self.timer_active
@@ -0,0 +1,124 @@
+"""
+Batch position analysis over HTTP.
+
+POST /analysis takes a list of FENs and a depth and/or time limit and
+streams one NDJSON line per FEN as results become available: cached
+positions first, then the rest in the order their searches finish. FENs
+that describe the same position are searched once. Searches run on the
+engine pool the live games use, as offline work: live games go first and
+may interrupt them. Each user is one flow, so a large batch waits behind
+other users' searches rather than in front of them, and each search is
+charged to the user's engine quota.
+"""
+import asyncio
+import json
+import logging
+import os
+
+import chess
+import chess.engine
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+
+from app.auth import decode_access_token
+from app.cache import LRUCache
+from app.engine_pool import OFFLINE, QuotaExceeded, engine_pool
+from app.model import AnalysisRequest
+
+MAX_ANALYSIS_POSITIONS = int(os.getenv("MAX_ANALYSIS_POSITIONS", "100"))
+MAX_ANALYSIS_DEPTH = int(os.getenv("MAX_ANALYSIS_DEPTH", "30"))
+MAX_ANALYSIS_TIME = float(os.getenv("MAX_ANALYSIS_TIME", "5"))  # Seconds per position
+DEFAULT_ANALYSIS_TIME = 0.2  # As for live game evaluations
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "10000"))
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+analysed_positions = LRUCache(ANALYSIS_CACHE_SIZE)  # (EPD, depth, time) -> result
+
+
+def describe(info: dict) -> dict:
+    """Engine output as sent to clients; scores are from white's point of view."""
+    score = info["score"].white()
+    pv = info.get("pv", [])
+    return {
+        "score": {"mate": score.mate()} if score.is_mate() else {"cp": score.score()},
+        "best_move": pv[0].uci() if pv else None,
+        "pv": [move.uci() for move in pv],
+        "depth": info.get("depth"),
+    }
+
+
+async def analyse_batch(positions: list, depth: int = None, time: float = None, engines=None, username: str = None):
+    """Yield a result or an error for every FEN, as soon as each is known."""
+    engines = engines or engine_pool
+    limit = chess.engine.Limit(depth=depth, time=time)
+    flow = f"analysis:{username}"
+    pending = {}  # Position key -> (board, FENs waiting for it)
+    for fen in positions:
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            yield {"fen": fen, "error": "Invalid FEN"}
+            continue
+        if not board.is_valid():
+            yield {"fen": fen, "error": "Illegal position"}
+            continue
+        key = (board.epd(), depth, time)  # EPD leaves out the move counters
+        if key in pending:
+            pending[key][1].append(fen)
+            continue
+        result = analysed_positions.get(key)
+        if result is not None:
+            yield {"fen": fen, **result, "cached": True}
+        else:
+            pending[key] = (board, [fen])
+
+    async def analyse(key, board):
+        """(key, result, error) for one position."""
+        try:
+            info = await engines.run("analyse", board, limit, priority=OFFLINE, flow=flow, user=username)
+            return key, describe(info), None
+        except QuotaExceeded:
+            return key, None, "Engine quota exceeded, try again later"
+        except Exception:
+            logger.exception("Analysis of %s failed", key[0])
+            return key, None, "Analysis failed"
+
+    tasks = [asyncio.create_task(analyse(key, board)) for key, (board, _) in pending.items()]
+    try:
+        for search in asyncio.as_completed(tasks):
+            key, result, error = await search
+            if result is not None:
+                analysed_positions.put(key, result)
+            for fen in pending[key][1]:
+                yield {"fen": fen, "error": error} if error else {"fen": fen, **result, "cached": False}
+    finally:
+        # The client went away: searches that have not started yet are dropped
+        for task in tasks:
+            task.cancel()
+
+
+async def ndjson_lines(results):
+    async for result in results:
+        yield json.dumps(result, separators=(",", ":")) + "\n"
+
+
+@router.post("/analysis")
+async def analyse_positions(request: AnalysisRequest, username: str = Depends(decode_access_token)):
+    """Evaluate a batch of positions, streaming NDJSON lines as each result is ready."""
+    # Validate up front; errors can't be reported once streaming has started
+    if not request.positions:
+        raise HTTPException(status_code=400, detail="No positions given")
+    if len(request.positions) > MAX_ANALYSIS_POSITIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ANALYSIS_POSITIONS} positions per request")
+    if request.depth is not None and request.depth > MAX_ANALYSIS_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Depth is limited to {MAX_ANALYSIS_DEPTH}")
+    if request.time is not None and request.time > MAX_ANALYSIS_TIME:
+        raise HTTPException(status_code=400, detail=f"Time is limited to {MAX_ANALYSIS_TIME}s per position")
+    time = request.time if request.time is not None or request.depth is not None else DEFAULT_ANALYSIS_TIME
+    logger.debug("%s requested analysis of %d positions", username, len(request.positions))
+    return StreamingResponse(
+        ndjson_lines(analyse_batch(request.positions, request.depth, time, username=username)),
+        media_type="application/x-ndjson"
+    )
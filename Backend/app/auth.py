@@ -1,12 +1,17 @@
+import asyncio
+import logging
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, WebSocket
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+from app.cache import LRUCache
 from app.model import UserCreate, Token, UserDB
 from db.db import get_db
 from dotenv import load_dotenv
@@ -16,10 +21,27 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))  # Processes dedicated to bcrypt
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "32"))  # Hashes running or waiting before shedding load
+PASSWORD_RETRY_AFTER = 2  # Seconds shed clients are asked to wait
+# Refuse websocket connections without a valid token; otherwise anonymous players keep naming themselves
+WS_AUTH_REQUIRED = os.getenv("WS_AUTH_REQUIRED", "false").lower() == "true"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger(__name__)
+
+verified_tokens = LRUCache(TOKEN_CACHE_SIZE)  # token -> username, dropped when the token expires
+
+# Hashes with fewer rounds than BCRYPT_ROUNDS count as outdated and are rehashed at login
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS
+)
 router = APIRouter()
 
+password_pool = None  # Created on first use, so importing this module never forks
+password_tasks = 0  # Hashes running or queued on password_pool; only touched on the event loop
+
 # Utility functions
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
@@ -27,6 +49,39 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str):
+    """(valid, new hash or None); a new hash is returned when the stored one is outdated."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+async def run_password_task(function, *args):
+    """
+    Run a bcrypt operation on the dedicated process pool.
+
+    Keeps ~250ms hashes off the shared threadpool that sync endpoints run
+    on. Once PASSWORD_QUEUE_LIMIT hashes are pending, further requests are
+    shed with a 503 instead of queueing without bound.
+    """
+    global password_pool, password_tasks
+    if password_tasks >= PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many sign-ins at once, please retry shortly",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER)}
+        )
+    if password_pool is None:
+        password_pool = ProcessPoolExecutor(PASSWORD_WORKERS)
+    password_tasks += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_pool, function, *args)
+    finally:
+        password_tasks -= 1
+
+def close_password_pool():
+    global password_pool
+    if password_pool is not None:
+        password_pool.shutdown()
+        password_pool = None
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
@@ -36,43 +91,95 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def get_user(db: Session, email: str):
     return db.query(UserDB).filter(UserDB.email == email).first()
 
+def verify_token(token: str) -> str:
+    """
+    Username a token was issued to; raises JWTError if it is invalid or expired.
+
+    Verified tokens are cached until their own expiry, so repeat requests
+    skip signature verification.
+    """
+    username = verified_tokens.get(token)
+    if username is not None:
+        return username
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username = payload.get("sub")
+    if username is None:
+        raise JWTError("Token has no subject")
+    ttl = payload["exp"] - time.time() if "exp" in payload else None
+    verified_tokens.put(token, username, ttl=ttl)
+    return username
+
 def decode_access_token(token: str):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return username
+        return verify_token(token)
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def authenticate_websocket(websocket: WebSocket) -> bool:
+    """
+    Check the token offered at handshake and bind the connection to its user.
+
+    Browsers can't set headers on websockets, so the token may come as a
+    `token` query parameter as well as a bearer Authorization header. Sets
+    websocket.state.user (None when anonymous); closes the connection and
+    returns False if the token is invalid, or missing while WS_AUTH_REQUIRED.
+    """
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+
+    websocket.state.user = None
+    if token:
+        try:
+            websocket.state.user = verify_token(token)
+        except JWTError:
+            await websocket.close(code=1008)
+            return False
+    elif WS_AUTH_REQUIRED:
+        await websocket.close(code=1008)
+        return False
+    return True
+
 # Routes
+# login and register are async so that waiting on bcrypt holds no thread; database calls go to threads
 @router.post("/register", response_model=dict)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: Session = Depends(get_db)):
     try:
-        existing_user = db.query(UserDB).filter(UserDB.username == user.username).first()
+        existing_user = await asyncio.to_thread(
+            lambda: db.query(UserDB).filter(UserDB.username == user.username).first()
+        )
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already exists")
         
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await run_password_task(get_password_hash, user.password)
         new_user = UserDB(
             username=user.username, 
             email=user.email, 
             password=hashed_password
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await asyncio.to_thread(db.commit)
         return {"message": "User registered successfully"}
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error registering user %s", user.username)
+        await asyncio.to_thread(db.rollback)
+        raise HTTPException(status_code=500, detail="Registration failed")
 
 @router.post("/login", response_model=Token)
-def login(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = get_user(db, user.email)
-    if not db_user or not verify_password(user.password, db_user.password):
+async def login(user: UserCreate, db: Session = Depends(get_db)):
+    db_user = await asyncio.to_thread(get_user, db, user.email)
+    if not db_user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    valid, new_hash = await run_password_task(verify_and_update_password, user.password, db_user.password)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Stored with outdated cost parameters; upgrade while we have the plain password
+        db_user.password = new_hash
+        await asyncio.to_thread(db.commit)
     
     access_token = create_access_token(
         data={"sub": db_user.username}, 
@@ -0,0 +1,89 @@
+"""
+Games against the engine.
+
+A bot plays through the same Game, TimeControl and play_move as a human;
+its seat holds a BotSocket instead of a websocket. Whenever a message puts
+the bot on move, the socket starts a task that searches on the engine pool
+and plays the reply. Bot searches have their own priority class, below the
+evaluations and suggestions of human games, and each bot game is a flow of
+its own, so however many bot games are waiting they share the engines
+fairly and never hold up human games.
+
+Strength is Stockfish's Skill Level (0-20) or, if an Elo is given, its
+UCI_Elo. A node limit makes the bot weaker still and its moves cheaper.
+The bot spends a fortieth of its clock per move, at most BOT_MOVE_TIME.
+"""
+import asyncio
+import logging
+import os
+
+import chess
+import chess.engine
+
+from app.engine_pool import BOT
+
+BOT_MOVE_TIME = float(os.getenv("BOT_MOVE_TIME", "1.0"))  # Longest a bot thinks about one move, in seconds
+MIN_BOT_MOVE_TIME = 0.05
+MAX_SKILL = 20
+MIN_ELO, MAX_ELO = 1320, 3190  # Stockfish's UCI_Elo range
+
+logger = logging.getLogger(__name__)
+
+
+class BotPlayer:
+    def __init__(self, skill: int = MAX_SKILL, elo: int = None, nodes: int = None):
+        if not 0 <= skill <= MAX_SKILL:
+            raise ValueError(f"Skill must be between 0 and {MAX_SKILL}")
+        if elo is not None and not MIN_ELO <= elo <= MAX_ELO:
+            raise ValueError(f"Elo must be between {MIN_ELO} and {MAX_ELO}")
+        if nodes is not None and nodes < 1:
+            raise ValueError("Nodes must be positive")
+        self.skill = skill
+        self.elo = elo
+        self.nodes = nodes
+
+    @property
+    def name(self) -> str:
+        return f"Stockfish {self.elo}" if self.elo else f"Stockfish level {self.skill}"
+
+    def settings(self) -> dict:
+        """Keyword arguments that recreate this bot, as stored in snapshots."""
+        return {"skill": self.skill, "elo": self.elo, "nodes": self.nodes}
+
+    def options(self) -> dict:
+        """UCI options for this bot's searches."""
+        if self.elo:
+            return {"UCI_LimitStrength": True, "UCI_Elo": self.elo}
+        return {"Skill Level": self.skill}
+
+    def limit(self, remaining: float) -> chess.engine.Limit:
+        think = max(MIN_BOT_MOVE_TIME, min(BOT_MOVE_TIME, remaining / 40))
+        return chess.engine.Limit(time=think, nodes=self.nodes)
+
+    async def choose_move(self, engines, board: chess.Board, remaining: float, game_id: str) -> chess.Move:
+        result = await engines.run(
+            "play", board, self.limit(remaining), options=self.options(), priority=BOT, flow=game_id
+        )
+        return result.move
+
+
+class BotSocket:
+    """Stands in for the bot's websocket; starts `on_turn()` whenever a message puts the bot on move."""
+
+    def __init__(self, name: str, on_turn):
+        self.name = name
+        self.on_turn = on_turn
+        self.task = None
+
+    async def send_json(self, message: dict):
+        if message.get("event") == "GAME_STARTED":
+            turn = message.get("turn")
+        elif message.get("event") == "MOVE":
+            turn = message["data"].get("turn")
+        else:
+            return  # Everything else is for humans, including TIMEOUT from the clock thread
+        if turn == self.name:
+            self.play()
+
+    def play(self):
+        self.task = asyncio.create_task(self.on_turn())
@@ -1,16 +1,22 @@
 import asyncio
+import logging
 from fastapi import WebSocket
-from db.db import get_db
-from app.utils import save_game
+from app.game_handlers import attach_bot
+from app.log import game_id_var
+from app.utils import save_game, player_for
+from app.snapshot import restore_game
+
+logger = logging.getLogger(__name__)
 
 async def handle_disconnect_timeout(game_id, player_name, active_games):
     """Waits 30 seconds to check if the player reconnects, else the opponent wins."""
     
+    game_id_var.set(game_id)
     await asyncio.sleep(30)  # Match the comment with the actual timeout
     
     try:
         if game_id not in active_games:
-            print(f"Game {game_id} no longer active, canceling timeout handler")
+            logger.debug("Game no longer active, canceling timeout handler")
             return
             
         game_data = active_games[game_id]
@@ -18,15 +24,15 @@ async def handle_disconnect_timeout(game_id, player_name, active_games):
         
         # Check if the player is still disconnected
         if not hasattr(game, "disconnected_player") or game.disconnected_player != player_name:
-            print(f"Player {player_name} has reconnected, canceling timeout handler")
+            logger.debug("Player %s has reconnected, canceling timeout handler", player_name)
             return
             
         players = game_data["players"]
         opponent_name = next(name for name in players if name != player_name)
         
         # Save the game result
-        db = get_db()
-        save_game(game.id, game.player1, game.player2, game.moves, opponent_name, "Disconnect", db)
+        time_control = players[opponent_name]["time"]
+        save_game(game.id, game.player1, game.player2, game.moves, opponent_name, "Disconnect", time_control.total_time, time_control.increment)
         
         # Notify opponent about winning the game
         opponent_socket = players[opponent_name]["websocket"]
@@ -41,74 +47,99 @@ async def handle_disconnect_timeout(game_id, player_name, active_games):
         
         # Remove the game from active games
         del active_games[game_id]
-        print(f"Game {game_id} ended due to reconnection timeout")
+        logger.info("Game ended due to reconnection timeout")
         
-    except Exception as e:
-        print(f"Error handling disconnect timeout: {e}")
-
+    except Exception:
+        logger.exception("Error handling disconnect timeout")
 
-async def handle_disconnect(websocket: WebSocket, waiting_users, active_games):
-    """Handles player disconnection and starts a timer for reconnection."""
 
-    # Remove from waiting queue
-    for time_key in list(waiting_users.keys()):
-        waiting_users[time_key] = [
-            user for user in waiting_users[time_key] if user["websocket"] != websocket
-        ]
-        if not waiting_users[time_key]:  
-            del waiting_users[time_key]
-    
-    player_who_left = None
-    game_id_to_remove = None
+async def handle_disconnect(websocket: WebSocket, active_games):
+    """Handles player disconnection and starts a timer for reconnection in every game the connection played."""
 
-    # Check if player belongs to an active game
     for game_id, game_data in list(active_games.items()):
+        player_name = player_for(game_data, websocket)
+        if not player_name:
+            continue
+        # Messages to the opponent belong to this game
+        game_id_var.set(game_id)
         players = game_data["players"]
-        
-        for player_name, details in players.items():
-            if details["websocket"] == websocket:
-                player_who_left = player_name
-                game = game_data["game"]
-                
-                # Mark player as disconnected
-                game.disconnected_player = player_name
-                
-                # Notify opponent
-                opponent_name = next(name for name in players if name != player_name)
-                opponent_socket = players[opponent_name]["websocket"]
+        game = game_data["game"]
+
+        # Mark player as disconnected
+        game.disconnected_player = player_name
+
+        # Notify opponent
+        opponent_name = next(name for name in players if name != player_name)
+        opponent_socket = players[opponent_name]["websocket"]
+
+        try:
+            await opponent_socket.send_json({
+                "event": "OPPONENT_DISCONNECTED",
+                "data": {
+                    "player_name": player_name,
+                    "message": "Opponent disconnected. Waiting 30 seconds for reconnection."
+                }
+            })
+        except Exception as e:
+            logger.warning("Error notifying opponent about disconnect: %s", e)
+
+        # Start async task to track reconnection timeout
+        asyncio.create_task(handle_disconnect_timeout(game_id, player_name, active_games))
+
 
-                try:
-                    await opponent_socket.send_json({
-                        "event": "OPPONENT_DISCONNECTED",
-                        "data": {
-                            "player_name": player_name,
-                            "message": "Opponent disconnected. Waiting 30 seconds for reconnection."
-                        }
-                    })
-                except Exception as e:
-                    print(f"Error notifying opponent about disconnect: {e}")
+async def resume_game(websocket: WebSocket, event, active_games, lobby, snapshots):
+    """
+    Bring a game back from its snapshot after the worker hosting it restarted.
 
-                # Start async task to track reconnection timeout
-                asyncio.create_task(handle_disconnect_timeout(game_id, player_who_left, active_games))
+    Returns False if the game was handed to another worker instead.
+    """
+    game_id = event.data["game_id"]
+    snapshot = await asyncio.to_thread(snapshots.load, game_id)
+    if not snapshot or snapshot["status"] != "ongoing":
+        return True
+    if event.data["player_name"] not in (snapshot["player1"], snapshot["player2"]):
+        # Only a player of the game may bring it back; anyone else would start a forfeit clock on a seated player
+        logger.warning("Refused to resume game for non-player %s", event.data["player_name"])
+        return True
+
+    owner = await lobby.take_over_game(game_id)
+    if owner != lobby.worker_id:
+        # Another worker resumed it first (e.g. the opponent reconnected there)
+        await lobby.forward_event(owner, websocket, event)
+        return False
+
+    game_data = restore_game(snapshot, active_games)
+    logger.info("Resumed game from snapshot with %d moves", len(snapshot["moves"]))
 
-                break  # Exit inner loop
+    bot = game_data.get("bot")
+    if bot:
+        # The bot is back at once, and moves if it is on turn
+        socket = attach_bot(game_id, active_games, bot)
+        if game_data["game"].current_turn == bot.name:
+            socket.play()
+        return True
 
-        if player_who_left:
-            break  # Exit outer loop
+    # The opponent gets the usual reconnection window
+    opponent_name = next(name for name in game_data["players"] if name != event.data["player_name"])
+    game_data["game"].disconnected_player = opponent_name
+    asyncio.create_task(handle_disconnect_timeout(game_id, opponent_name, active_games))
+    return True
 
 
-async def handle_reconnect(websocket: WebSocket, event, active_games):
+async def handle_reconnect(websocket: WebSocket, event, active_games, lobby, snapshots):
     player_name = event.data["player_name"]
     game_id = event.data["game_id"]
-    print(f"Reconnecting player {player_name} to game {game_id}")
+    logger.info("Reconnecting player %s", player_name)
     try:
+        if game_id not in active_games:
+            if not await resume_game(websocket, event, active_games, lobby, snapshots):
+                return
+
         if game_id in active_games:
             game_data = active_games[game_id]
             players = game_data["players"]
             game = game_data["game"]
 
-            print(f"Reconnecting player {player_name} to game {game_id}")
-            
             if player_name in players:
                 # Update the player's websocket
                 players[player_name]["websocket"] = websocket
@@ -117,7 +148,7 @@ async def handle_reconnect(websocket: WebSocket, event, active_games):
                 if hasattr(game, "disconnected_player") and game.disconnected_player == player_name:
                     game.disconnected_player = None
 
-                print(f"Reconnected player {player_name} to game {game_id}")
+                logger.debug("Reconnected player %s", player_name)
 
                 time_control = players[player_name]["time"]
 
@@ -155,5 +186,5 @@ async def handle_reconnect(websocket: WebSocket, event, active_games):
                 "event": "ERROR",
                 "data": {"message": "Game not found!"}
             })
-    except Exception as e:
-        print(f"Error handling reconnect: {e}")
\ No newline at end of file
+    except Exception:
+        logger.exception("Error handling reconnect")
\ No newline at end of file
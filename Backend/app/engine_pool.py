@@ -0,0 +1,426 @@
+"""
+Engines shared by every game hosted by the worker and by /analysis.
+
+A game only needs an engine for the moment after each move, so a few
+engines can serve many games. EnginePool starts up to `size` engines on
+first use and lends one out per request. Time spent waiting and searching
+is recorded per request.
+
+Every request has a priority class. When all engines are busy, a free
+engine goes to the most urgent class waiting: evaluations after a move
+first, then suggested moves, PV requests, bot moves and offline work.
+Within a class, requests wait in a weighted fair queue. Each request
+belongs to a flow (a game, a user's analysis batch) and is stamped with a
+virtual finish time: the flow's previous finish time, or the class's
+virtual time if later, plus the request's expected search time divided by
+the flow's weight. The smallest stamp goes first, so one flow with a
+thousand requests queued cannot hold up the others.
+
+A live request that has to wait stops an offline analysis instead; the
+stopped request goes back to the queue and starts over later. Classes
+with a deadline are dropped with DeadlineExceeded if no engine is free in
+time, since an evaluation shown seconds after the move is no use. Requests
+made for a user are charged their expected search time against a quota
+that refills over QUOTA_PERIOD; past it they fail with QuotaExceeded.
+
+Blocking callers use call(). Coroutines use run(), which waits for its turn
+without holding a thread.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess.engine
+
+from app.metrics import Counter, Histogram
+
+# stockfish_path = os.getenv("STOCKFISH_PATH", "app/backend/stockfish/stockfish-ubuntu-x86-64-avx2")
+# stockfish_path = "/mnt/c/users/gagan/onedrive/desktop/chess/backend/stockfish/stockfish-ubuntu-x86-64-avx2"
+# stockfish_path = os.path.join(os.path.dirname(__file__), '..', 'stockfish', 'stockfish-ubuntu-x86-64-avx2')
+
+stockfish_path = os.getenv("STOCKFISH_PATH", "/usr/local/bin/stockfish")
+ENGINE_POOL_SIZE = int(os.getenv("ENGINE_POOL_SIZE", str(os.cpu_count() or 1)))  # Engine processes per worker
+
+# Priority classes, most urgent first
+LIVE = "live"  # Evaluation after a move in a live game
+SUGGESTION = "suggestion"  # Suggested move after a move
+PV = "pv"  # Principal variation requested in a game
+BOT = "bot"  # A bot's move
+OFFLINE = "offline"  # /analysis batches and other background work
+PRIORITIES = {LIVE: 0, SUGGESTION: 1, PV: 2, BOT: 3, OFFLINE: 4}
+DEADLINES = {LIVE: 2.0, SUGGESTION: 2.0, PV: 10.0}  # Seconds a request may wait for an engine
+PREEMPTING = {LIVE, SUGGESTION}  # Classes that stop a preemptible search rather than wait
+PREEMPTIBLE = {OFFLINE}  # Classes whose analyses are stopped, and restarted later, for them
+USER_QUOTA = float(os.getenv("ENGINE_USER_QUOTA", "60"))  # Engine seconds a user may request per period
+QUOTA_PERIOD = 60.0
+DEFAULT_SEARCH_COST = 0.5  # Seconds assumed for searches limited by depth or nodes only
+
+logger = logging.getLogger(__name__)
+
+logger.info(
+    "Stockfish at %s (exists: %s, executable: %s), working directory %s",
+    stockfish_path, os.path.exists(stockfish_path), os.access(stockfish_path, os.X_OK), os.getcwd()
+)
+
+ENGINE_WAIT_SECONDS = Histogram(
+    "engine_queue_wait_seconds", "Time an engine request waits for a free engine", labelnames=("priority",)
+)
+ENGINE_SEARCH_SECONDS = Histogram(
+    "engine_search_seconds", "Time the engine spends on a request", labelnames=("operation",)
+)
+ENGINE_PREEMPTIONS = Counter("engine_preemptions_total", "Offline searches stopped to free an engine for live requests")
+ENGINE_DEADLINE_MISSES = Counter("engine_deadline_misses_total", "Requests dropped because no engine was free in time")
+ENGINE_QUOTA_REJECTIONS = Counter("engine_quota_rejections_total", "Requests refused because their user's quota ran out")
+
+
+class EngineUnavailable(Exception):
+    """A request was given up before any engine searched it."""
+
+
+class DeadlineExceeded(EngineUnavailable):
+    pass
+
+
+class QuotaExceeded(EngineUnavailable):
+    pass
+
+
+class Preempted(Exception):
+    """Raised inside the pool when a search was stopped for a more urgent one."""
+
+
+def launch_stockfish(path: str):
+    logger.debug("Launching Stockfish from %s", path)
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Stockfish not found at {path}")
+        if not os.access(path, os.X_OK):
+            raise PermissionError(f"Stockfish at {path} is not executable")
+        return chess.engine.SimpleEngine.popen_uci(path)
+    except Exception:
+        permissions = oct(os.stat(path).st_mode)[-3:] if os.path.exists(path) else None
+        logger.exception("Failed to launch Stockfish from %s (user %s, permissions %s)", path, os.getuid(), permissions)
+        raise
+
+
+def search_cost(args) -> float:
+    """Expected seconds of a search, from the time of the Limit among its arguments."""
+    limit = next((arg for arg in args if isinstance(arg, chess.engine.Limit)), None)
+    return limit.time if limit is not None and limit.time else DEFAULT_SEARCH_COST
+
+
+class Job:
+    """One request, from the time it is queued until its search ends."""
+
+    def __init__(self, priority: str, flow, weight: float, cost: float, deadline: float = None):
+        self.priority = priority
+        self.flow = flow
+        self.weight = weight
+        self.cost = cost
+        self.deadline = deadline  # time.monotonic() by which it must have an engine, or None
+        self.finish = None  # Virtual finish time, kept when a preempted job is queued again
+        self.grant = None  # Called with the engine, or None and an error, when the job's turn comes
+        self.search = None  # The running analysis, while a preemptible search runs
+        self.preempted = False
+
+
+class EnginePool:
+    def __init__(self, path: str = None, size: int = ENGINE_POOL_SIZE, factory=None, quota: float = USER_QUOTA):
+        self.path = path or stockfish_path
+        self.size = max(1, size)
+        self.factory = factory or (lambda: launch_stockfish(self.path))
+        self.quota = quota
+        self.engines = []  # Every engine started and still alive, idle or lent out
+        self.idle = []
+        self.lock = threading.Lock()
+        self.waiting = []  # Heap of (priority, finish time, sequence, job)
+        self.finish_times = {}  # (priority, flow) -> virtual finish time of its last waiting job
+        self.queued = {}  # (priority, flow) -> jobs waiting
+        self.virtual_times = {}  # Priority -> finish time of the job of that class granted last
+        self.running = set()  # Jobs searching
+        self.usage = {}  # User -> (quota left, when it was last charged)
+        self.sequence = itertools.count()
+        self.executor = None  # Created on first run(), so games alone never start threads
+
+    def _charge(self, user: str, job: Job):
+        if user is None or not self.quota:
+            return
+        now = time.monotonic()
+        with self.lock:
+            left, charged = self.usage.get(user, (self.quota, now))
+            left = min(self.quota, left + (now - charged) * self.quota / QUOTA_PERIOD)
+            if left < job.cost:
+                self.usage[user] = (left, now)
+                ENGINE_QUOTA_REJECTIONS.inc()
+                raise QuotaExceeded(f"Engine quota of {self.quota:g}s per {QUOTA_PERIOD:g}s used up")
+            self.usage[user] = (left - job.cost, now)
+
+    def _take(self, job: Job):
+        """An idle engine, "launch" if the caller may start one, or None once the job is queued."""
+        victim = None
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            if len(self.engines) < self.size:
+                self.engines.append(None)  # Reserve the slot while the engine starts
+                return "launch"
+            key = (job.priority, job.flow)
+            if job.finish is None:
+                start = max(self.virtual_times.get(job.priority, 0.0), self.finish_times.get(key, 0.0))
+                job.finish = start + job.cost / job.weight
+            self.finish_times[key] = max(job.finish, self.finish_times.get(key, 0.0))
+            self.queued[key] = self.queued.get(key, 0) + 1
+            heapq.heappush(self.waiting, (PRIORITIES[job.priority], job.finish, next(self.sequence), job))
+            if job.priority in PREEMPTING:
+                victim = self._victim()
+        if victim:
+            ENGINE_PREEMPTIONS.inc()
+            victim.stop()
+        return None
+
+    def _victim(self):
+        """The least urgent preemptible search still running, its job marked preempted; call with the lock held."""
+        candidates = [job for job in self.running if job.search is not None and not job.preempted]
+        if not candidates:
+            return None
+        job = max(candidates, key=lambda job: PRIORITIES[job.priority])
+        job.preempted = True
+        return job.search
+
+    def _launch(self):
+        try:
+            engine = self.factory()
+        except Exception:
+            with self.lock:
+                self.engines.remove(None)
+            raise
+        with self.lock:
+            self.engines[self.engines.index(None)] = engine
+        return engine
+
+    def _next_waiting(self) -> Job:
+        """Pop the most urgent waiting job; call with the lock held."""
+        _, finish, _, job = heapq.heappop(self.waiting)
+        self.virtual_times[job.priority] = finish
+        key = (job.priority, job.flow)
+        self.queued[key] -= 1
+        if not self.queued[key]:
+            del self.queued[key]
+            del self.finish_times[key]
+        return job
+
+    def _release(self, engine):
+        """Lend an engine to the next job whose deadline has not passed, or keep it idle."""
+        expired = []
+        job = None
+        now = time.monotonic()
+        with self.lock:
+            while self.waiting and job is None:
+                job = self._next_waiting()
+                if job.deadline is not None and job.deadline < now:
+                    expired.append(job)
+                    job = None
+            if job is None:
+                self.idle.append(engine)
+        for late in expired:
+            late.grant(None, DeadlineExceeded("No engine became free in time"))
+        if job:
+            job.grant(engine)
+
+    def _discard(self, engine):
+        """Forget a dead engine; a waiting job gets a replacement, or the error if none starts."""
+        with self.lock:
+            self.engines.remove(engine)
+            if not self.waiting:
+                return
+            self.engines.append(None)
+        try:
+            replacement = self._launch()
+        except Exception as e:
+            with self.lock:
+                job = self._next_waiting() if self.waiting else None
+            if job:
+                job.grant(None, e)
+            return
+        self._release(replacement)
+
+    def _acquire(self, job: Job):
+        granted = []
+        ready = threading.Event()
+        lock = threading.Lock()
+
+        def grant(engine, error=None):
+            with lock:
+                if not ready.is_set():
+                    granted.append((engine, error))
+                    ready.set()
+                    return
+            if engine is not None:
+                self._release(engine)  # The caller stopped waiting
+
+        job.grant = grant
+        engine = self._take(job)
+        if engine == "launch":
+            return self._launch()
+        if engine is None:
+            ready.wait(None if job.deadline is None else max(0.0, job.deadline - time.monotonic()))
+            with lock:
+                if not ready.is_set():
+                    granted.append((None, DeadlineExceeded("No engine became free in time")))
+                    ready.set()
+            engine, error = granted[0]
+            if error:
+                raise error
+        return engine
+
+    async def _acquire_async(self, job: Job):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(engine, error):
+            if future.done():
+                if engine is not None:
+                    self._release(engine)  # Its caller went away while waiting
+            elif error:
+                future.set_exception(error)
+            else:
+                future.set_result(engine)
+
+        def grant(engine, error=None):
+            loop.call_soon_threadsafe(resolve, engine, error)
+
+        job.grant = grant
+        engine = self._take(job)
+        if engine == "launch":
+            return await loop.run_in_executor(self._executor(), self._launch)
+        if engine is None:
+            if job.deadline is None:
+                return await future
+            try:
+                return await asyncio.wait_for(future, max(0.0, job.deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("No engine became free in time") from None
+        return engine
+
+    def _analyse(self, engine, job: Job, args, kwargs):
+        """engine.analyse() as a search the pool can stop when a more urgent job needs the engine."""
+        with engine.analysis(*args, **kwargs) as search:
+            with self.lock:
+                job.search = search
+            search.wait()
+        return search.info if kwargs.get("multipv") is None else search.multipv
+
+    def _search(self, engine, job: Job, operation: str, args, kwargs):
+        """Run one search on an engine lent to `job`, then lend the engine to the next job."""
+        started = time.perf_counter()
+        with self.lock:
+            self.running.add(job)
+        try:
+            if operation == "analyse" and job.priority in PREEMPTIBLE:
+                result = self._analyse(engine, job, args, kwargs)
+            else:
+                result = getattr(engine, operation)(*args, **kwargs)
+            if kwargs.get("options"):
+                # Options passed to one search stay set in the engine; put back the defaults for the next caller
+                engine.configure({name: engine.options[name].default for name in kwargs["options"] if name in engine.options})
+        except chess.engine.EngineTerminatedError:
+            # The process died; it is replaced for whoever is waiting
+            self._discard(engine)
+            raise
+        except BaseException:
+            self._release(engine)
+            raise
+        finally:
+            with self.lock:
+                self.running.discard(job)
+                job.search = None
+            ENGINE_SEARCH_SECONDS.labels(operation).observe(time.perf_counter() - started)
+        self._release(engine)
+        if job.preempted:
+            job.preempted = False
+            raise Preempted()
+        return result
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.size, thread_name_prefix="engine")
+        return self.executor
+
+    def _job(self, args, priority: str, flow, weight: float, cost: float, user: str) -> Job:
+        deadline = DEADLINES.get(priority)
+        job = Job(
+            priority,
+            flow if flow is not None else ("request", next(self.sequence)),
+            weight,
+            cost or search_cost(args),
+            None if deadline is None else time.monotonic() + deadline
+        )
+        self._charge(user, job)
+        return job
+
+    def call(self, operation: str, *args, priority: str = LIVE, flow=None, weight: float = 1.0, cost: float = None,
+             user: str = None, **kwargs):
+        """
+        Run `engine.<operation>(*args, **kwargs)` on a free engine, waiting for one if all are busy.
+
+        Requests of the same `priority` and `flow` share its `weight`;
+        without a flow the request is a flow of its own. Raises
+        EngineUnavailable if no engine is free by the class's deadline or
+        `user` is over their quota.
+        """
+        job = self._job(args, priority, flow, weight, cost, user)
+        while True:
+            requested = time.perf_counter()
+            try:
+                engine = self._acquire(job)
+            except DeadlineExceeded:
+                ENGINE_DEADLINE_MISSES.inc()
+                raise
+            finally:
+                ENGINE_WAIT_SECONDS.labels(priority).observe(time.perf_counter() - requested)
+            try:
+                return self._search(engine, job, operation, args, kwargs)
+            except Preempted:
+                logger.debug("Preempted %s search, queued again", priority)
+
+    async def run(self, operation: str, *args, priority: str = LIVE, flow=None, weight: float = 1.0,
+                  cost: float = None, user: str = None, **kwargs):
+        """call() from a coroutine, without blocking the event loop."""
+        job = self._job(args, priority, flow, weight, cost, user)
+        loop = asyncio.get_running_loop()
+        while True:
+            requested = time.perf_counter()
+            try:
+                engine = await self._acquire_async(job)
+            except DeadlineExceeded:
+                ENGINE_DEADLINE_MISSES.inc()
+                raise
+            finally:
+                ENGINE_WAIT_SECONDS.labels(priority).observe(time.perf_counter() - requested)
+            try:
+                return await loop.run_in_executor(
+                    self._executor(), lambda: self._search(engine, job, operation, args, kwargs)
+                )
+            except Preempted:
+                logger.debug("Preempted %s search, queued again", priority)
+
+    def close(self):
+        """Stop the engines; requests still searching finish first."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            engines, self.engines, self.idle = [engine for engine in self.engines if engine], [], []
+        for engine in engines:
+            try:
+                engine.quit()
+            except chess.engine.EngineError:
+                pass
+
+
+engine_pool = EnginePool()  # Shared by the games hosted by this worker and /analysis
@@ -1,22 +1,43 @@
+import asyncio
+import logging
+from time import perf_counter
+import chess
 from uuid import uuid4 as UUID4
 from fastapi import WebSocket
 from app.Game import Game
 from app.TimeControl import TimeControl
-from app.utils import save_game
-from db.db import get_db
+from app.bots import BotPlayer, BotSocket
+from app.engine_pool import EngineUnavailable
+from app.log import game_id_var
+from app.metrics import Counter, Histogram
+from app.utils import save_game, log_move, player_for
+from app.watchdog import handling
 
-async def handle_init_game(websocket: WebSocket, event, waiting_users, active_games):
+# validate: parse and apply the move; engine: evaluation and suggestion; send: both players' updates
+MOVE_PHASE_SECONDS = Histogram("handle_move_seconds", "handle_move latency by phase", labelnames=("phase",))
+PREMOVES_PLAYED = Counter("premoves_played_total", "Queued moves played as soon as the opponent moved")
+
+logger = logging.getLogger(__name__)
+
+async def handle_init_game(websocket: WebSocket, event, lobby, active_games):
+    if event.data.get("bot"):
+        await start_bot_game(websocket, event, lobby, active_games)
+        return
     player_name = event.data["player_name"]
     total_time = event.data["total_time"]
     increment = event.data["increment"]
     time_key = (total_time, increment)
     
-    if waiting_users.get(time_key):
-        opponent_info = waiting_users[time_key].pop(0)
+    entry = lobby.make_entry(websocket, player_name, total_time, increment)
+    opponent_info = await lobby.match_or_wait(time_key, entry)
+
+    if opponent_info:
         opponent_name = opponent_info["player_name"]
-        opponent_socket = opponent_info["websocket"]
+        opponent_socket = lobby.socket_for(opponent_info)
         
         game_id = UUID4().hex  # Generate unique game ID
+        game_id_var.set(game_id)
+        logger.info("Starting game between %s and %s", player_name, opponent_name)
         
         game = Game(game_id=game_id)
         time = TimeControl(
@@ -30,7 +51,8 @@ async def handle_init_game(websocket: WebSocket, event, waiting_users, active_ga
         game.current_turn = player_name
         time.start(player_name, player_name, opponent_name, websocket, opponent_socket)
         
-        # Save game in active_games by game_id
+        # Save game in active_games by game_id and host it on this worker
+        await lobby.claim_game(game_id)
         active_games[game_id] = {
             "players": {
                 player_name: {"websocket": websocket, "time": time},
@@ -51,19 +73,8 @@ async def handle_init_game(websocket: WebSocket, event, waiting_users, active_ga
             "turn": player_name
         })
     else:
-        # Add this player to the waiting queue
-        if time_key not in waiting_users:
-            waiting_users[time_key] = []
-        
-        waiting_users[time_key].append({
-            "player_name": player_name,
-            "websocket": websocket,
-            "total_time": total_time,
-            "increment": increment
-        })
-        
         # Get count of players waiting with same time control
-        waiting_count = len(waiting_users[time_key])
+        waiting_count = await lobby.queue_length(time_key)
         await websocket.send_json({
             "event": "WAITING",
             "data": {
@@ -71,14 +82,15 @@ async def handle_init_game(websocket: WebSocket, event, waiting_users, active_ga
             }
         })
 
-async def handle_join_game(websocket: WebSocket, event, joining_games, active_games):
+async def handle_join_game(websocket: WebSocket, event, lobby, active_games):
     player_name = event.data["player_name"]
     game_id = event.data["game_id"]
     
-    if game_id in joining_games:
-        opponent_info = joining_games.pop(game_id)
+    opponent_info = await lobby.pop_invite(game_id)
+    if opponent_info:
         opponent_name = opponent_info["player_name"]
-        opponent_socket = opponent_info["websocket"]
+        opponent_socket = lobby.socket_for(opponent_info)
+        logger.info("Starting game between %s and %s", opponent_name, player_name)
         
         game = Game(game_id=game_id)
         time = TimeControl(
@@ -92,6 +104,7 @@ async def handle_join_game(websocket: WebSocket, event, joining_games, active_ga
         game.current_turn = opponent_name
         time.start(opponent_name, opponent_name, player_name, opponent_socket, websocket)
         
+        await lobby.claim_game(game_id)
         active_games[game_id] = {
             "players": {
                 opponent_name: {"websocket": opponent_socket, "time": time},
@@ -116,26 +129,126 @@ async def handle_join_game(websocket: WebSocket, event, joining_games, active_ga
             "data": {"message": "Invalid game ID or game not available for joining."}
         })
 
-async def handle_create_game(websocket: WebSocket, event, joining_games):
+async def handle_create_game(websocket: WebSocket, event, lobby, active_games):
+    if event.data.get("bot"):
+        await start_bot_game(websocket, event, lobby, active_games)
+        return
     player_name = event.data["player_name"]
     total_time = event.data["total_time"]
     increment = event.data["increment"]
     
     game_id = UUID4().hex  # Generate new game ID
     
-    joining_games[game_id] = {
-        "player_name": player_name,
-        "websocket": websocket,
-        "total_time": total_time,
-        "increment": increment
-    }
+    await lobby.create_invite(game_id, lobby.make_entry(websocket, player_name, total_time, increment))
     
     await websocket.send_json({
         "event": "GAME_CREATED",
         "data": {"message": "Game created. Share the game ID to invite a friend.", "game_id": game_id}
     })
 
+async def start_bot_game(websocket: WebSocket, event, lobby, active_games):
+    """
+    Start a game against the engine right away.
+
+    `bot` is true or the bot's strength ({"skill", "elo", "nodes"}); `color`
+    is the side the player takes, white by default.
+    """
+    player_name = event.data["player_name"]
+    settings = event.data["bot"] if isinstance(event.data["bot"], dict) else {}
+    color = event.data.get("color", "white")
+    try:
+        bot = BotPlayer(**settings)
+        if color not in ("white", "black"):
+            raise ValueError("Color must be white or black")
+        if bot.name == player_name:
+            raise ValueError("Player name is taken by the bot")
+    except (TypeError, ValueError) as e:
+        await websocket.send_json({
+            "event": "ERROR",
+            "data": {"message": f"Invalid bot game: {e}"}
+        })
+        return
+
+    game_id = UUID4().hex
+    game_id_var.set(game_id)
+    white, black = (player_name, bot.name) if color == "white" else (bot.name, player_name)
+    logger.info("Starting game between %s and %s", white, black)
+
+    game = Game(game_id=game_id)
+    time = TimeControl(
+        total_time=event.data["total_time"],
+        increment=event.data["increment"],
+        game=game,
+        active_games=active_games,
+        game_id=game_id
+    )
+    game.start(white, black)
+    game.current_turn = white
+
+    await lobby.claim_game(game_id)
+    active_games[game_id] = {
+        "players": {
+            player_name: {"websocket": websocket, "time": time},
+            bot.name: {"websocket": None, "time": time}
+        },
+        "game": game
+    }
+    bot_socket = attach_bot(game_id, active_games, bot)
+    sockets = (websocket, bot_socket) if color == "white" else (bot_socket, websocket)
+    time.start(white, white, black, *sockets)
+
+    await websocket.send_json({
+        "event": "GAME_STARTED",
+        "data": {"opponent": bot.name, "game_id": game_id, "bot": bot.settings()},
+        "turn": white
+    })
+    # Starts the bot's first move if it has white
+    await bot_socket.send_json({
+        "event": "GAME_STARTED",
+        "data": {"opponent": player_name, "game_id": game_id},
+        "turn": white
+    })
+
+def attach_bot(game_id: str, active_games, bot: BotPlayer) -> BotSocket:
+    """Seat a bot in its game; it answers every message that puts it on move."""
+    game_data = active_games[game_id]
+    socket = BotSocket(bot.name, lambda: play_bot_move(game_id, active_games))
+    game_data["bot"] = bot
+    game_data["players"][bot.name]["websocket"] = socket
+    return socket
+
+async def play_bot_move(game_id: str, active_games):
+    """Search and play the bot's move, unless the game ended or moved on during the search."""
+    game_id_var.set(game_id)
+    game_data = active_games.get(game_id)
+    if not game_data or game_data["game"].current_turn != game_data["bot"].name:
+        return
+    game = game_data["game"]
+    bot = game_data["bot"]
+    time = game_data["players"][bot.name]["time"]
+    board = game.board.copy()
+    try:
+        move = await bot.choose_move(game.engines, board, time.remaining(bot.name), game_id)
+    except Exception:
+        # The bot's clock keeps running; it loses on time rather than leaving the game stuck
+        logger.exception("Bot failed to find a move")
+        return
+    if active_games.get(game_id) is not game_data or game.board.fen() != board.fen():
+        return
+
+    started = perf_counter()
+    player_name = game.player1 if bot.name == game.player2 else game.player2
+    with handling("BOT_MOVE", game_id):
+        try:
+            if await play_move(game_id, active_games, bot.name, board.san(move), started):
+                await play_premove(game_id, active_games, player_name)
+        except Exception:
+            logger.exception("Error playing the bot's move %s", move)
+        finally:
+            MOVE_PHASE_SECONDS.labels("total").observe(perf_counter() - started)
+
 async def handle_move(websocket: WebSocket, event, active_games):
+    started = perf_counter()
     game_id = event.data.get("game_id")
     if not game_id or game_id not in active_games:
         await websocket.send_json({
@@ -147,12 +260,7 @@ async def handle_move(websocket: WebSocket, event, active_games):
     game_data = active_games[game_id]
     game = game_data["game"]
     players = game_data["players"]
-    player_name = None
-    
-    for name, details in players.items():
-        if details["websocket"] == websocket:
-            player_name = name
-            break
+    player_name = player_for(game_data, websocket)
     
     if not player_name:
         await websocket.send_json({
@@ -161,8 +269,6 @@ async def handle_move(websocket: WebSocket, event, active_games):
         })
         return
     
-    time = players[player_name]["time"]
-    
     # Check if it's the player's turn
     if game.current_turn != player_name:
         await websocket.send_json({
@@ -180,44 +286,79 @@ async def handle_move(websocket: WebSocket, event, active_games):
             })
             return
         
-        # Make the move and switch turn
-        game.move(move)
+        if await play_move(game_id, active_games, player_name, move, started):
+            # The opponent may have queued their reply already
+            opponent_name = game.player1 if player_name == game.player2 else game.player2
+            await play_premove(game_id, active_games, opponent_name)
+    except Exception as e:
+        logger.warning("Error handling move from %s: %s", player_name, e)
+        await websocket.send_json({
+            "event": "ERROR",
+            "data": {"message": str(e)}
+        })
+    finally:
+        MOVE_PHASE_SECONDS.labels("total").observe(perf_counter() - started)
+
+async def play_move(game_id: str, active_games, player_name: str, move: str, started: float) -> bool:
+    """Apply a validated move, update the clocks and tell both players; False once the game is over."""
+    game_data = active_games[game_id]
+    game = game_data["game"]
+    players = game_data["players"]
+    time = players[player_name]["time"]
+    websocket = players[player_name]["websocket"]
+
+    # Make the move and switch turn
+    game.move(move)
+    
+    game.update_status()
+    game_status = game.get_status()
+    MOVE_PHASE_SECONDS.labels("validate").observe(perf_counter() - started)
+    active_time = time.timer_active
+    opponent_name = game.player1 if player_name == game.player2 else game.player2
+    opponent_socket = players[opponent_name]["websocket"]
+    
+    if game_status == "ongoing" and active_time:
+        try:
+            time_update = time.process_move(player_name)
+            game.current_turn = opponent_name
+            if premove_ready(game.board, players[opponent_name]):
+                # The premove replaces this position at once and is evaluated instead, so it costs its player no engine time
+                evaluation = winning_chance = suggest = None
+            else:
+                with MOVE_PHASE_SECONDS.labels("engine").time():
+                    evaluation, suggest = await asyncio.gather(game.evaluate(), game.suggest())
+                    winning_chance = game.get_winning_chances(evaluation)
+            logger.debug("%s played %s, clocks %s, winning chances %s", player_name, move, time_update, winning_chance)
+        except EngineUnavailable as e:
+            # The engines are swamped; the move goes out without its evaluation
+            logger.warning("No evaluation after %s: %s", move, e)
+            evaluation = None
+            winning_chance = None
+            suggest = None
+        except Exception:
+            logger.exception("Error updating clocks or evaluation after %s", move)
+            time_update = None
+            evaluation = None
+            winning_chance = None
+            suggest = None
+
+        log_move(game_id, len(game.moves), move, time.remaining(player_name))
         
-        game.update_status()
-        game_status = game.get_status()
-        active_time = time.timer_active
-        opponent_name = game.player1 if player_name == game.player2 else game.player2
-        opponent_socket = players[opponent_name]["websocket"]
+        response = {
+            "event": "MOVE",
+            "data": {"move": move, "turn": game.current_turn, "game_id": game_id},
+            "winning_chance": winning_chance,
+            "suggest": suggest,
+            "time": time_update
+        }
         
-        if game_status == "ongoing" and active_time:
-            try:
-                print(f"Updating time for player: {player_name}")
-                time_update = time.process_move(player_name)
-                print(f"Updated time for player: {player_name}")
-                game.current_turn = opponent_name
-                print(f"Switching turn to player: {opponent_name}")
-                evaluation = game.get_evaluation()
-                winning_chance = game.get_winning_chances(evaluation)
-                print(f"Winning chances: {winning_chance}")
-                suggest = game.suggest_move()
-            except Exception as e:
-                print(e)
-                time_update = None
-                evaluation = None
-                winning_chance = None
-                suggest = None
-            
-            response = {
-                "event": "MOVE",
-                "data": {"move": move, "turn": game.current_turn, "game_id": game_id},
-                "winning_chance": winning_chance,
-                "suggest": suggest,
-                "time": time_update
-            }
-            
+        with MOVE_PHASE_SECONDS.labels("send").time():
             await websocket.send_json(response)
             await opponent_socket.send_json(response)
-        else:
+        return True
+    else:
+        log_move(game_id, len(game.moves), move, time.remaining(player_name))
+        with MOVE_PHASE_SECONDS.labels("send").time():
             await websocket.send_json({
                 "event": "MOVE",
                 "data": {"move": move, "turn": game.current_turn, "game_id": game_id}
@@ -226,21 +367,100 @@ async def handle_move(websocket: WebSocket, event, active_games):
                 "event": "MOVE",
                 "data": {"move": move, "turn": game.current_turn, "game_id": game_id}
             })
-            winner = game.current_turn
-            await websocket.send_json({
-                "event": "GAME_OVER",
-                "data": {"status": game.get_status(), "winner": winner}
-            })
-            await opponent_socket.send_json({
-                "event": "GAME_OVER",
-                "data": {"status": game.get_status(), "winner": winner}
-            })
-            db = get_db()
-            save_game(game.id, game.player1, game.player2, game.moves, winner, game.get_status(), db)
-            # Remove game from active_games
-            del active_games[game_id]
-    except Exception as e:
+        winner = game.current_turn
+        await websocket.send_json({
+            "event": "GAME_OVER",
+            "data": {"status": game.get_status(), "winner": winner}
+        })
+        await opponent_socket.send_json({
+            "event": "GAME_OVER",
+            "data": {"status": game.get_status(), "winner": winner}
+        })
+        save_game(game.id, game.player1, game.player2, game.moves, winner, game.get_status(), time.total_time, time.increment)
+        logger.info("Game over: %s, winner %s", game.get_status(), winner)
+        # Remove game from active_games
+        del active_games[game_id]
+        return False
+
+def premove_ready(board: chess.Board, details: dict) -> bool:
+    """Whether a player has queued a move that is legal in the position."""
+    premove = details.get("premove")
+    return premove is not None and chess.Move.from_uci(premove) in board.legal_moves
+
+async def play_premove(game_id: str, active_games, player_name: str):
+    """
+    Play the move a player queued while waiting for their opponent.
+
+    Runs in the same pass as the opponent's move, which skips its engine
+    work when a premove is ready, so the player's clock is only charged the
+    time the server spent applying and sending that move.
+    """
+    details = active_games[game_id]["players"][player_name]
+    premove = details.pop("premove", None)
+    if premove is None:
+        return
+    started = perf_counter()
+    board = active_games[game_id]["game"].board
+    move = chess.Move.from_uci(premove)
+    if move not in board.legal_moves:
+        await details["websocket"].send_json({
+            "event": "PREMOVE_CANCELLED",
+            "data": {"game_id": game_id, "move": premove, "reason": "Illegal after the opponent's move"}
+        })
+        return
+    PREMOVES_PLAYED.inc()
+    await play_move(game_id, active_games, player_name, board.san(move), started)
+
+async def handle_premove(websocket: WebSocket, event, active_games):
+    """Queue a move (in UCI) to be played as soon as the opponent has moved, replacing any queued one."""
+    game_id = event.data.get("game_id")
+    game_data = active_games.get(game_id)
+    player_name = game_data and player_for(game_data, websocket, on_turn=False)
+    if not player_name:
         await websocket.send_json({
             "event": "ERROR",
-            "data": {"message": str(e)}
-        })
\ No newline at end of file
+            "data": {"message": "Invalid game ID or no active game found!"}
+        })
+        return
+
+    game = game_data["game"]
+    try:
+        move = chess.Move.from_uci(event.data["move"])
+    except (KeyError, ValueError):
+        await websocket.send_json({
+            "event": "ERROR",
+            "data": {"message": f"Invalid premove: {event.data.get('move')}"}
+        })
+        return
+
+    if game.current_turn == player_name:
+        # The opponent's move arrived first; it is a normal move now
+        if move in game.board.legal_moves:
+            event.data["move"] = game.board.san(move)
+        await handle_move(websocket, event, active_games)
+        return
+
+    piece = game.board.piece_at(move.from_square)
+    if piece is None or piece.color != (player_name == game.player1):
+        await websocket.send_json({
+            "event": "ERROR",
+            "data": {"message": f"Invalid premove: {move.uci()}"}
+        })
+        return
+
+    game_data["players"][player_name]["premove"] = move.uci()
+    await websocket.send_json({
+        "event": "PREMOVE_SET",
+        "data": {"game_id": game_id, "move": move.uci()}
+    })
+
+async def handle_cancel_premove(websocket: WebSocket, event, active_games):
+    game_id = event.data.get("game_id")
+    game_data = active_games.get(game_id)
+    player_name = game_data and player_for(game_data, websocket, on_turn=False)
+    if player_name:
+        premove = game_data["players"][player_name].pop("premove", None)
+        await websocket.send_json({
+            "event": "PREMOVE_CANCELLED",
+            "data": {"game_id": game_id, "move": premove, "reason": "Cancelled"}
+        })
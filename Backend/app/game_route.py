@@ -1,38 +1,349 @@
-from fastapi import FastAPI, Depends, HTTPException
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Optional
+import chess
+import chess.pgn
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, select, tuple_, union_all
 from sqlalchemy.orm import Session
 from db.db import get_db
-from app.model import GameDB
+from app.model import GameDB, OpeningMoveDB, PlayerStatsDB, PositionDB
+from app.positions import position_key
+from app.ratings import DRAW_STATUSES, OVERALL, PROVISIONAL_DEVIATION, game_result
+from app.cache import LRUCache
 from fastapi import APIRouter, HTTPException, Depends
 
+# Columns returned by history listings; moves are only loaded by /game/{game_id}
+HISTORY_COLUMNS = (
+    GameDB.game_id,
+    GameDB.status,
+    GameDB.winner,
+    GameDB.player1,
+    GameDB.player2,
+    GameDB.ended_at,
+    GameDB.total_time,
+    GameDB.increment,
+)
+EXPORT_COLUMNS = HISTORY_COLUMNS + (GameDB.moves,)
+EXPORT_CHUNK = 500  # Games read per short transaction while exporting
+
+# Finished games never change, so their serialized payloads can be cached and revalidated forever
+GAME_CACHE_SIZE = int(os.getenv("GAME_CACHE_SIZE", "2048"))
+GAME_PAYLOAD_VERSION = 1  # Bump whenever the /game/{game_id} payload format changes
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+finished_games = LRUCache(GAME_CACHE_SIZE)  # game_id -> serialized response body
+
+# Hot tier for the explorer: popular positions stay in memory, refreshed every EXPLORER_CACHE_TTL seconds
+EXPLORER_CACHE_SIZE = int(os.getenv("EXPLORER_CACHE_SIZE", "10000"))
+EXPLORER_CACHE_TTL = float(os.getenv("EXPLORER_CACHE_TTL", "60"))
+
+explorer_positions = LRUCache(EXPLORER_CACHE_SIZE, ttl=EXPLORER_CACHE_TTL)  # Zobrist key -> serialized response body
+
 router = APIRouter()
 
+def game_etag(game_id: str) -> str:
+    """Strong ETag for a finished game; its payload is fixed once the game is saved."""
+    return '"' + hashlib.sha1(f"{GAME_PAYLOAD_VERSION}:{game_id}".encode()).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str, exists: bool = False) -> bool:
+    """`*` matches any current representation, so it only counts once the game is known to be saved."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return (exists and "*" in tags) or etag in tags or f"W/{etag}" in tags
+
+
 @router.get("/game/{game_id}")
-def get_game_details(game_id: str, db: Session = Depends(get_db)):
-    game = db.query(GameDB).filter(GameDB.game_id == game_id).first()
-    if not game:
-        raise HTTPException(status_code=404, detail="Game not found")
+def get_game_details(game_id: str, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    # The session stays unused (and never connects) on 304s and cache hits
+    etag = game_etag(game_id)
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    body = finished_games.get(game_id)
+    if body is None:
+        game = db.query(GameDB).filter(GameDB.game_id == game_id).first()
+        if not game:
+            raise HTTPException(status_code=404, detail="Game not found")
+        body = json.dumps({
+            "game_id": game.game_id,
+            "player1": game.player1,
+            "player2": game.player2,
+            "status": game.status,
+            "winner": game.winner,
+            "moves" : game.moves
+        }, separators=(",", ":")).encode()
+        finished_games.put(game_id, body)
+    if etag_matches(if_none_match, etag, exists=True):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def encode_cursor(ended_at: datetime, game_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{ended_at.isoformat()}|{game_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        ended_at, game_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(ended_at), game_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def user_games_query(username: str, limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                     result: Optional[str] = None, time_control: Optional[str] = None, columns=HISTORY_COLUMNS):
+    """
+    Newest-first page of a user's games, projected to `columns`.
+
+    Each side of the OR runs as its own index range scan on
+    (player, ended_at, game_id), and the two sorted halves are merged, so a
+    page costs the same however many games the user has.
+    """
+    filters = []
+    if cursor:
+        filters.append(tuple_(GameDB.ended_at, GameDB.game_id) < tuple_(*decode_cursor(cursor)))
+    if status:
+        filters.append(GameDB.status == status)
+    if time_control:
+        try:
+            total_time, increment = (int(part) for part in time_control.split("+"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="time_control must look like 600+10")
+        filters.extend([GameDB.total_time == total_time, GameDB.increment == increment])
+    if result == "draw":
+        filters.append(GameDB.status.in_(DRAW_STATUSES))
+    elif result in ("win", "loss"):
+        filters.append(GameDB.status.notin_(DRAW_STATUSES))
+        filters.append(GameDB.winner == username if result == "win" else GameDB.winner != username)
+    elif result:
+        raise HTTPException(status_code=400, detail="result must be one of win, loss, draw")
+
+    sides = []
+    for column, other in ((GameDB.player1, None), (GameDB.player2, GameDB.player1)):
+        conditions = [column == username, *filters]
+        if other is not None:
+            conditions.append(other != username)  # Don't list games against oneself twice
+        side = (
+            select(*columns)
+            .where(and_(*conditions))
+            .order_by(GameDB.ended_at.desc(), GameDB.game_id.desc())
+            .limit(limit)
+        )
+        sides.append(select(side.subquery()))
+    games = union_all(*sides).subquery()
+    return select(games).order_by(games.c.ended_at.desc(), games.c.game_id.desc()).limit(limit)
+
+
+@router.get("/user/{username}/games")
+def get_user_games(
+    username: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    status: Optional[str] = None,
+    result: Optional[str] = None,
+    time_control: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """One page of a user's games; pass the X-Next-Cursor response header back as `cursor` for the next."""
+    games = db.execute(user_games_query(username, limit, cursor, status, result, time_control)).all()
+    if not games and not cursor:
+        raise HTTPException(status_code=404, detail="No games found for this user")
+    if len(games) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(games[-1].ended_at, games[-1].game_id)
+    return [game_summary(game) for game in games]
+
+
+def game_summary(game) -> dict:
     return {
         "game_id": game.game_id,
-        "player1": game.player1,
-        "player2": game.player2,
         "status": game.status,
         "winner": game.winner,
-        "moves" : game.moves
+        "player1": game.player1,
+        "player2": game.player2,
+        "ended_at": game.ended_at.isoformat() if game.ended_at else None,
+        "total_time": game.total_time,
+        "increment": game.increment,
     }
 
 
-@router.get("/user/{username}/games")
-def get_user_games(username: str, db: Session = Depends(get_db)):
-    games = db.query(GameDB).filter((GameDB.player1 == username) | (GameDB.player2 == username)).all()
-    if not games:
-        raise HTTPException(status_code=404, detail="No games found for this user")
-    return [
-        {
-            "game_id": game.game_id,
-            "status": game.status,
-            "winner": game.winner,
-            "player1": game.player1,
-            "player2": game.player2,
+@router.get("/positions/{fen:path}/games")
+def get_position_games(
+    fen: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db)
+):
+    """
+    Games that reached a position, in game id order.
+
+    A single range scan of the positions primary key by Zobrist key; pass
+    the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    board = board_from_fen(fen)
+    query = (
+        select(*HISTORY_COLUMNS, PositionDB.ply)
+        .join(PositionDB, PositionDB.game_id == GameDB.game_id)
+        .where(PositionDB.zobrist == position_key(board))
+        .order_by(PositionDB.game_id)
+        .limit(limit)
+    )
+    if cursor:
+        query = query.where(PositionDB.game_id > cursor)
+    games = db.execute(query).all()
+    if len(games) == limit:
+        response.headers["X-Next-Cursor"] = games[-1].game_id
+    return [dict(game_summary(game), ply=game.ply) for game in games]
+
+
+def board_from_fen(fen: str) -> chess.Board:
+    try:
+        return chess.Board(fen)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid FEN")
+
+
+@router.get("/explorer/{fen:path}")
+def get_explorer(fen: str, db: Session = Depends(get_db)):
+    """Every move played from a position in the opening with its results, most played first."""
+    board = board_from_fen(fen)
+    key = position_key(board)
+    body = explorer_positions.get(key)
+    if body is None:
+        moves = []
+        for row in db.query(OpeningMoveDB).filter(OpeningMoveDB.zobrist == key):
+            move = chess.Move.from_uci(row.move)
+            if not board.is_legal(move):
+                continue  # Recorded from another position with the same key
+            moves.append({
+                "uci": row.move,
+                "san": board.san(move),
+                "white": row.white_wins,
+                "draws": row.draws,
+                "black": row.black_wins,
+                "games": row.white_wins + row.draws + row.black_wins,
+            })
+        moves.sort(key=lambda move: move["games"], reverse=True)
+        body = json.dumps({
+            "white": sum(move["white"] for move in moves),
+            "draws": sum(move["draws"] for move in moves),
+            "black": sum(move["black"] for move in moves),
+            "moves": moves,
+        }, separators=(",", ":")).encode()
+        explorer_positions.put(key, body)
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={int(EXPLORER_CACHE_TTL)}"}
+    )
+
+
+@router.get("/user/{username}/stats")
+def get_user_stats(username: str, db: Session = Depends(get_db)):
+    """Results and rating, overall and per time control, from the incrementally maintained player_stats."""
+    rows = db.query(PlayerStatsDB).filter(PlayerStatsDB.username == username).all()
+    stats = {
+        row.time_control: {
+            "games": row.games,
+            "wins": row.wins,
+            "losses": row.losses,
+            "draws": row.draws,
+            "rating": round(row.rating),
+            "deviation": round(row.deviation),
+            "provisional": row.deviation > PROVISIONAL_DEVIATION,
         }
-        for game in games
-    ]
+        for row in rows
+    }
+    if OVERALL not in stats:
+        raise HTTPException(status_code=404, detail="No games found for this user")
+    return {"username": username, "overall": stats.pop(OVERALL), "time_controls": stats}
+
+
+def game_to_pgn(game) -> str:
+    pgn = chess.pgn.Game()
+    pgn.headers["Event"] = "Casual game"
+    pgn.headers["Site"] = "Chess"
+    pgn.headers["Date"] = game.ended_at.strftime("%Y.%m.%d") if game.ended_at else "????.??.??"
+    pgn.headers["White"] = game.player1
+    pgn.headers["Black"] = game.player2
+    pgn.headers["Result"] = game_result(game.status, game.winner, game.player1, game.player2)
+    if game.total_time is not None:
+        pgn.headers["TimeControl"] = f"{game.total_time}+{game.increment or 0}"
+    pgn.headers["Termination"] = game.status
+    pgn.headers["GameId"] = game.game_id
+
+    node = pgn
+    for move in game.moves or []:
+        try:
+            node = node.add_variation(node.board().parse_san(move))
+        except ValueError:
+            break  # Keep the legal prefix of a corrupt record
+    return str(pgn) + "\n\n"
+
+
+def game_to_ndjson(game) -> str:
+    return json.dumps({
+        "game_id": game.game_id,
+        "player1": game.player1,
+        "player2": game.player2,
+        "status": game.status,
+        "winner": game.winner,
+        "ended_at": game.ended_at.isoformat() if game.ended_at else None,
+        "total_time": game.total_time,
+        "increment": game.increment,
+        "moves": game.moves,
+    }, separators=(",", ":")) + "\n"
+
+
+def export_games(db: Session, username: str, formatter, **filters):
+    """
+    Yield a user's games formatted one chunk at a time.
+
+    Every chunk is a separate keyset page read through a server-side cursor
+    and its transaction is ended right away, so memory stays flat and no
+    transaction lives for the length of the download.
+    """
+    cursor = None
+    while True:
+        query = user_games_query(username, EXPORT_CHUNK, cursor, columns=EXPORT_COLUMNS, **filters)
+        result = db.execute(query.execution_options(stream_results=True, yield_per=100))
+        chunk = []
+        last = None
+        for game in result:
+            chunk.append(formatter(game))
+            last = game
+        db.rollback()  # Read-only; just end the transaction
+        if chunk:
+            yield "".join(chunk)
+        if len(chunk) < EXPORT_CHUNK:
+            return
+        cursor = encode_cursor(last.ended_at, last.game_id)
+
+
+@router.get("/user/{username}/games/export")
+def export_user_games(
+    username: str,
+    format: str = Query("pgn", pattern="^(pgn|ndjson)$"),
+    status: Optional[str] = None,
+    result: Optional[str] = None,
+    time_control: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Stream every game of a user as PGN or NDJSON, newest first."""
+    # Validate filters up front; errors can't be reported once streaming has started
+    user_games_query(username, 1, None, status, result, time_control)
+    formatter, media_type = (game_to_pgn, "application/x-chess-pgn") if format == "pgn" else (game_to_ndjson, "application/x-ndjson")
+    return StreamingResponse(
+        export_games(db, username, formatter, status=status, result=result, time_control=time_control),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{username}-games.{format}"'}
+    )
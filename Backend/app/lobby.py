@@ -0,0 +1,477 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from uuid import uuid4 as UUID4
+
+import redis
+from dotenv import load_dotenv
+
+from app.log import game_id_var
+from app.model import Event
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+logger = logging.getLogger(__name__)
+
+# Identifies this worker process in the shared lobby (gunicorn runs several per node)
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{UUID4().hex[:8]}"
+
+WORKER_TTL = 30  # Seconds a worker stays "alive" in Redis without a heartbeat
+INVITE_TTL = 24 * 60 * 60  # Unjoined invites expire after a day
+GAME_TTL = 24 * 60 * 60  # Ownership records outlive any real game
+
+
+class RemoteSocket:
+    """
+    Stand-in for a WebSocket that lives on another worker.
+
+    Handlers only ever call send_json on player sockets, so a game hosted on
+    this worker can treat remote players exactly like local ones.
+    """
+
+    def __init__(self, lobby, worker_id: str, conn_id: str):
+        self.lobby = lobby
+        self.worker_id = worker_id
+        self.conn_id = conn_id
+
+    async def send_json(self, message: dict):
+        await self.lobby.deliver(self.worker_id, self.conn_id, message)
+
+    def __eq__(self, other):
+        return isinstance(other, RemoteSocket) and other.conn_id == self.conn_id
+
+    def __hash__(self):
+        return hash(self.conn_id)
+
+
+class LobbyStore(ABC):
+    """
+    Matchmaking queues and join-by-ID invites shared by every worker.
+
+    Waiting entries are plain dicts (player_name, conn_id, worker_id,
+    total_time, increment) so they can be stored outside the process; the
+    WebSocket itself always stays in `connections` on the worker it belongs to.
+
+    Each game is hosted by the worker that created it. Events for a game that
+    arrive on another worker are forwarded to the owner, which runs the
+    handler against a RemoteSocket and relays its replies back.
+    """
+
+    def __init__(self):
+        self.worker_id = WORKER_ID
+        self.connections = {}  # conn_id -> local WebSocket
+        self.remote_games = {}  # conn_id -> {game_id: owner worker} for games hosted elsewhere
+        self.event_handler = None
+        self.loop = None
+        self.relayed = {}  # (sending worker, conn_id) -> messages from that connection not yet handled
+        self._relay_tasks = set()
+
+    def register(self, websocket) -> str:
+        """Register a local connection and return its lobby-wide id."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        conn_id = UUID4().hex
+        self.connections[conn_id] = websocket
+        websocket.state.conn_id = conn_id
+        return conn_id
+
+    def unregister(self, conn_id: str):
+        self.connections.pop(conn_id, None)
+        self.remote_games.pop(conn_id, None)
+
+    def make_entry(self, websocket, player_name: str, total_time, increment) -> dict:
+        return {
+            "player_name": player_name,
+            "conn_id": websocket.state.conn_id,
+            "worker_id": self.worker_id,
+            "total_time": total_time,
+            "increment": increment
+        }
+
+    def socket_for(self, entry: dict):
+        """Return the local WebSocket for an entry, or a relay to the worker holding it."""
+        if entry["worker_id"] == self.worker_id and entry["conn_id"] in self.connections:
+            return self.connections[entry["conn_id"]]
+        return RemoteSocket(self, entry["worker_id"], entry["conn_id"])
+
+    async def deliver(self, worker_id: str, conn_id: str, message: dict):
+        """Send a message to a connection, wherever it lives."""
+        if worker_id == self.worker_id:
+            await self._deliver_local(conn_id, message)
+        else:
+            await self._publish(worker_id, {
+                "kind": "deliver",
+                "worker_id": self.worker_id,
+                "conn_id": conn_id,
+                "game_id": game_id_var.get(),
+                "message": message
+            })
+
+    async def forward_event(self, worker_id: str, websocket, event: Event):
+        """Hand an event from a local connection to the worker hosting its game."""
+        self.remote_games.setdefault(websocket.state.conn_id, {})[event.data["game_id"]] = worker_id
+        await self._publish(worker_id, {
+            "kind": "event",
+            "worker_id": self.worker_id,
+            "conn_id": websocket.state.conn_id,
+            "event": {"event": event.event, "data": event.data}
+        })
+
+    async def disconnect(self, websocket):
+        """Drop a closed connection and tell the owners of its remote games."""
+        conn_id = websocket.state.conn_id
+        remote_games = self.remote_games.get(conn_id, {})
+        await self.remove_waiting(conn_id)
+        self.unregister(conn_id)
+        for worker_id in set(remote_games.values()):
+            await self._publish(worker_id, {
+                "kind": "event",
+                "worker_id": self.worker_id,
+                "conn_id": conn_id,
+                "event": {"event": "DISCONNECT", "data": {}}
+            })
+
+    async def _deliver_local(self, conn_id: str, message: dict):
+        websocket = self.connections.get(conn_id)
+        if websocket is None:
+            logger.warning("Dropping message for unknown connection %s", conn_id)
+            return
+        await websocket.send_json(message)
+
+    def _receive(self, payload: dict):
+        """
+        Queue a message published to this worker behind earlier ones for the
+        same connection, so a remote player's events (MOVE then MOVE, PREMOVE
+        then CANCEL_PREMOVE) run one after another in the order sent, as they
+        do for local connections. Runs on the event loop.
+        """
+        key = (payload["worker_id"], payload["conn_id"])
+        pending = self.relayed.get(key)
+        if pending is not None:
+            pending.append(payload)
+            return
+        self.relayed[key] = deque([payload])
+        task = asyncio.create_task(self._drain(key))
+        self._relay_tasks.add(task)
+        task.add_done_callback(self._relay_tasks.discard)
+
+    async def _drain(self, key: tuple):
+        pending = self.relayed[key]
+        while pending:
+            await self._dispatch(pending[0])
+            pending.popleft()
+        del self.relayed[key]
+
+    async def _dispatch(self, payload: dict):
+        """Handle a message published to this worker by another one."""
+        try:
+            conn_id = payload["conn_id"]
+            if payload["kind"] == "deliver":
+                message = payload["message"]
+                data = message.get("data")
+                # Remember who hosts the game so a later disconnect reaches the owner
+                if conn_id in self.connections and isinstance(data, dict) and data.get("game_id"):
+                    self.remote_games.setdefault(conn_id, {})[data["game_id"]] = payload["worker_id"]
+                # Queued with the game it belongs to on multiplexed connections
+                game_id_var.set(payload.get("game_id"))
+                await self._deliver_local(conn_id, message)
+            elif payload["kind"] == "event" and self.event_handler:
+                websocket = RemoteSocket(self, payload["worker_id"], conn_id)
+                await self.event_handler(websocket, Event(**payload["event"]))
+        except Exception:
+            logger.exception("Error handling relayed message")
+
+    async def start(self, event_handler=None):
+        """Start serving; event_handler(websocket, event) runs events forwarded to this worker."""
+        self.loop = asyncio.get_running_loop()
+        self.event_handler = event_handler
+
+    async def close(self):
+        pass
+
+    # Storage primitives, implemented per backend
+
+    @abstractmethod
+    async def match_or_wait(self, time_key: tuple, entry: dict):
+        """Atomically pop a waiting opponent for time_key, or enqueue entry and return None."""
+
+    @abstractmethod
+    async def remove_waiting(self, conn_id: str):
+        ...
+
+    @abstractmethod
+    async def queue_length(self, time_key: tuple) -> int:
+        ...
+
+    @abstractmethod
+    def queue_lengths(self) -> dict:
+        """Players waiting per "total+increment" time control; blocking, meant for metrics scrapes."""
+
+    @abstractmethod
+    async def create_invite(self, game_id: str, entry: dict):
+        ...
+
+    @abstractmethod
+    async def pop_invite(self, game_id: str):
+        """Atomically claim an invite; only one joiner can ever get it."""
+
+    @abstractmethod
+    async def claim_game(self, game_id: str):
+        """Record this worker as the host of game_id."""
+
+    @abstractmethod
+    async def game_owner(self, game_id: str):
+        """Return the live worker id hosting game_id, or None if unknown or gone."""
+
+    @abstractmethod
+    async def take_over_game(self, game_id: str) -> str:
+        """Claim game_id unless a live worker already hosts it; return the host."""
+
+    @abstractmethod
+    async def _publish(self, worker_id: str, payload: dict):
+        ...
+
+
+class InMemoryLobbyStore(LobbyStore):
+    """Single-process lobby; used when no REDIS_URL is configured and in tests."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiting_users = defaultdict(list)  # time_key -> waiting entries
+        self.joining_games = {}  # game_id -> creator entry
+        self.game_owners = {}  # game_id -> worker id
+
+    async def match_or_wait(self, time_key, entry):
+        if self.waiting_users.get(time_key):
+            opponent = self.waiting_users[time_key].pop(0)
+            if not self.waiting_users[time_key]:
+                del self.waiting_users[time_key]
+            return opponent
+        self.waiting_users[time_key].append(entry)
+        return None
+
+    async def remove_waiting(self, conn_id):
+        for time_key in list(self.waiting_users.keys()):
+            self.waiting_users[time_key] = [
+                user for user in self.waiting_users[time_key] if user["conn_id"] != conn_id
+            ]
+            if not self.waiting_users[time_key]:
+                del self.waiting_users[time_key]
+
+    async def queue_length(self, time_key):
+        return len(self.waiting_users.get(time_key, []))
+
+    def queue_lengths(self):
+        return {
+            f"{total_time}+{increment}": len(entries)
+            for (total_time, increment), entries in list(self.waiting_users.items())
+        }
+
+    async def create_invite(self, game_id, entry):
+        self.joining_games[game_id] = entry
+
+    async def pop_invite(self, game_id):
+        return self.joining_games.pop(game_id, None)
+
+    async def claim_game(self, game_id):
+        self.game_owners[game_id] = self.worker_id
+
+    async def game_owner(self, game_id):
+        return self.game_owners.get(game_id)
+
+    async def take_over_game(self, game_id):
+        self.game_owners[game_id] = self.worker_id
+        return self.worker_id
+
+    async def _publish(self, worker_id, payload):
+        logger.warning("No route to worker %s without Redis, dropping message", worker_id)
+
+
+# Pop the first opponent whose worker is still alive, otherwise join the queue.
+# Runs as one Lua script so two workers can never claim the same opponent.
+MATCH_OR_WAIT_SCRIPT = """
+while true do
+    local opponent = redis.call('LPOP', KEYS[1])
+    if not opponent then
+        break
+    end
+    local worker_id = cjson.decode(opponent)['worker_id']
+    if redis.call('EXISTS', ARGV[2] .. worker_id) == 1 then
+        return opponent
+    end
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return false
+"""
+
+GAME_OWNER_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and redis.call('EXISTS', ARGV[1] .. owner) == 1 then
+    return owner
+end
+return false
+"""
+
+# Hand a game to this worker unless another live worker still hosts it
+TAKE_OVER_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] and redis.call('EXISTS', ARGV[2] .. owner) == 1 then
+    return owner
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return ARGV[1]
+"""
+
+POP_INVITE_SCRIPT = """
+local invite = redis.call('GET', KEYS[1])
+if invite then
+    redis.call('DEL', KEYS[1])
+end
+return invite
+"""
+
+
+class RedisLobbyStore(LobbyStore):
+    """
+    Lobby shared through Redis so all gunicorn workers (and nodes) pair together.
+
+    redis-py 3.x is synchronous, so every call runs in a thread to keep the
+    event loop free; cross-worker deliveries use one pub/sub channel per worker.
+    """
+
+    def __init__(self, client: redis.Redis, prefix: str = "lobby"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.waiting = {}  # conn_id -> (queue key, payload) for entries queued from this worker
+        self._match_or_wait = client.register_script(MATCH_OR_WAIT_SCRIPT)
+        self._pop_invite = client.register_script(POP_INVITE_SCRIPT)
+        self._game_owner = client.register_script(GAME_OWNER_SCRIPT)
+        self._take_over_game = client.register_script(TAKE_OVER_SCRIPT)
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def _queue_key(self, time_key):
+        total_time, increment = time_key
+        return f"{self.prefix}:queue:{total_time}:{increment}"
+
+    def _invite_key(self, game_id):
+        return f"{self.prefix}:invite:{game_id}"
+
+    def _game_key(self, game_id):
+        return f"{self.prefix}:game:{game_id}"
+
+    def _worker_key(self, worker_id):
+        return f"{self.prefix}:worker:{worker_id}"
+
+    def _channel(self, worker_id):
+        return f"{self.prefix}:channel:{worker_id}"
+
+    async def match_or_wait(self, time_key, entry):
+        key = self._queue_key(time_key)
+        payload = json.dumps(entry)
+        opponent = await asyncio.to_thread(
+            self._match_or_wait, keys=[key], args=[payload, f"{self.prefix}:worker:"]
+        )
+        if opponent is None:
+            self.waiting[entry["conn_id"]] = (key, payload)
+            return None
+        return json.loads(opponent)
+
+    async def remove_waiting(self, conn_id):
+        if conn_id in self.waiting:
+            key, payload = self.waiting.pop(conn_id)
+            await asyncio.to_thread(self.client.lrem, key, 0, payload)
+
+    async def queue_length(self, time_key):
+        return await asyncio.to_thread(self.client.llen, self._queue_key(time_key))
+
+    def queue_lengths(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}:queue:*", count=100))
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.llen(key)
+        lengths = pipeline.execute()
+        return {
+            "+".join(key.decode().rsplit(":", 2)[1:]): length
+            for key, length in zip(keys, lengths)
+        }
+
+    async def create_invite(self, game_id, entry):
+        await asyncio.to_thread(
+            self.client.set, self._invite_key(game_id), json.dumps(entry), ex=INVITE_TTL
+        )
+
+    async def pop_invite(self, game_id):
+        invite = await asyncio.to_thread(self._pop_invite, keys=[self._invite_key(game_id)])
+        return json.loads(invite) if invite else None
+
+    async def claim_game(self, game_id):
+        await asyncio.to_thread(self.client.set, self._game_key(game_id), self.worker_id, ex=GAME_TTL)
+
+    async def game_owner(self, game_id):
+        owner = await asyncio.to_thread(
+            self._game_owner, keys=[self._game_key(game_id)], args=[f"{self.prefix}:worker:"]
+        )
+        return owner.decode() if owner else None
+
+    async def take_over_game(self, game_id):
+        owner = await asyncio.to_thread(
+            self._take_over_game,
+            keys=[self._game_key(game_id)],
+            args=[self.worker_id, f"{self.prefix}:worker:", GAME_TTL]
+        )
+        return owner.decode()
+
+    async def _publish(self, worker_id, payload):
+        await asyncio.to_thread(self.client.publish, self._channel(worker_id), json.dumps(payload))
+
+    async def start(self, event_handler=None):
+        await super().start(event_handler)
+        await asyncio.to_thread(self._heartbeat)
+        self._stopped.clear()
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    async def close(self):
+        self._stopped.set()
+        if self._listener:
+            await asyncio.to_thread(self._listener.join, 5)
+        await asyncio.to_thread(self.client.delete, self._worker_key(self.worker_id))
+
+    def _heartbeat(self):
+        self.client.set(self._worker_key(self.worker_id), 1, ex=WORKER_TTL)
+
+    def _listen(self):
+        """Forward messages published to this worker's channel onto the event loop."""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel(self.worker_id))
+        last_beat = time.monotonic()
+        try:
+            while not self._stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if time.monotonic() - last_beat >= WORKER_TTL / 3:
+                    self._heartbeat()
+                    last_beat = time.monotonic()
+                if message is None:
+                    continue
+                payload = json.loads(message["data"])
+                self.loop.call_soon_threadsafe(self._receive, payload)
+        except Exception:
+            logger.exception("Lobby listener stopped")
+        finally:
+            pubsub.close()
+
+
+def get_lobby_store() -> LobbyStore:
+    if REDIS_URL:
+        return RedisLobbyStore(redis.Redis.from_url(REDIS_URL))
+    return InMemoryLobbyStore()
@@ -0,0 +1,140 @@
+"""
+Logging for the server.
+
+Handlers only put records on a bounded queue; a background listener
+formats and writes them, so a slow stdout never stalls the event loop, and
+a full queue drops records instead of blocking. Records carry the game and
+connection they belong to, taken from context variables set as events are
+handled. Loggers can be sampled below WARNING by game, so a sampled game is
+logged completely instead of one line in a hundred.
+
+Configured from the environment:
+
+    LOG_LEVEL=INFO                                              default level
+    LOG_LEVELS=app.game_handlers=DEBUG,app.lobby=WARNING        per-module levels
+    LOG_SAMPLE=app.websocket_handlers=0.01,app.game_handlers=0.1   share of games kept
+    LOG_FORMAT=json                                             or text
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import zlib
+
+from app.metrics import Counter
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+game_id_var = contextvars.ContextVar("game_id", default=None)  # Game the current event belongs to
+connection_id_var = contextvars.ContextVar("connection_id", default=None)  # Websocket the current event came from
+
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+listener = None
+
+
+def parse_settings(value: str) -> dict:
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    settings = {}
+    for item in value.split(","):
+        name, _, setting = item.partition("=")
+        if name.strip() and setting.strip():
+            settings[name.strip()] = setting.strip()
+    return settings
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the current game and connection, then applies per-logger sampling."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.logger_rates = {}  # Logger name -> rate of its closest configured ancestor
+
+    def rate(self, name: str) -> float:
+        if name not in self.logger_rates:
+            prefix = name
+            while prefix and prefix not in self.rates:
+                prefix = prefix.rpartition(".")[0]
+            self.logger_rates[name] = self.rates.get(prefix, 1.0)
+        return self.logger_rates[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Runs in the thread that logged, before the record is queued, so the context variables are visible
+        record.game_id = getattr(record, "game_id", None) or game_id_var.get()
+        record.connection_id = getattr(record, "connection_id", None) or connection_id_var.get()
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1:
+            return True
+        key = record.game_id or record.connection_id
+        sample = zlib.crc32(key.encode()) / 2 ** 32 if key else random.random()
+        return sample < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("game_id", "connection_id"):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        return json.dumps(entry)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        context = "".join(
+            f" {key}={getattr(record, key)}" for key in ("game_id", "connection_id") if getattr(record, key, None)
+        )
+        return f"{self.formatTime(record)} {record.levelname} {record.name}{context} {record.getMessage()}"
+
+
+def setup_logging():
+    """Send every log record through the queue to a background writer; safe to call twice."""
+    global listener
+    if listener:
+        return
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter({name: float(rate) for name, rate in parse_settings(LOG_SAMPLE).items()}))
+    root.handlers = [handler]
+
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+
+
+def stop_logging():
+    """Write out queued records and stop the writer."""
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
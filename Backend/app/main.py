@@ -1,15 +1,27 @@
 import asyncio
-from collections import defaultdict
 from fastapi import FastAPI, WebSocket, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-from app.websocket_handlers import websocket_endpoint
-from app.auth import router as auth_router
+from app.log import setup_logging, stop_logging
+
+# Before the other app modules, so messages logged while importing them are written too
+setup_logging()
+
+from app.websocket_handlers import websocket_endpoint, handle_event
+from app.auth import router as auth_router, close_password_pool
 from app.game_route import router as game_router
-from db.db import engine, Base
+from app.analysis import router as analysis_router
+from app.engine_pool import engine_pool
+from app.lobby import get_lobby_store
+from app.snapshot import get_snapshot_store, Snapshotter
+from app.metrics import Gauge, router as metrics_router, worker_metrics
+from app.persistence import game_writer
+from app.watchdog import LoopWatchdog, router as debug_router
+from app.model import Base
+from db.db import engine
 
-# Initialize database
+# Initialize database; tables that already exist are upgraded by `python -m app.migrate`
 Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
@@ -17,6 +29,9 @@ app = FastAPI()
 # Add routers
 app.include_router(auth_router)
 app.include_router(game_router)
+app.include_router(analysis_router)
+app.include_router(metrics_router)
+app.include_router(debug_router)
 
 # Add middleware
 app.add_middleware(
@@ -25,12 +40,46 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Global state
-app.state.waiting_users = defaultdict(list)  # Store players waiting for opponents
-app.state.active_games = {}  # Track active games by game ID
-app.state.joining_games = {}  # Track games waiting for another player to join
+app.state.lobby = get_lobby_store()  # Matchmaking queues and invites, shared across workers with Redis
+app.state.active_games = {}  # Track active games hosted by this worker by game ID
+app.state.snapshots = get_snapshot_store()  # Lets games survive restarts, resumed on RECONNECT
+app.state.snapshotter = Snapshotter(app.state.snapshots, app.state.active_games)
+app.state.watchdog = LoopWatchdog()  # Reports handlers that block the event loop
+
+ACTIVE_GAMES = Gauge("active_games", "Games hosted by this worker", lambda: len(app.state.active_games))
+LOBBY_WAITING = Gauge(
+    "lobby_waiting_players", "Players waiting for an opponent, per time control",
+    lambda: {(time_control,): waiting for time_control, waiting in app.state.lobby.queue_lengths().items()},
+    labelnames=("time_control",), per_worker=False  # Lobby-wide with Redis; every worker sees the same queues
+)
+
+@app.on_event("startup")
+async def start_lobby():
+    # Events forwarded from other workers are for games hosted here
+    async def handle_forwarded_event(websocket, event):
+        await handle_event(websocket, event, app, forwarded=True)
+
+    await app.state.lobby.start(handle_forwarded_event)
+    app.state.snapshotter.start()
+    game_writer.start()
+    app.state.watchdog.start()
+    worker_metrics.start()
+
+@app.on_event("shutdown")
+async def close_lobby():
+    app.state.watchdog.stop()
+    await asyncio.to_thread(worker_metrics.stop)
+    await app.state.snapshotter.close()
+    await app.state.lobby.close()
+    # Games that ended before shutdown must reach the database
+    await asyncio.to_thread(game_writer.close)
+    close_password_pool()
+    await asyncio.to_thread(engine_pool.close)
+    stop_logging()
 
 # Static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
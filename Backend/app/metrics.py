@@ -0,0 +1,371 @@
+"""
+Prometheus metrics for /metrics.
+
+Under gunicorn every worker process has its own registry, and a scrape
+reaches whichever worker accepts it. With METRICS_DIR set, each worker
+writes the state of its metrics to <pid>-<token>.json there every
+METRICS_INTERVAL seconds (and on shutdown), and /metrics adds up the
+counters and histograms of every worker. Files of workers that have
+exited are folded into retired.json, so totals never go backwards, even
+when a new worker gets an old worker's pid. Gauges are per worker and get
+a `worker` label, except those that are the same in every worker. Empty
+the directory before starting the server, as the Procfile does; without
+METRICS_DIR each worker only reports itself.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from uuid import uuid4
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.getenv("METRICS_DIR")  # Shared by the workers of one server
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "5"))  # Seconds between writes of a worker's metrics
+RETIRED = "retired.json"  # Counters and histograms of exited workers, added up
+
+# Seconds; covers sub-millisecond commits up to a stalled database
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _key(values) -> str:
+    """Label values as a JSON object key."""
+    return json.dumps(list(values))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+    def render(self, samples=None):
+        """Exposition lines for (worker, sample) pairs, by default this worker's own."""
+        samples = samples if samples is not None else [(None, self.sample())]
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        yield f"{self.name} {sum(value for _, value in samples)}"
+
+
+class Gauge:
+    """
+    A value that goes up and down; pass `function` to read it at scrape time.
+
+    With `labelnames`, `function` returns a dict mapping tuples of label
+    values to values. Pass per_worker=False for values that are the same in
+    every worker, such as ones read from Redis: they are reported once, by
+    the worker that is scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, function=None, labelnames=(), per_worker: bool = True):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        self.per_worker = per_worker
+        self.value = 0
+        REGISTRY.append(self)
+
+    def set(self, value: float):
+        self.value = value
+
+    def sample(self):
+        value = self.function() if self.function else self.value
+        if self.labelnames:
+            return {_key(values): sample for values, sample in value.items()}
+        return {_key(()): value}
+
+    def render(self, samples=None):
+        samples = samples if samples is not None else [(None, self.sample())]
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for worker, values in samples:
+            for key, sample in sorted(values.items()):
+                labels = dict(zip(self.labelnames, json.loads(key)))
+                if worker is not None:
+                    labels["worker"] = worker
+                yield f"{self.name}{_format_labels(labels)} {sample}"
+
+
+class Histogram:
+    """
+    Cumulative histogram; observing costs a bisect and an uncontended lock.
+
+    With `labelnames`, observe through `labels(*values)`, which returns the
+    child histogram for those label values.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS, labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self.children = {}  # label values -> child Histogram
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        if register:
+            REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(
+                    values, Histogram(self.name, self.documentation, self.buckets, register=False)
+                )
+        return child
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block."""
+        return _Timer(self)
+
+    def sample(self):
+        """Label values -> bucket counts followed by the sum."""
+        histograms = list(self.children.items()) if self.labelnames else [((), self)]
+        return {_key(values): histogram._state() for values, histogram in histograms}
+
+    def _state(self) -> list:
+        with self.lock:
+            return self.counts + [self.sum]
+
+    def render(self, samples=None):
+        samples = samples if samples is not None else [(None, self.sample())]
+        merged = {}
+        for _, states in samples:
+            for key, state in states.items():
+                total = merged.setdefault(key, [0] * len(state))
+                for index, value in enumerate(state):
+                    total[index] += value
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, state in sorted(merged.items()):
+            yield from self._samples(dict(zip(self.labelnames, json.loads(key))), state[:-1], state[-1])
+
+    def _samples(self, labels: dict, counts: list, total: float):
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}"
+        cumulative += counts[-1]
+        yield f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(labels)} {total}"
+        yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def timed_send(histogram: Histogram, send_json):
+    """Wrap a websocket's send_json so every send is observed in `histogram`."""
+    async def send(message, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await send_json(message, *args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return send
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _fold(totals: dict, states: dict):
+    """Add an exited worker's counter and histogram states to `totals`; its gauges are dropped."""
+    metrics = {metric.name: metric for metric in REGISTRY}
+    for name, state in states.items():
+        metric = metrics.get(name)
+        if isinstance(metric, Counter):
+            totals[name] = totals.get(name, 0) + state
+        elif isinstance(metric, Histogram):
+            histograms = totals.setdefault(name, {})
+            for key, values in state.items():
+                total = histograms.get(key, [0] * len(values))
+                histograms[key] = [a + b for a, b in zip(total, values)]
+
+
+class WorkerMetrics:
+    """Shares this worker's metrics with the other workers of the server through files in `directory`."""
+
+    def __init__(self, directory: str = METRICS_DIR, interval: float = METRICS_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = self._token = None
+
+    def _name(self) -> str:
+        # A fresh token per process, so a worker that reuses a dead worker's pid never overwrites its file
+        if self._pid != os.getpid():
+            self._pid, self._token = os.getpid(), uuid4().hex[:12]
+        return f"{self._pid}-{self._token}.json"
+
+    def _load(self, name: str):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Error reading metrics file %s: %s", name, e)
+            return None
+
+    def _dump(self, name: str, states: dict):
+        path = os.path.join(self.directory, name)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(states, f, separators=(",", ":"))
+        os.replace(f"{path}.tmp", path)
+
+    @contextmanager
+    def _locked(self):
+        """Serialize folding and reading across workers, so no total is counted twice or missed."""
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def write(self):
+        """Replace this worker's file with the current state of its metrics."""
+        states = {}
+        for metric in REGISTRY:
+            if isinstance(metric, Gauge) and not metric.per_worker:
+                continue
+            try:
+                states[metric.name] = metric.sample()
+            except Exception as e:
+                logger.warning("Error sampling metric %s: %s", metric.name, e)
+        self._dump(self._name(), states)
+
+    def collect(self) -> tuple:
+        """
+        Retired totals and (pid, metric states) of every other running
+        worker, after folding the files of exited workers into the retired
+        totals and removing them.
+        """
+        own = self._name()
+        with self._locked():
+            retired = self._load(RETIRED) or {"workers": [], "metrics": {}}
+            workers, exited = [], []
+            for name in sorted(os.listdir(self.directory)):
+                stem, extension = os.path.splitext(name)
+                pid, _, token = stem.partition("-")
+                if extension != ".json" or not pid.isdigit() or not token or name == own:
+                    continue
+                if name in retired["workers"]:
+                    os.remove(os.path.join(self.directory, name))  # Folded before a crash got to remove it
+                    continue
+                states = self._load(name)
+                if states is None:
+                    continue
+                # A file with this worker's pid but another token was left by a dead predecessor
+                if int(pid) != os.getpid() and _alive(int(pid)):
+                    workers.append((int(pid), states))
+                else:
+                    exited.append((name, states))
+            if exited:
+                for name, states in exited:
+                    _fold(retired["metrics"], states)
+                    retired["workers"].append(name)
+                self._dump(RETIRED, retired)
+                for name, _ in exited:
+                    os.remove(os.path.join(self.directory, name))
+        return retired["metrics"], workers
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Error writing metrics")
+
+    def start(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write the final totals, so the worker's counters outlive it."""
+        if not self._thread:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+
+worker_metrics = WorkerMetrics()
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format, over all workers with METRICS_DIR."""
+    own = os.getpid() if worker_metrics.directory else None
+    retired, others = worker_metrics.collect() if worker_metrics.directory else ({}, [])
+    lines = []
+    for metric in REGISTRY:
+        try:
+            if isinstance(metric, Gauge) and not metric.per_worker:
+                samples = [(None, metric.sample())]
+            else:
+                samples = [(own, metric.sample())]
+                samples.extend((pid, states[metric.name]) for pid, states in others if metric.name in states)
+                if metric.name in retired:
+                    samples.append((None, retired[metric.name]))
+            lines.extend(metric.render(samples))
+        except Exception as e:
+            # One failing scrape-time gauge (say Redis is down) must not hide the rest
+            logger.warning("Error rendering metric %s: %s", metric.name, e)
+    return "\n".join(lines) + "\n"
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return render_metrics()
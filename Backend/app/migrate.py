@@ -0,0 +1,55 @@
+"""
+Bring a database created by an older version up to date.
+
+create_all (run at startup) creates missing tables but never alters
+existing ones, so a `games` table from before the game history columns
+lacks ended_at, total_time and increment and the (player, ended_at,
+game_id) indexes. Run before starting the new version:
+
+    python -m app.migrate
+
+The migration is idempotent. Games without an end time get the time of
+their last logged move or, failing that, the time of the migration; their
+time controls stay unknown (NULL).
+"""
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select, text, update
+
+from app.model import Base, GameDB, MoveLogDB
+
+GAME_COLUMNS = ("ended_at", "total_time", "increment")  # Added to games after its first release
+
+
+def upgrade_games(engine):
+    """Add the missing game history columns, backfill ended_at, then build the history indexes."""
+    Base.metadata.create_all(bind=engine)  # New tables, including move_log used by the backfill
+    existing = {column["name"] for column in inspect(engine).get_columns("games")}
+    with engine.begin() as connection:
+        for name in GAME_COLUMNS:
+            if name not in existing:
+                # Nullable at first; ended_at is filled in below
+                column_type = GameDB.__table__.c[name].type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE games ADD COLUMN {name} {column_type}"))
+
+        last_move = select(func.max(MoveLogDB.created_at)).where(MoveLogDB.game_id == GameDB.game_id).scalar_subquery()
+        backfilled = connection.execute(
+            update(GameDB).where(GameDB.ended_at.is_(None)).values(ended_at=func.coalesce(last_move, datetime.utcnow()))
+        ).rowcount
+        if connection.dialect.name == "postgresql":
+            # SQLite cannot add the constraint to an existing column; new rows always get ended_at anyway
+            connection.execute(text("ALTER TABLE games ALTER COLUMN ended_at SET NOT NULL"))
+
+        for index in GameDB.__table__.indexes:
+            index.create(connection, checkfirst=True)
+    print(f"games is up to date; backfilled ended_at for {backfilled} games")
+
+
+def main():
+    from db.db import engine
+
+    upgrade_games(engine)
+
+
+if __name__ == "__main__":
+    main()
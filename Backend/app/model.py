@@ -1,8 +1,9 @@
 from enum import Enum
-from typing import Optional
-from pydantic import BaseModel, EmailStr
+from typing import List, Optional
+from pydantic import BaseModel, EmailStr, Field
 
-from sqlalchemy import JSON, Column, Integer, String
+from datetime import datetime
+from sqlalchemy import JSON, BigInteger, Column, DateTime, Float, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -38,6 +39,11 @@ class Event(BaseModel):
     event: str
     data: dict
 
+class AnalysisRequest(BaseModel):
+    positions: List[str]  # FENs
+    depth: Optional[int] = Field(None, ge=1)
+    time: Optional[float] = Field(None, gt=0)  # Seconds per position
+
 # SQLAlchemy model for database
 class UserDB(Base):
     __tablename__ = "users"
@@ -49,10 +55,74 @@ class UserDB(Base):
 
 class GameDB(Base):
     __tablename__ = "games"
+    __table_args__ = (
+        # History lookups walk one of these per player, newest first (keyset pagination)
+        Index("ix_games_player1_ended_at", "player1", "ended_at", "game_id"),
+        Index("ix_games_player2_ended_at", "player2", "ended_at", "game_id"),
+    )
 
     game_id = Column(String, nullable=False, primary_key=True)
     player1 = Column(String, nullable=False)
     player2 = Column(String, nullable=False)
     status = Column(String, nullable=False)
     winner = Column(String, nullable=True)  # Can be NULL if the game is not finished
-    moves = Column(JSON, nullable=False, default=[])  # Storing moves as a JSON array
\ No newline at end of file
+    moves = Column(JSON, nullable=False, default=[])  # Storing moves as a JSON array
+    ended_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    total_time = Column(Integer, nullable=True)  # Time control in seconds
+    increment = Column(Integer, nullable=True)
+
+class MoveLogDB(Base):
+    """Append-only log of every move, written as it is played"""
+    __tablename__ = "move_log"
+
+    game_id = Column(String, primary_key=True)
+    ply = Column(Integer, primary_key=True)  # 1-based half-move number
+    move = Column(String, nullable=False)  # SAN, as sent by the client
+    clock_remaining = Column(Float, nullable=True)  # Mover's clock after the move, in seconds
+    created_at = Column(DateTime, nullable=False)
+
+class PlayerStatsDB(Base):
+    """Results and Glicko-2 rating per player, kept up to date as games are saved"""
+    __tablename__ = "player_stats"
+
+    username = Column(String, primary_key=True)
+    time_control = Column(String, primary_key=True)  # "600+10", or "all" across every time control
+    games = Column(Integer, nullable=False, default=0)
+    wins = Column(Integer, nullable=False, default=0)
+    losses = Column(Integer, nullable=False, default=0)
+    draws = Column(Integer, nullable=False, default=0)
+    rating = Column(Float, nullable=False)
+    deviation = Column(Float, nullable=False)
+    volatility = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=True)  # When the last counted game ended
+
+class PositionDB(Base):
+    """Zobrist key of every distinct position reached in a saved game"""
+    __tablename__ = "positions"
+
+    zobrist = Column(BigInteger, primary_key=True)  # Polyglot key, stored signed
+    game_id = Column(String, primary_key=True)
+    ply = Column(Integer, nullable=False)  # Half-moves played when the position was first reached
+
+class OpeningMoveDB(Base):
+    """Results of every move played from a position in the opening, for the explorer"""
+    __tablename__ = "opening_moves"
+
+    zobrist = Column(BigInteger, primary_key=True)  # Position the move is played from
+    move = Column(String, primary_key=True)  # UCI
+    white_wins = Column(Integer, nullable=False, default=0)
+    draws = Column(Integer, nullable=False, default=0)
+    black_wins = Column(Integer, nullable=False, default=0)
+
+class PuzzleDB(Base):
+    """Tactic mined from a saved game: a winning line the player to move missed"""
+    __tablename__ = "puzzles"
+
+    zobrist = Column(BigInteger, primary_key=True)  # Puzzle position; one puzzle per position
+    fen = Column(String, nullable=False)
+    solution = Column(JSON, nullable=False)  # UCI moves, starting with the solver's
+    game_id = Column(String, nullable=False)
+    ply = Column(Integer, nullable=False)  # Half-moves played before the puzzle position
+    rating = Column(Float, nullable=False)  # Glicko-2, like players
+    deviation = Column(Float, nullable=False)
+    volatility = Column(Float, nullable=False)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Many games over one websocket.
+
+A Connection wraps a client's websocket so it can carry any number of
+games. Incoming events that name a game are handled by a task per game: a
+slow handler in one game does not hold up the others, and events of the
+same game still run in order. Other events are handled as they arrive.
+
+Outgoing messages are queued per game (the game being handled when they
+are sent, see app.log.game_id_var) and written round-robin, so a busy game
+can't delay the others. A game whose queue grows past OUTBOX_LIMIT,
+because the client stopped reading it, has its backlog dropped and gets a
+single RESYNC; the client then sends RECONNECT for that game and is sent
+the full GAME_STATE again. A game with INBOX_LIMIT events already waiting
+refuses new ones with an ERROR.
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+
+from app.log import game_id_var
+from app.metrics import Counter
+
+OUTBOX_LIMIT = int(os.getenv("WS_OUTBOX_LIMIT", "100"))  # Messages queued per game before it must resync
+INBOX_LIMIT = int(os.getenv("WS_INBOX_LIMIT", "16"))  # Events waiting per game before new ones are refused
+
+OUTBOX_OVERFLOWS = Counter("websocket_outbox_overflows_total", "Games told to resync because their client stopped reading")
+INBOX_OVERFLOWS = Counter("websocket_inbox_overflows_total", "Events refused because too many were pending for their game")
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    def __init__(self, websocket, handler):
+        """`handler(websocket, event)` runs an event; from now on websocket.send_json queues."""
+        self.websocket = websocket
+        self.handler = handler
+        self.send = websocket.send_json
+        self.loop = asyncio.get_running_loop()
+        self.outboxes = {}  # game_id (None outside games) -> messages waiting to be written
+        self.ready = deque()  # Games with messages waiting, in the order they are served
+        self.resyncing = set()  # Games whose backlog was dropped, until the client sends RECONNECT
+        self.inboxes = {}  # game_id -> events waiting for the game's task
+        self.tasks = {}  # game_id -> task running the game's events
+        self.wakeup = asyncio.Event()
+        self.writer = self.loop.create_task(self._write())
+        websocket.send_json = self.send_json
+
+    async def send_json(self, message: dict):
+        game_id = game_id_var.get()
+        if game_id is None and isinstance(message.get("data"), dict):
+            game_id = message["data"].get("game_id")
+        if asyncio.get_running_loop() is self.loop:
+            self._enqueue(game_id, message)
+        else:
+            # Clock threads send from their own event loop
+            self.loop.call_soon_threadsafe(self._enqueue, game_id, message)
+
+    def _enqueue(self, game_id, message: dict):
+        if game_id in self.resyncing:
+            return
+        outbox = self.outboxes.setdefault(game_id, deque())
+        if not outbox:
+            self.ready.append(game_id)
+        elif game_id is not None and len(outbox) >= OUTBOX_LIMIT:
+            logger.warning("Client is not keeping up, dropping %d messages", len(outbox), extra={"game_id": game_id})
+            OUTBOX_OVERFLOWS.inc()
+            outbox.clear()
+            self.resyncing.add(game_id)
+            message = {"event": "RESYNC", "data": {"game_id": game_id, "message": "Send RECONNECT for the current state."}}
+        outbox.append(message)
+        self.wakeup.set()
+
+    async def _write(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.ready:
+                game_id = self.ready.popleft()
+                outbox = self.outboxes[game_id]
+                message = outbox.popleft()
+                if outbox:
+                    self.ready.append(game_id)
+                else:
+                    del self.outboxes[game_id]
+                try:
+                    await self.send(message)
+                except Exception as e:
+                    logger.debug("Stopped writing to closed connection: %s", e)
+                    return
+
+    async def route(self, event):
+        """Run an event in its game's task, or right away if it names no game."""
+        game_id = event.data.get("game_id")
+        if not game_id:
+            await self.handler(self.websocket, event)
+            return
+        if event.event == "RECONNECT":
+            self.resyncing.discard(game_id)
+        inbox = self.inboxes.get(game_id)
+        if inbox is None:
+            inbox = self.inboxes[game_id] = asyncio.Queue(INBOX_LIMIT)
+            self.tasks[game_id] = asyncio.create_task(self._run_game(game_id, inbox))
+        try:
+            inbox.put_nowait(event)
+        except asyncio.QueueFull:
+            INBOX_OVERFLOWS.inc()
+            self._enqueue(game_id, {
+                "event": "ERROR",
+                "data": {"game_id": game_id, "message": f"Too many events pending for this game, {event.event} ignored"}
+            })
+
+    async def _run_game(self, game_id: str, inbox: asyncio.Queue):
+        while True:
+            event = await inbox.get()
+            try:
+                await self.handler(self.websocket, event)
+            except Exception:
+                logger.exception("Error handling %s", event.event, extra={"game_id": game_id})
+            if inbox.empty():
+                del self.inboxes[game_id]
+                del self.tasks[game_id]
+                return
+
+    async def close(self):
+        """Finish the events already received, then stop writing."""
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.writer.cancel()
@@ -0,0 +1,143 @@
+"""
+Opening explorer aggregates.
+
+OpeningMoveDB holds, for every (position, next move) pair seen in the first
+OPENING_PLIES half-moves of a finished game, how often white won, drew or
+lost. The explorer reads one primary-key range per position. GameWriter
+adds every saved game in the same transaction that saves it; the whole
+table can be rebuilt from GameDB on a process pool:
+
+    python -m app.openings --workers 8
+
+A rebuild starts from an empty table, so run it while no games are being
+saved, otherwise games finishing meanwhile may be counted twice.
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app.model import Base, GameDB, OpeningMoveDB
+from app.positions import position_keys
+from app.ratings import game_score
+
+OPENING_PLIES = int(os.getenv("OPENING_PLIES", "40"))  # Deeper positions are too sparse to be worth aggregating
+REBUILD_CHUNK = 5000  # Games aggregated per task when rebuilding
+RESULT_COLUMNS = ("white_wins", "draws", "black_wins")
+
+
+def opening_moves(moves: list) -> set:
+    """Distinct (position key, move in UCI) pairs played in the opening of a game."""
+    pairs = set()
+    previous = None
+    for _, key, move in position_keys((moves or [])[:OPENING_PLIES]):
+        if move is not None:
+            pairs.add((previous, move.uci()))
+        previous = key
+    return pairs
+
+
+def aggregate(games) -> dict:
+    """(zobrist, move) -> [white wins, draws, black wins] over finished games (GameDB rows as dicts)."""
+    counts = defaultdict(lambda: [0, 0, 0])
+    for game in games:
+        score = game_score(game)
+        if score is None:
+            continue
+        column = 0 if score == 1 else 1 if score == 0.5 else 2
+        for pair in opening_moves(game["moves"]):
+            counts[pair][column] += 1
+    return counts
+
+
+def add_counts(db, counts: dict):
+    """Add aggregated counts onto OpeningMoveDB, creating missing rows; keys are written in order to avoid deadlocks."""
+    if not counts:
+        return
+    rows = [
+        {"zobrist": zobrist, "move": move, **dict(zip(RESULT_COLUMNS, results))}
+        for (zobrist, move), results in sorted(counts.items())
+    ]
+    dialect = sqlite if db.get_bind().dialect.name == "sqlite" else postgresql
+    statement = dialect.insert(OpeningMoveDB)
+    statement = statement.on_conflict_do_update(
+        index_elements=[OpeningMoveDB.zobrist, OpeningMoveDB.move],
+        set_={column: getattr(OpeningMoveDB, column) + getattr(statement.excluded, column) for column in RESULT_COLUMNS}
+    )
+    db.execute(statement, rows)
+
+
+def record_openings(db, games: list):
+    """Add newly saved games to the explorer inside the caller's transaction."""
+    add_counts(db, aggregate(games))
+
+
+def _aggregate_chunk(games: list) -> dict:
+    return dict(aggregate(games))
+
+
+def rebuild(engine, workers: int = None, chunk: int = REBUILD_CHUNK):
+    """
+    Recount OpeningMoveDB from every game in GameDB.
+
+    Chunks of games are aggregated on a process pool and each partial result
+    is added to the table as it arrives, so memory stays bounded by the
+    chunk size rather than the number of distinct positions.
+    """
+    started = time.perf_counter()
+    columns = (GameDB.player1, GameDB.player2, GameDB.winner, GameDB.status, GameDB.moves)
+
+    def chunks():
+        last = None
+        while True:
+            with engine.connect() as connection:
+                query = select(GameDB.game_id, *columns).order_by(GameDB.game_id).limit(chunk)
+                if last is not None:
+                    query = query.where(GameDB.game_id > last)
+                games = [dict(game) for game in connection.execute(query).mappings()]
+            if not games:
+                return
+            last = games[-1]["game_id"]
+            yield games
+
+    with engine.begin() as connection:
+        connection.execute(delete(OpeningMoveDB))
+
+    games = 0
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        # Keep a bounded number of chunks in flight
+        pending = []
+        for batch in chunks():
+            pending.append((len(batch), executor.submit(_aggregate_chunk, batch)))
+            if len(pending) > workers:
+                games += _add_chunk(engine, *pending.pop(0))
+        for count, future in pending:
+            games += _add_chunk(engine, count, future)
+        print(f"Aggregated {games} games in {time.perf_counter() - started:.1f}s")
+
+
+def _add_chunk(engine, count: int, future) -> int:
+    with Session(engine) as db, db.begin():
+        add_counts(db, future.result())
+    return count
+
+
+def main():
+    from db.db import engine
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=None, help="Aggregating processes (default: all cores)")
+    parser.add_argument("--chunk", type=int, default=REBUILD_CHUNK)
+    args = parser.parse_args()
+    Base.metadata.create_all(bind=engine)
+    rebuild(engine, args.workers, args.chunk)
+
+
+if __name__ == "__main__":
+    main()
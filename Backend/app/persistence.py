@@ -0,0 +1,191 @@
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from app.metrics import Counter, Gauge, Histogram
+from app.model import GameDB, MoveLogDB
+from app.openings import record_openings
+from app.positions import index_games
+from app.ratings import record_games
+from db.db import SessionLocal
+
+BATCH_SIZE = 500  # Rows per transaction
+FLUSH_INTERVAL = 0.25  # Seconds to keep collecting moves before writing a batch
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5  # Seconds, doubled after every failed attempt
+
+MOVE = "move"
+GAME = "game"
+REWIND = "rewind"
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+COMMIT_SECONDS = Histogram("game_writer_commit_seconds", "Time to commit one batch of moves and finished games")
+BATCH_ROWS = Histogram(
+    "game_writer_batch_rows", "Rows written per transaction",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500)
+)
+RETRIES = Counter("game_writer_retries_total", "Batch commits retried after a database error")
+DROPPED = Counter("game_writer_dropped_total", "Rows dropped after exhausting retries")
+
+
+class GameWriter:
+    """
+    Write-behind queue for the move log and finished games.
+
+    Handlers (and the clock thread) only enqueue; a background thread collects
+    rows for up to FLUSH_INTERVAL and writes them in one multi-row
+    transaction, retrying with exponential backoff when the database is
+    unavailable. Rows are written in the order they were queued, so a game's
+    moves are always in the log before its finished-game row is derived.
+
+    A game resumed from a snapshot rewinds its log to the snapshot first:
+    moves logged after the snapshot was taken were lost with the worker, and
+    the resumed game replays those plies with moves of its own.
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="game-writer", daemon=True)
+                self.thread.start()
+
+    def submit_move(self, row: dict):
+        """Queue a MoveLogDB row; never blocks the caller on the database."""
+        self.start()
+        self.queue.put((MOVE, row))
+
+    def submit_game(self, row: dict):
+        """Queue a finished game; plies missing from its in-memory moves are taken from the move log."""
+        self.start()
+        self.queue.put((GAME, row))
+
+    def rewind(self, game_id: str, ply: int):
+        """Queue the removal of a game's logged moves after `ply`."""
+        self.start()
+        self.queue.put((REWIND, {"game_id": game_id, "ply": ply}))
+
+    def close(self, timeout: float = 30):
+        """Flush everything queued so far and stop the writer thread."""
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            # Keep collecting until the batch is full or the flush interval is up
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _STOP:
+                stopping = True
+                batch.pop()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list):
+        delay = RETRY_BACKOFF
+        for attempt in range(MAX_RETRIES):
+            try:
+                with COMMIT_SECONDS.time():
+                    self._insert(batch)
+                BATCH_ROWS.observe(len(batch))
+                return
+            except Exception as e:
+                logger.warning("Error saving %d rows (attempt %d): %s", len(batch), attempt + 1, e)
+                RETRIES.inc()
+                time.sleep(delay)
+                delay *= 2
+        logger.error("Dropping %d rows after %d attempts", len(batch), MAX_RETRIES)
+        DROPPED.inc(len(batch))
+
+    def _insert(self, batch: list):
+        db = self.session_factory()
+        try:
+            try:
+                self._insert_rows(db, batch)
+                db.commit()
+            except IntegrityError:
+                # A duplicate key poisons the whole batch; fall back to one row at a time
+                db.rollback()
+                for item in batch:
+                    try:
+                        self._insert_rows(db, [item])
+                        db.commit()
+                    except IntegrityError:
+                        db.rollback()
+                        if not self._already_saved(db, item):
+                            raise  # Not a duplicate; retry the batch rather than lose the row
+                        logger.warning("Skipping duplicate %s row", item[0], extra={"game_id": item[1]["game_id"]})
+        finally:
+            db.close()
+
+    def _already_saved(self, db, item: tuple) -> bool:
+        """Whether a row that failed to insert clashed with the same game or move written before."""
+        kind, row = item
+        if kind == MOVE:
+            return db.get(MoveLogDB, (row["game_id"], row["ply"])) is not None
+        if kind == GAME:
+            return db.get(GameDB, row["game_id"]) is not None
+        return False
+
+    def _insert_rows(self, db, batch: list):
+        moves = [row for kind, row in batch if kind == MOVE]
+        games = [row for kind, row in batch if kind == GAME]
+        for kind, row in batch:
+            if kind == REWIND:
+                # Before the batch's moves, which can only come from the resumed game
+                db.execute(delete(MoveLogDB).where(MoveLogDB.game_id == row["game_id"], MoveLogDB.ply > row["ply"]))
+        if moves:
+            db.execute(insert(MoveLogDB), moves)
+        if games:
+            db.flush()
+            games = [self._derive_game(db, row) for row in games]
+            db.execute(insert(GameDB), games)
+            # Same transaction, so a game is counted and indexed exactly when it is saved
+            record_games(db, games)
+            index_games(db, games)
+            record_openings(db, games)
+
+    def _derive_game(self, db, row: dict) -> dict:
+        """
+        Build the finished-game row from its in-memory moves.
+
+        The move log only adds plies past the end of them, and only if it
+        agrees with them up to there; otherwise it is from another timeline.
+        """
+        logged = db.execute(
+            select(MoveLogDB.move).where(MoveLogDB.game_id == row["game_id"]).order_by(MoveLogDB.ply)
+        ).scalars().all()
+        moves = list(row.get("moves") or [])
+        if logged[:len(moves)] != moves[:len(logged)]:
+            logger.warning("Move log disagrees with the game, using in-memory moves", extra={"game_id": row["game_id"]})
+        elif len(logged) > len(moves):
+            moves = list(logged)
+        return dict(row, moves=moves)
+
+
+game_writer = GameWriter()
+
+QUEUE_DEPTH = Gauge("game_writer_queue_depth", "Rows waiting to be written", lambda: game_writer.queue.qsize())
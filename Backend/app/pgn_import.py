@@ -0,0 +1,292 @@
+"""
+Bulk import of PGN archives into GameDB.
+
+    python -m app.pgn_import lichess_2024-01.pgn more.pgn.gz --workers 8
+
+Files are streamed game by game, parsed and validated on a process pool,
+and inserted in large transactions: COPY into a staging table on Postgres,
+multi-row INSERTs elsewhere. The byte offset reached in each file is
+checkpointed after every committed batch, so an interrupted import resumes
+where it stopped; re-imported games are skipped because their ids are
+derived from the PGN text.
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import chess
+import chess.pgn
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.model import Base, GameDB
+from db.db import engine
+
+BATCH_SIZE = 5000  # Games per transaction
+CHECKPOINT_PATH = "pgn_import_checkpoint.json"
+COLUMNS = ("game_id", "player1", "player2", "status", "winner", "moves", "ended_at", "total_time", "increment")
+
+
+def open_pgn(path: str):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def iter_games(path: str, offset: int = 0):
+    """
+    Yield (pgn_text, resume_offset) for each game in a file, starting at offset.
+
+    resume_offset is where the next game starts, i.e. where reading should
+    pick up again once this game has been committed.
+    """
+    with open_pgn(path) as f:
+        f.seek(offset)
+        lines = []
+        in_movetext = False
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            # A header line after movetext starts the next game
+            if line.startswith(b"[") and in_movetext:
+                yield b"".join(lines).decode("utf-8", errors="replace"), position
+                lines = []
+                in_movetext = False
+            elif line.strip() and not line.startswith(b"["):
+                in_movetext = True
+            lines.append(line)
+        if in_movetext:
+            yield b"".join(lines).decode("utf-8", errors="replace"), f.tell()
+
+
+def parse_ended_at(headers) -> datetime:
+    date = headers.get("UTCDate") or headers.get("Date") or ""
+    clock = headers.get("UTCTime") or "00:00:00"
+    try:
+        return datetime.strptime(f"{date} {clock}", "%Y.%m.%d %H:%M:%S")
+    except ValueError:
+        return datetime.utcnow()
+
+
+def parse_time_control(value: str):
+    try:
+        total_time, increment = value.split("+")
+        return int(total_time), int(increment)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    """
+    Collects headers and mainline SAN without building a game tree.
+
+    The reader only hands over moves that parse_san accepted, so every
+    collected move is legal; variations are skipped entirely.
+    """
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.moves = []
+        self.board = None
+        self.san = None
+        self.failed = False
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def parse_san(self, board, san):
+        self.san = san
+        return super().parse_san(board, san)
+
+    def visit_move(self, board, move):
+        self.board = board  # The reader keeps pushing onto this board, so it ends on the final position
+        self.moves.append(self.san)
+
+    def handle_error(self, error):
+        self.failed = True
+
+    def result(self):
+        return self
+
+
+def parse_game(text: str):
+    """Parse and validate one PGN game into a GameDB row; None if it is unusable."""
+    game = chess.pgn.read_game(io.StringIO(text), Visitor=MainlineVisitor)
+    if game is None or game.failed or game.headers.get("FEN"):
+        return None  # Unreadable, illegal or not from the standard start position
+    result = game.headers.get("Result", "*")
+    if result not in ("1-0", "0-1", "1/2-1/2"):
+        return None  # Unfinished or unknown result
+
+    board = game.board or chess.Board()
+    moves = game.moves
+    white = game.headers.get("White", "?")
+    black = game.headers.get("Black", "?")
+    if board.is_checkmate():
+        status = "checkmate"
+    elif board.is_stalemate():
+        status = "stalemate"
+    elif result == "1/2-1/2":
+        status = "draw"
+    elif "time" in game.headers.get("Termination", "").lower():
+        status = "timeout"
+    else:
+        status = "resignation"
+    total_time, increment = parse_time_control(game.headers.get("TimeControl"))
+
+    return {
+        "game_id": "import-" + hashlib.sha1(text.encode()).hexdigest()[:24],
+        "player1": white,
+        "player2": black,
+        "status": status,
+        "winner": white if result == "1-0" else black if result == "0-1" else None,
+        "moves": moves,
+        "ended_at": parse_ended_at(game.headers),
+        "total_time": total_time,
+        "increment": increment,
+    }
+
+
+def copy_rows(rows: list):
+    """Postgres: COPY into a staging table, then move over skipping known games."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            json.dumps(row[column]) if column == "moves"
+            else "" if row[column] is None
+            else row[column]
+            for column in COLUMNS
+        ])
+    buffer.seek(0)
+
+    columns = ", ".join(COLUMNS)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TEMP TABLE import_games (LIKE games INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(f"COPY import_games ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO games ({columns}) SELECT {columns} FROM import_games ON CONFLICT (game_id) DO NOTHING"
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def insert_rows(rows: list):
+    if not rows:
+        return
+    if engine.dialect.name == "postgresql":
+        copy_rows(rows)
+        return
+    statement = insert(GameDB)
+    if engine.dialect.name == "sqlite":
+        statement = sqlite_insert(GameDB).on_conflict_do_nothing(index_elements=["game_id"])
+    with engine.begin() as connection:
+        connection.execute(statement, rows)
+
+
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+
+    def report(self, label: str = "Progress"):
+        elapsed = time.perf_counter() - self.started
+        print(f"{label}: {self.read} read, {self.imported} imported, {self.rejected} rejected "
+              f"in {elapsed:.1f}s ({self.read / max(elapsed, 1e-9):.0f} games/sec)")
+
+
+def import_files(paths: list, workers: int = None, batch_size: int = BATCH_SIZE, checkpoint_path: str = CHECKPOINT_PATH):
+    Base.metadata.create_all(bind=engine)
+    checkpoint = load_checkpoint(checkpoint_path)
+    stats = ImportStats()
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(workers) as executor:
+        for path in paths:
+            key = os.path.abspath(path)
+            if checkpoint.get(key) == "done":
+                print(f"Skipping {path}, already imported")
+                continue
+            print(f"Importing {path} from offset {checkpoint.get(key, 0)}")
+
+            def commit(pending):
+                resume_offset, count, parsed = pending
+                rows = [row for row in parsed if row]
+                insert_rows(rows)
+                stats.read += count
+                stats.imported += len(rows)
+                stats.rejected += count - len(rows)
+                checkpoint[key] = resume_offset
+                save_checkpoint(checkpoint_path, checkpoint)
+                stats.report()
+
+            # Parse the next batch on the pool while the previous one is being inserted
+            pending = None
+            for batch in batched(iter_games(path, checkpoint.get(key, 0)), batch_size):
+                texts = [text for text, _ in batch]
+                parsed = executor.map(parse_game, texts, chunksize=max(1, len(texts) // (workers * 4)))
+                if pending:
+                    commit(pending)
+                pending = (batch[-1][1], len(texts), parsed)
+            if pending:
+                commit(pending)
+
+            checkpoint[key] = "done"
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    stats.report("Finished")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="PGN files, optionally gzipped")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+    import_files(args.paths, args.workers, args.batch_size, args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
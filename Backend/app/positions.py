@@ -0,0 +1,172 @@
+"""
+Position index: which games reached a given position.
+
+Every distinct position of a saved game is recorded in PositionDB under its
+64-bit Zobrist (Polyglot) key, so looking up a position is one index range
+scan however many games are stored. GameWriter indexes games as they are
+saved; games stored before the index existed, or bulk imported, are indexed
+with:
+
+    python -m app.positions --workers 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.polyglot
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.model import Base, GameDB, PositionDB
+
+BACKFILL_CHUNK = 2000  # Games read, hashed and inserted per transaction
+
+RANDOM_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+HASHER = chess.polyglot.ZobristHasher(RANDOM_ARRAY)
+
+
+def signed64(key: int) -> int:
+    """Map an unsigned 64-bit key onto a signed BIGINT."""
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def position_key(board: chess.Board) -> int:
+    return signed64(HASHER(board))
+
+
+def _piece_hash(board: chess.Board, squares) -> int:
+    zobrist_hash = 0
+    for square in squares:
+        piece = board.piece_at(square)
+        if piece:
+            zobrist_hash ^= RANDOM_ARRAY[64 * ((piece.piece_type - 1) * 2 + piece.color) + square]
+    return zobrist_hash
+
+
+def position_keys(moves: list):
+    """
+    Yield (ply, key, move) for the start position and the position after
+    every move, `move` being the move that led there (None at the start).
+
+    The piece part of the key is updated from the squares each move touches
+    instead of being rehashed from scratch. Stops at the first illegal move,
+    keeping the legal prefix of a corrupt record.
+    """
+    board = chess.Board()
+    pieces = HASHER.hash_board(board)
+    yield 0, position_key(board), None
+    for ply, san in enumerate(moves, start=1):
+        try:
+            move = board.parse_san(san)
+        except ValueError:
+            return
+        if board.is_castling(move):
+            # King and rook both move along the back rank
+            squares = chess.SquareSet(chess.BB_RANKS[chess.square_rank(move.from_square)])
+        elif board.is_en_passant(move):
+            squares = [move.from_square, move.to_square, chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))]
+        else:
+            squares = [move.from_square, move.to_square]
+        pieces ^= _piece_hash(board, squares)
+        board.push(move)
+        pieces ^= _piece_hash(board, squares)
+        key = pieces ^ HASHER.hash_castling(board) ^ HASHER.hash_ep_square(board) ^ HASHER.hash_turn(board)
+        yield ply, signed64(key), move
+
+
+def position_rows(game_id: str, moves: list) -> list:
+    """PositionDB rows for one game; a repeated position keeps the ply it was first reached at."""
+    seen = {}
+    for ply, key, _ in position_keys(moves or []):
+        seen.setdefault(key, ply)
+    return [{"zobrist": key, "game_id": game_id, "ply": ply} for key, ply in seen.items()]
+
+
+def index_games(db, games: list):
+    """Index newly saved games (GameDB rows as dicts) inside the caller's transaction."""
+    rows = [row for game in games for row in position_rows(game["game_id"], game["moves"])]
+    if rows:
+        db.execute(insert(PositionDB), rows)
+
+
+def _hash_chunk(games: list) -> list:
+    return [row for game_id, moves in games for row in position_rows(game_id, moves)]
+
+
+def insert_ignoring_duplicates(connection, rows: list, model=PositionDB):
+    """Backfills may overlap games the writer already indexed."""
+    if connection.dialect.name == "postgresql":
+        statement = postgresql.insert(model).on_conflict_do_nothing()
+    elif connection.dialect.name == "sqlite":
+        statement = sqlite.insert(model).on_conflict_do_nothing()
+    else:
+        statement = insert(model)
+    connection.execute(statement, rows)
+
+
+def backfill(engine, workers: int = None, after: str = None, chunk: int = BACKFILL_CHUNK):
+    """
+    Index every game in GameDB, walking game ids in order from `after`.
+
+    Hashing runs on a process pool, one chunk ahead of the inserts; the last
+    game id of each committed chunk is printed so an interrupted run can be
+    resumed with --after.
+    """
+    started = time.perf_counter()
+    indexed = positions = 0
+
+    def chunks():
+        last = after
+        while True:
+            with engine.connect() as connection:
+                query = select(GameDB.game_id, GameDB.moves).order_by(GameDB.game_id).limit(chunk)
+                if last is not None:
+                    query = query.where(GameDB.game_id > last)
+                games = [tuple(game) for game in connection.execute(query)]
+            if not games:
+                return
+            last = games[-1][0]
+            yield games
+
+    with ProcessPoolExecutor(workers or os.cpu_count()) as executor:
+        pending = None
+        for games in chunks():
+            future = executor.submit(_hash_chunk, games)
+            if pending:
+                indexed, positions = _commit(engine, pending, indexed, positions, started)
+            pending = (games[-1][0], len(games), future)
+        if pending:
+            indexed, positions = _commit(engine, pending, indexed, positions, started)
+    print(f"Finished: {indexed} games, {positions} positions in {time.perf_counter() - started:.1f}s")
+
+
+def _commit(engine, pending, indexed: int, positions: int, started: float):
+    last_game_id, count, future = pending
+    rows = future.result()
+    with engine.begin() as connection:
+        if rows:
+            insert_ignoring_duplicates(connection, rows)
+    indexed += count
+    positions += len(rows)
+    elapsed = time.perf_counter() - started
+    print(f"Indexed {indexed} games, {positions} positions ({indexed / max(elapsed, 1e-9):.0f} games/sec), "
+          f"last game {last_game_id}")
+    return indexed, positions
+
+
+def main():
+    from db.db import engine
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes (default: all cores)")
+    parser.add_argument("--after", default=None, help="Resume after this game id")
+    parser.add_argument("--chunk", type=int, default=BACKFILL_CHUNK)
+    args = parser.parse_args()
+    Base.metadata.create_all(bind=engine)
+    backfill(engine, args.workers, args.after, args.chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Tactical puzzles mined from saved games.
+
+Games are replayed on a process pool, each worker with its own engine. A
+shallow scan evaluates every position; where the player to move could have
+reached a winning score (WINNING_CP) but played a move that gave away at
+least SWING_CP, the position is searched again deeper with two principal
+variations. It becomes a puzzle only if the best move still wins and beats
+the second best by UNIQUE_CP, so that there is a single answer.
+
+Puzzles are keyed by the position's Zobrist key, so a position reached in
+many games is stored once. A puzzle starts at the overall rating of the
+player who missed it, with a new player's deviation, so that solves can
+settle it quickly.
+
+    python -m app.puzzles --workers 4 --max-rate 500
+
+Game ids are walked in order and the last one of every committed chunk is
+printed; resume an interrupted run with --after. Workers run niced and
+--max-rate caps the positions scanned per second, so mining can share a
+machine with live games.
+"""
+import argparse
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import chess
+import chess.engine
+from sqlalchemy import select
+
+from app.engine_pool import launch_stockfish, stockfish_path
+from app.model import Base, GameDB, PlayerStatsDB, PuzzleDB
+from app.positions import insert_ignoring_duplicates, position_key
+from app.ratings import DEFAULT_DEVIATION, DEFAULT_RATING, DEFAULT_VOLATILITY, OVERALL
+
+MINE_CHUNK = 100  # Games mined and committed together
+SCAN_DEPTH = 8
+VERIFY_DEPTH = 18
+MIN_PLY = 10  # Positions out of the opening only
+WINNING_CP = 200  # The best move must be worth at least this much
+SWING_CP = 300  # ...and at least this much more than the move played
+UNIQUE_CP = 200  # ...and this much more than the second best move
+SOLUTION_PLIES = 5  # Longest line stored, ending on the solver's move
+MATE_CP = 10_000
+NICE = 10
+
+engine = None  # This worker's engine
+
+
+def _start_worker(factory, nice: int):
+    global engine
+    if nice:
+        os.nice(nice)
+    engine = factory()
+    multiprocessing.util.Finalize(None, engine.quit, exitpriority=10)
+
+
+def centipawns(score: chess.engine.PovScore) -> int:
+    return score.relative.score(mate_score=MATE_CP)
+
+
+def scan(board: chess.Board, depth: int) -> tuple:
+    """(score for the side to move, best move) from a shallow search."""
+    if board.is_checkmate():
+        return -MATE_CP, None
+    if board.is_game_over():
+        return 0, None
+    info = engine.analyse(board, chess.engine.Limit(depth=depth))
+    pv = info.get("pv")
+    return centipawns(info["score"]), pv[0] if pv else None
+
+
+def verify(board: chess.Board, played: chess.Move, depth: int, winning: int, unique: int) -> list:
+    """The solution in UCI if the deep search finds one clearly best winning move, else None."""
+    infos = engine.analyse(board, chess.engine.Limit(depth=depth), multipv=2)
+    pv = infos[0].get("pv", [])
+    if not pv or pv[0] == played:
+        return None
+    best = centipawns(infos[0]["score"])
+    second = centipawns(infos[1]["score"]) if len(infos) > 1 else -MATE_CP
+    if best < winning or best - second < unique:
+        return None
+    plies = min(len(pv), SOLUTION_PLIES)
+    plies -= 1 - plies % 2
+    return [move.uci() for move in pv[:plies]]
+
+
+def mine_game(game: tuple, scan_depth: int = SCAN_DEPTH, verify_depth: int = VERIFY_DEPTH, min_ply: int = MIN_PLY,
+              winning: int = WINNING_CP, swing: int = SWING_CP, unique: int = UNIQUE_CP) -> tuple:
+    """(puzzle rows, positions scanned) for one (game_id, moves) game; runs on a worker."""
+    game_id, moves = game
+    board = chess.Board()
+    played = []
+    for san in moves or []:
+        try:
+            move = board.parse_san(san)
+        except ValueError:
+            break  # Keep the legal prefix of a corrupt record
+        played.append(move)
+        board.push(move)
+
+    board = chess.Board()
+    for move in played[:min_ply]:
+        board.push(move)
+    candidates = []
+    previous = None  # (position before the last move, its score, best move)
+    scanned = 0
+    for ply in range(min_ply, len(played) + 1):
+        score, best = scan(board, scan_depth)
+        scanned += 1
+        if previous:
+            before, best_score, best_move = previous
+            # The opponent's score after the move, seen from the mover's side
+            if best_move != played[ply - 1] and best_score >= winning and best_score + score >= swing:
+                candidates.append((ply - 1, before, played[ply - 1]))
+        if ply < len(played):
+            previous = (board.copy(stack=False), score, best)
+            board.push(played[ply])
+
+    puzzles = []
+    seen = set()
+    for ply, position, move in candidates:
+        key = position_key(position)
+        if key in seen:
+            continue
+        seen.add(key)
+        solution = verify(position, move, verify_depth, winning, unique)
+        if solution:
+            puzzles.append({
+                "zobrist": key, "fen": position.fen(), "solution": solution, "game_id": game_id, "ply": ply,
+                "white": position.turn == chess.WHITE,
+            })
+    return puzzles, scanned
+
+
+def player_ratings(connection, usernames: set) -> dict:
+    rows = connection.execute(
+        select(PlayerStatsDB.username, PlayerStatsDB.rating)
+        .where(PlayerStatsDB.username.in_(usernames), PlayerStatsDB.time_control == OVERALL)
+    )
+    return dict(rows.all())
+
+
+class MiningStats:
+    def __init__(self, workers: int):
+        self.started = time.perf_counter()
+        self.workers = workers
+        self.games = 0
+        self.scanned = 0
+        self.puzzles = 0
+
+    def rate(self) -> float:
+        return self.scanned / max(time.perf_counter() - self.started, 1e-9)
+
+    def report(self, label: str):
+        print(f"{label}: {self.games} games, {self.scanned} positions, {self.puzzles} puzzles "
+              f"({self.rate():.0f} positions/sec, {self.rate() / self.workers:.1f} per core)")
+
+
+def mine(db_engine, workers: int = None, after: str = None, chunk: int = MINE_CHUNK, max_rate: float = None,
+         nice: int = NICE, factory=None, **settings) -> MiningStats:
+    """
+    Mine every game in GameDB, walking game ids in order from `after`.
+
+    One chunk is mined on the pool while the previous one is committed.
+    Before a chunk is submitted, the run sleeps as long as it is ahead of
+    `max_rate` positions per second.
+    """
+    workers = workers or os.cpu_count()
+    factory = factory or partial(launch_stockfish, stockfish_path)
+    stats = MiningStats(workers)
+
+    def chunks():
+        last = after
+        while True:
+            with db_engine.connect() as connection:
+                query = select(GameDB.game_id, GameDB.moves, GameDB.player1, GameDB.player2)
+                query = query.order_by(GameDB.game_id).limit(chunk)
+                if last is not None:
+                    query = query.where(GameDB.game_id > last)
+                games = connection.execute(query).all()
+            if not games:
+                return
+            last = games[-1].game_id
+            yield games
+
+    def commit(pending):
+        games, results = pending
+        players = {game.game_id: (game.player1, game.player2) for game in games}
+        rows = {}
+        for puzzles, scanned in results:
+            stats.scanned += scanned
+            for puzzle in puzzles:
+                rows.setdefault(puzzle["zobrist"], puzzle)
+        with db_engine.begin() as connection:
+            if rows:
+                ratings = player_ratings(connection, {name for pair in players.values() for name in pair})
+                for puzzle in rows.values():
+                    white, black = players[puzzle["game_id"]]
+                    puzzle["rating"] = ratings.get(white if puzzle.pop("white") else black, DEFAULT_RATING)
+                    puzzle["deviation"] = DEFAULT_DEVIATION
+                    puzzle["volatility"] = DEFAULT_VOLATILITY
+                insert_ignoring_duplicates(connection, list(rows.values()), PuzzleDB)
+        stats.games += len(games)
+        stats.puzzles += len(rows)
+        stats.report(f"Last game {games[-1].game_id}")
+
+    search = partial(mine_game, **settings)
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(factory, nice)) as executor:
+        pending = None
+        for games in chunks():
+            if max_rate:
+                time.sleep(max(0.0, stats.scanned / max_rate - (time.perf_counter() - stats.started)))
+            results = executor.map(search, [(game.game_id, game.moves) for game in games])
+            if pending:
+                commit(pending)
+            pending = (games, results)
+        if pending:
+            commit(pending)
+    stats.report("Finished")
+    return stats
+
+
+def main():
+    from db.db import engine
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=None, help="Engine processes (default: all cores)")
+    parser.add_argument("--after", default=None, help="Resume after this game id")
+    parser.add_argument("--chunk", type=int, default=MINE_CHUNK)
+    parser.add_argument("--max-rate", type=float, default=None, help="Positions scanned per second at most")
+    parser.add_argument("--nice", type=int, default=NICE, help="Niceness added to the workers")
+    parser.add_argument("--scan-depth", type=int, default=SCAN_DEPTH)
+    parser.add_argument("--verify-depth", type=int, default=VERIFY_DEPTH)
+    parser.add_argument("--min-ply", type=int, default=MIN_PLY)
+    args = parser.parse_args()
+    Base.metadata.create_all(bind=engine)
+    mine(engine, args.workers, args.after, args.chunk, args.max_rate, args.nice,
+         scan_depth=args.scan_depth, verify_depth=args.verify_depth, min_ply=args.min_ply)
+
+
+if __name__ == "__main__":
+    main()
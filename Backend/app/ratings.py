@@ -0,0 +1,307 @@
+"""
+Player statistics and Glicko-2 ratings.
+
+Every saved game is folded into PlayerStatsDB in the same transaction that
+writes it (see GameWriter), once for the player's overall row and once for
+the row of the game's time control, so profile pages read a handful of rows
+instead of scanning GameDB. Each game is its own rating period.
+
+After bulk imports, or when the rating constants change, rebuild the table
+from the whole game history in one vectorized pass:
+
+    python -m app.ratings
+"""
+import argparse
+import time
+
+import numpy as np
+from sqlalchemy import delete, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.model import Base, GameDB, PlayerStatsDB
+
+OVERALL = "all"  # time_control of the row aggregating every time control
+DEFAULT_RATING = 1500.0
+DEFAULT_DEVIATION = 350.0
+MIN_DEVIATION = 45.0  # Keeps established ratings responsive
+PROVISIONAL_DEVIATION = 110.0  # Above this there are too few games for a reliable rating
+DEFAULT_VOLATILITY = 0.06
+TAU = 0.5  # How fast volatility may change
+SCALE = 173.7178  # Glicko to Glicko-2 scale
+EPSILON = 1e-6  # Convergence tolerance of the volatility search
+MAX_ITERATIONS = 100
+WRITE_CHUNK = 10_000  # Rows per INSERT when rebuilding the table
+
+# Game statuses that end without a winner, whatever `winner` says
+DRAW_STATUSES = ("stalemate", "draw")
+
+
+def game_result(status: str, winner: str, player1: str, player2: str) -> str:
+    """PGN result of a finished game; player1 always has the white pieces."""
+    if status in DRAW_STATUSES:
+        return "1/2-1/2"
+    if winner == player1:
+        return "1-0"
+    if winner == player2:
+        return "0-1"
+    return "*"
+
+
+SCORES = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+
+def game_score(game) -> float:
+    """player1's score in a finished game, or None if it does not count towards ratings."""
+    if game["player1"] == game["player2"]:
+        return None
+    return SCORES.get(game_result(game["status"], game["winner"], game["player1"], game["player2"]))
+
+
+def time_control_key(total_time, increment) -> str:
+    return None if total_time is None else f"{total_time}+{increment or 0}"
+
+
+def _volatility(phi, sigma, v, delta):
+    """New volatility (step 5 of Glicko-2), solved for every element at once."""
+    a = np.log(sigma ** 2)
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / TAU ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        # Bracket the root between A and B
+        large = delta ** 2 > phi ** 2 + v
+        A = a
+        B = np.where(large, np.log(np.where(large, delta ** 2 - phi ** 2 - v, 1.0)), a - TAU)
+        pending = ~large & (f(B) < 0)
+        while pending.any():
+            B = np.where(pending, B - TAU, B)
+            pending = pending & (f(B) < 0)
+
+        # Illinois algorithm, stopping per element once it has converged
+        fA, fB = f(A), f(B)
+        active = np.abs(B - A) > EPSILON
+        for _ in range(MAX_ITERATIONS):
+            if not active.any():
+                break
+            C = A + (A - B) * fA / (fB - fA)
+            fC = f(C)
+            swap = active & (fC * fB <= 0)
+            halve = active & ~swap
+            A, fA = np.where(swap, B, A), np.where(swap, fB, np.where(halve, fA / 2, fA))
+            B, fB = np.where(active, C, B), np.where(active, fC, fB)
+            active = np.abs(B - A) > EPSILON
+    return np.exp(A / 2)
+
+
+def glicko2_update(rating, deviation, volatility, opponent_rating, opponent_deviation, score):
+    """
+    Rating, deviation and volatility after one game against one opponent.
+
+    Takes scalars or equally shaped arrays, so the incremental and the
+    full-recompute paths share one implementation.
+    """
+    rating, deviation, volatility, opponent_rating, opponent_deviation, score = (
+        np.asarray(value, dtype=float)
+        for value in (rating, deviation, volatility, opponent_rating, opponent_deviation, score)
+    )
+    mu = (rating - DEFAULT_RATING) / SCALE
+    phi = deviation / SCALE
+    opponent_mu = (opponent_rating - DEFAULT_RATING) / SCALE
+    g = 1 / np.sqrt(1 + 3 * (opponent_deviation / SCALE) ** 2 / np.pi ** 2)
+    expected = 1 / (1 + np.exp(-g * (mu - opponent_mu)))
+    v = 1 / (g ** 2 * expected * (1 - expected))
+    delta = v * g * (score - expected)
+
+    new_volatility = _volatility(phi, volatility, v, delta)
+    phi_star = np.sqrt(phi ** 2 + new_volatility ** 2)
+    new_phi = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+    new_mu = mu + new_phi ** 2 * g * (score - expected)
+    return (
+        new_mu * SCALE + DEFAULT_RATING,
+        np.clip(new_phi * SCALE, MIN_DEVIATION, DEFAULT_DEVIATION),
+        new_volatility
+    )
+
+
+def new_stats(username: str, time_control: str) -> dict:
+    return {
+        "username": username, "time_control": time_control, "games": 0, "wins": 0, "losses": 0, "draws": 0,
+        "rating": DEFAULT_RATING, "deviation": DEFAULT_DEVIATION, "volatility": DEFAULT_VOLATILITY
+    }
+
+
+def record_games(db, games: list):
+    """
+    Fold finished games (GameDB rows as dicts) into PlayerStatsDB.
+
+    Runs inside the caller's transaction; the affected rows are locked in
+    key order so concurrent writers serialize instead of deadlocking. New
+    players' rows are created first, ignoring conflicts, since another
+    worker may be creating the same rows at the same time.
+    """
+    counted = []
+    keys = set()
+    for game in games:
+        score = game_score(game)
+        if score is None:
+            continue
+        for time_control in (OVERALL, time_control_key(game.get("total_time"), game.get("increment"))):
+            if time_control:
+                counted.append((game, time_control, score))
+                keys.update({(game["player1"], time_control), (game["player2"], time_control)})
+    if not counted:
+        return
+
+    dialect = sqlite if db.get_bind().dialect.name == "sqlite" else postgresql
+    db.execute(dialect.insert(PlayerStatsDB).on_conflict_do_nothing(), [new_stats(*key) for key in sorted(keys)])
+    stats = {
+        (row.username, row.time_control): row
+        for row in db.execute(
+            select(PlayerStatsDB)
+            .where(tuple_(PlayerStatsDB.username, PlayerStatsDB.time_control).in_(sorted(keys)))
+            .order_by(PlayerStatsDB.username, PlayerStatsDB.time_control)
+            .with_for_update()
+        ).scalars()
+    }
+
+    for game, time_control, score in counted:
+        white = stats[(game["player1"], time_control)]
+        black = stats[(game["player2"], time_control)]
+        white_rating = glicko2_update(white.rating, white.deviation, white.volatility, black.rating, black.deviation, score)
+        black_rating = glicko2_update(black.rating, black.deviation, black.volatility, white.rating, white.deviation, 1 - score)
+        for row, result, (rating, deviation, volatility) in ((white, score, white_rating), (black, 1 - score, black_rating)):
+            row.games += 1
+            row.wins += result == 1
+            row.losses += result == 0
+            row.draws += result == 0.5
+            row.rating, row.deviation, row.volatility = float(rating), float(deviation), float(volatility)
+            row.updated_at = game.get("ended_at")
+
+
+def rating_rounds(white, black, entities: int):
+    """
+    Split games (in play order) into rounds in which nobody plays twice.
+
+    Each game lands one round after the latest earlier game of either of its
+    players, so updating a whole round at once gives exactly the ratings a
+    game-by-game replay would.
+    """
+    last = [0] * entities
+    rounds = []
+    for w, b in zip(white.tolist(), black.tolist()):
+        current = max(last[w], last[b]) + 1
+        last[w] = last[b] = current
+        rounds.append(current)
+    rounds = np.asarray(rounds)
+    order = np.argsort(rounds, kind="stable")
+    boundaries = np.flatnonzero(np.diff(rounds[order])) + 1
+    return np.split(order, boundaries)
+
+
+def replay(white, black, score, entities: int):
+    """Ratings of every entity after replaying all games; white/black are entity indexes."""
+    rating = np.full(entities, DEFAULT_RATING)
+    deviation = np.full(entities, DEFAULT_DEVIATION)
+    volatility = np.full(entities, DEFAULT_VOLATILITY)
+    for games in rating_rounds(white, black, entities):
+        # Both sides of every game in the round, updated from pre-round values
+        players = np.concatenate((white[games], black[games]))
+        opponents = np.concatenate((black[games], white[games]))
+        scores = np.concatenate((score[games], 1 - score[games]))
+        rating[players], deviation[players], volatility[players] = glicko2_update(
+            rating[players], deviation[players], volatility[players],
+            rating[opponents], deviation[opponents], scores
+        )
+    return rating, deviation, volatility
+
+
+def compute_stats(games: list) -> list:
+    """PlayerStatsDB rows (as dicts) for a game history in play order."""
+    games = [game for game in games if game_score(game) is not None]
+    if not games:
+        return []
+    score = np.array([game_score(game) for game in games])
+    ended_at = [game.get("ended_at") for game in games]
+    names, player = np.unique(
+        np.array([game["player1"] for game in games] + [game["player2"] for game in games], dtype=object),
+        return_inverse=True
+    )
+    white, black = np.split(player, 2)
+
+    # Overall rows are indexed by player; per time control rows by (player, time control)
+    controls, control = np.unique(
+        np.array([time_control_key(game.get("total_time"), game.get("increment")) or "" for game in games], dtype=object),
+        return_inverse=True
+    )
+    timed = controls[control] != ""
+    pairs, pair = np.unique(np.concatenate((white, black)) * len(controls) + np.tile(control, 2), return_inverse=True)
+    white_pair, black_pair = np.split(pair, 2)
+
+    rows = []
+    for entities, white_entity, black_entity, mask, label in (
+        (len(names), white, black, np.ones(len(games), dtype=bool), lambda entity: (names[entity], OVERALL)),
+        (len(pairs), white_pair, black_pair, timed,
+         lambda entity: (names[pairs[entity] // len(controls)], controls[pairs[entity] % len(controls)])),
+    ):
+        w, b, s = white_entity[mask], black_entity[mask], score[mask]
+        rating, deviation, volatility = replay(w, b, s, entities)
+        side = np.concatenate((w, b))
+        side_score = np.concatenate((s, 1 - s))
+        played = np.bincount(side, minlength=entities)
+        wins = np.bincount(side, weights=side_score == 1, minlength=entities)
+        losses = np.bincount(side, weights=side_score == 0, minlength=entities)
+        draws = np.bincount(side, weights=side_score == 0.5, minlength=entities)
+        last_game = np.full(entities, -1)
+        np.maximum.at(last_game, side, np.tile(np.flatnonzero(mask), 2))
+        for entity in np.flatnonzero(played):
+            username, time_control = label(entity)
+            rows.append({
+                "username": username,
+                "time_control": time_control,
+                "games": int(played[entity]),
+                "wins": int(wins[entity]),
+                "losses": int(losses[entity]),
+                "draws": int(draws[entity]),
+                "rating": float(rating[entity]),
+                "deviation": float(deviation[entity]),
+                "volatility": float(volatility[entity]),
+                "updated_at": ended_at[last_game[entity]],
+            })
+    return rows
+
+
+def recompute(db) -> int:
+    """Rebuild PlayerStatsDB from every game in GameDB in one transaction; returns the row count."""
+    games = db.execute(
+        select(
+            GameDB.player1, GameDB.player2, GameDB.winner, GameDB.status,
+            GameDB.total_time, GameDB.increment, GameDB.ended_at
+        ).order_by(GameDB.ended_at, GameDB.game_id)
+    ).mappings().all()
+    rows = compute_stats(games)
+    db.execute(delete(PlayerStatsDB))
+    for start in range(0, len(rows), WRITE_CHUNK):
+        db.execute(insert(PlayerStatsDB), rows[start:start + WRITE_CHUNK])
+    db.commit()
+    return len(rows)
+
+
+def main():
+    from db.db import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    Base.metadata.create_all(bind=engine)
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        count = recompute(db)
+    finally:
+        db.close()
+    print(f"Rebuilt {count} player stats rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
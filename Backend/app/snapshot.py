@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+
+import redis
+from dotenv import load_dotenv
+
+from app.Game import Game
+from app.TimeControl import TimeControl
+from app.bots import BotPlayer
+from app.persistence import game_writer
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))
+SNAPSHOT_TTL = 24 * 60 * 60  # Abandoned snapshots expire after a day
+
+logger = logging.getLogger(__name__)
+
+
+class DetachedSocket:
+    """Placeholder for a player who has not reconnected to a restored game yet."""
+
+    async def send_json(self, message: dict):
+        pass
+
+
+def snapshot_game(game_id: str, game_data: dict) -> dict:
+    """Capture everything needed to resume a game: moves, turn, clocks and the bot's strength."""
+    game = game_data["game"]
+    time_control = game_data["players"][game.player1]["time"]
+    bot = game_data.get("bot")
+    return {
+        "game_id": game_id,
+        "player1": game.player1,
+        "player2": game.player2,
+        "moves": list(game.moves),
+        "turn": game.current_turn,
+        "status": game.get_status(),
+        "total_time": time_control.total_time,
+        "increment": time_control.increment,
+        "times": {
+            time_control.player1: round(time_control.player1_time, 2),
+            time_control.player2: round(time_control.player2_time, 2)
+        },
+        "bot": bot.settings() if bot else None,
+        "saved_at": time.time()
+    }
+
+
+def restore_game(snapshot: dict, active_games: dict) -> dict:
+    """
+    Rebuild an active game from its snapshot.
+
+    Neither player is attached yet; both get a DetachedSocket until they
+    reconnect, or until the caller seats the bot of a bot game. The clocks
+    resume from the saved remainders, so time spent while the server was
+    down is not charged to anyone. Moves logged after the snapshot are
+    dropped from the move log, since the game goes on without them.
+    """
+    game_id = snapshot["game_id"]
+    player1 = snapshot["player1"]
+    player2 = snapshot["player2"]
+
+    game = Game(game_id=game_id)
+    game.start(player1, player2)
+    for move in snapshot["moves"]:
+        game.move(move)
+    game.current_turn = snapshot["turn"]
+    game_writer.rewind(game_id, len(snapshot["moves"]))
+
+    time = TimeControl(
+        total_time=snapshot["total_time"],
+        increment=snapshot["increment"],
+        game=game,
+        active_games=active_games,
+        game_id=game_id
+    )
+    time.player1_time = snapshot["times"][player1]
+    time.player2_time = snapshot["times"][player2]
+
+    active_games[game_id] = {
+        "players": {
+            player1: {"websocket": DetachedSocket(), "time": time},
+            player2: {"websocket": DetachedSocket(), "time": time}
+        },
+        "game": game
+    }
+    if snapshot.get("bot"):
+        active_games[game_id]["bot"] = BotPlayer(**snapshot["bot"])
+    time.start(snapshot["turn"], player1, player2, DetachedSocket(), DetachedSocket())
+    return active_games[game_id]
+
+
+class SnapshotStore(ABC):
+    """Where game snapshots live between restarts; payloads are compact JSON."""
+
+    @abstractmethod
+    def save_many(self, snapshots: list):
+        ...
+
+    @abstractmethod
+    def load(self, game_id: str):
+        ...
+
+    @abstractmethod
+    def delete_many(self, game_ids: list):
+        ...
+
+
+class FileSnapshotStore(SnapshotStore):
+    """One file per game, replaced atomically so a crash never leaves half a snapshot."""
+
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, game_id):
+        return os.path.join(self.directory, f"{game_id}.json")
+
+    def save_many(self, snapshots):
+        for snapshot in snapshots:
+            path = self._path(snapshot["game_id"])
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(f"{path}.tmp", path)
+
+    def load(self, game_id):
+        # game_id comes from the client; never let it escape the snapshot directory
+        if os.path.basename(game_id) != game_id:
+            return None
+        try:
+            with open(self._path(game_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def delete_many(self, game_ids):
+        for game_id in game_ids:
+            try:
+                os.remove(self._path(game_id))
+            except FileNotFoundError:
+                pass
+
+
+class RedisSnapshotStore(SnapshotStore):
+    """Snapshots shared through Redis so any worker can resume any game."""
+
+    def __init__(self, client: redis.Redis, prefix: str = "snapshot"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, game_id):
+        return f"{self.prefix}:{game_id}"
+
+    def save_many(self, snapshots):
+        pipeline = self.client.pipeline(transaction=False)
+        for snapshot in snapshots:
+            pipeline.set(
+                self._key(snapshot["game_id"]),
+                json.dumps(snapshot, separators=(",", ":")),
+                ex=SNAPSHOT_TTL
+            )
+        pipeline.execute()
+
+    def load(self, game_id):
+        snapshot = self.client.get(self._key(game_id))
+        return json.loads(snapshot) if snapshot else None
+
+    def delete_many(self, game_ids):
+        if game_ids:
+            self.client.delete(*[self._key(game_id) for game_id in game_ids])
+
+
+class Snapshotter:
+    """Periodically snapshots this worker's active games and drops those that ended."""
+
+    def __init__(self, store: SnapshotStore, active_games: dict, interval: float = SNAPSHOT_INTERVAL):
+        self.store = store
+        self.active_games = active_games
+        self.interval = interval
+        self.saved = set()  # game ids with a snapshot written by this worker
+        self._task = None
+
+    async def snapshot_all(self):
+        snapshots = [
+            snapshot_game(game_id, game_data)
+            for game_id, game_data in list(self.active_games.items())
+            if game_data["game"].get_status() == "ongoing"
+        ]
+        current = {snapshot["game_id"] for snapshot in snapshots}
+        finished = list(self.saved - current)
+        await asyncio.to_thread(self.store.save_many, snapshots)
+        await asyncio.to_thread(self.store.delete_many, finished)
+        self.saved = current
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot_all()
+            except Exception:
+                logger.exception("Error snapshotting games")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the periodic task and take a final snapshot before shutdown."""
+        if self._task:
+            self._task.cancel()
+        await self.snapshot_all()
+
+
+def get_snapshot_store() -> SnapshotStore:
+    if REDIS_URL:
+        return RedisSnapshotStore(redis.Redis.from_url(REDIS_URL))
+    return FileSnapshotStore()
@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import Mock, patch, AsyncMock
 import asyncio
+import time as time_module
 import chess
 import pytest
 from fastapi.testclient import TestClient
@@ -8,11 +9,22 @@ from fastapi.websockets import WebSocket
 from app.Game import Game
 from app.TimeControl import TimeControl
 from app.Signaling import Signaling
+from app.lobby import InMemoryLobbyStore, RemoteSocket
+from app.model import Event
+from app.engine_pool import EnginePool
+from benchmarks.stub_engine import STUB_PATH, StubEngine, material
 
 class TestGame(unittest.TestCase):
     def setUp(self):
-        self.game = Game()
-        self.game.start("player1", "player2")
+        # The stub speaks UCI like Stockfish, so the engine calls themselves are exercised too
+        self.engines = EnginePool(STUB_PATH, size=1)
+        self.addCleanup(self.engines.close)
+        self.game = self.new_game("test-game")
+
+    def new_game(self, game_id):
+        game = Game(game_id=game_id, engines=self.engines)
+        game.start("player1", "player2")
+        return game
 
     @patch('chess.engine.SimpleEngine.popen_uci')
     def test_game_initialization(self, mock_engine):
@@ -52,8 +64,7 @@ class TestGame(unittest.TestCase):
         self.assertEqual(self.game.get_status(), "checkmate")
         
         # Test stalemate scenario
-        self.game = Game()
-        self.game.start("player1", "player2")
+        self.game = self.new_game("test-stalemate")
         # This is a known stalemate position
         stalemate_moves = [
             "e3", "a5", "Qh5", "Ra6", "Qxa5", "h5", "h4", "Rah6", 
@@ -175,6 +186,894 @@ async def test_signaling():
         "data": {"from": "player1", "offer": test_offer}
     }
 
+@pytest.mark.asyncio
+async def test_lobby_matchmaking():
+    lobby = InMemoryLobbyStore()
+    mock_websocket1 = AsyncMock(spec=WebSocket)
+    mock_websocket2 = AsyncMock(spec=WebSocket)
+    lobby.register(mock_websocket1)
+    lobby.register(mock_websocket2)
+
+    first = lobby.make_entry(mock_websocket1, "player1", 300, 2)
+    second = lobby.make_entry(mock_websocket2, "player2", 300, 2)
+
+    assert await lobby.match_or_wait((300, 2), first) is None
+    assert await lobby.queue_length((300, 2)) == 1
+    assert lobby.queue_lengths() == {"300+2": 1}
+
+    opponent = await lobby.match_or_wait((300, 2), second)
+    assert opponent["player_name"] == "player1"
+    assert lobby.socket_for(opponent) is mock_websocket1
+    assert await lobby.queue_length((300, 2)) == 0
+
+    # Entries from other workers are reached through a relay socket
+    remote = dict(opponent, worker_id="another-worker")
+    assert isinstance(lobby.socket_for(remote), RemoteSocket)
+
+@pytest.mark.asyncio
+async def test_lobby_invites():
+    lobby = InMemoryLobbyStore()
+    mock_websocket = AsyncMock(spec=WebSocket)
+    lobby.register(mock_websocket)
+
+    await lobby.create_invite("game1", lobby.make_entry(mock_websocket, "player1", 600, 10))
+    assert (await lobby.pop_invite("game1"))["player_name"] == "player1"
+    # An invite can only be claimed once
+    assert await lobby.pop_invite("game1") is None
+
+@pytest.mark.asyncio
+async def test_relayed_events_keep_their_order():
+    lobby = InMemoryLobbyStore()
+    handled = []
+
+    async def handle_forwarded_event(websocket, event):
+        # The first move takes longest; it must still finish before the second starts
+        await asyncio.sleep(0.05 if event.data["move"] == "e4" else 0)
+        handled.append((websocket.conn_id, event.data["move"]))
+
+    await lobby.start(handle_forwarded_event)
+    for conn_id, move in (("a", "e4"), ("b", "d4"), ("a", "e5")):
+        lobby._receive({"kind": "event", "worker_id": "w2", "conn_id": conn_id,
+                        "event": {"event": "MOVE", "data": {"move": move}}})
+    await asyncio.gather(*lobby._relay_tasks)
+
+    assert [move for conn_id, move in handled if conn_id == "a"] == ["e4", "e5"]
+    assert handled[0] == ("b", "d4")  # Other connections are not held up
+    assert lobby.relayed == {}
+
+@pytest.mark.asyncio
+async def test_redis_lobby_across_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    from app.lobby import RedisLobbyStore
+
+    server = fakeredis.FakeServer()
+    worker1 = RedisLobbyStore(fakeredis.FakeRedis(server=server))
+    worker2 = RedisLobbyStore(fakeredis.FakeRedis(server=server))
+    worker2.worker_id = "worker2"
+    forwarded = []
+
+    async def handle_forwarded_event(websocket, event):
+        forwarded.append((websocket, event))
+
+    await worker1.start()
+    await worker2.start(handle_forwarded_event)
+    mock_websocket1 = AsyncMock(spec=WebSocket)
+    mock_websocket2 = AsyncMock(spec=WebSocket)
+    worker1.register(mock_websocket1)
+    worker2.register(mock_websocket2)
+
+    try:
+        assert await worker1.match_or_wait((300, 2), worker1.make_entry(mock_websocket1, "player1", 300, 2)) is None
+        assert worker2.queue_lengths() == {"300+2": 1}
+        opponent = await worker2.match_or_wait((300, 2), worker2.make_entry(mock_websocket2, "player2", 300, 2))
+        assert opponent["player_name"] == "player1"
+
+        # The pairing worker reaches player1 through worker1's channel
+        await worker2.socket_for(opponent).send_json({"event": "GAME_STARTED"})
+        for _ in range(30):
+            if mock_websocket1.send_json.called:
+                break
+            await asyncio.sleep(0.1)
+        mock_websocket1.send_json.assert_called_with({"event": "GAME_STARTED"})
+
+        # Moves for a game hosted on worker2 are forwarded there from worker1
+        await worker2.claim_game("game1")
+        assert await worker1.game_owner("game1") == "worker2"
+        await worker1.forward_event("worker2", mock_websocket1, Event(event="MOVE", data={"game_id": "game1", "move": "e4"}))
+        for _ in range(30):
+            if forwarded:
+                break
+            await asyncio.sleep(0.1)
+        websocket, event = forwarded[0]
+        assert websocket == RemoteSocket(worker2, worker1.worker_id, opponent["conn_id"])
+        assert event.data["move"] == "e4"
+    finally:
+        await worker1.close()
+        await worker2.close()
+
+def test_labelled_metrics_render():
+    from app.metrics import Gauge, Histogram, REGISTRY, render_metrics
+
+    phases = Histogram("test_phase_seconds", "Test phases", buckets=(0.1, 1.0), labelnames=("phase",))
+    queued = Gauge("test_waiting", "Test gauge", lambda: {("60+0",): 3}, labelnames=("time_control",))
+    broken = Gauge("test_broken", "Fails at scrape time", lambda: 1 / 0)
+    try:
+        phases.labels("engine").observe(0.5)
+        phases.labels("send").observe(0.05)
+        text = render_metrics()
+    finally:
+        for metric in (phases, queued, broken):
+            REGISTRY.remove(metric)
+
+    assert 'test_phase_seconds_bucket{phase="engine",le="0.1"} 0' in text
+    assert 'test_phase_seconds_bucket{phase="engine",le="1.0"} 1' in text
+    assert 'test_phase_seconds_count{phase="send"} 1' in text
+    assert 'test_waiting{time_control="60+0"} 3' in text
+    assert "test_broken" not in text  # Skipped without taking the rest of the scrape down
+
+def test_metrics_aggregate_across_workers(tmp_path):
+    import json
+    import os
+    from app.metrics import Counter, Gauge, Histogram, REGISTRY, WorkerMetrics, render_metrics
+
+    games = Counter("test_games_total", "Test counter")
+    phases = Histogram("test_worker_seconds", "Test phases", buckets=(0.1, 1.0), labelnames=("phase",))
+    connected = Gauge("test_connected", "Test gauge", lambda: 2)
+    queued = Gauge("test_queued", "Same in every worker", lambda: 5, per_worker=False)
+    workers = WorkerMetrics(str(tmp_path))
+    try:
+        games.inc(3)
+        phases.labels("engine").observe(0.5)
+        workers.write()
+        # Another worker, still running
+        [written] = tmp_path.glob("*.json")
+        os.replace(written, tmp_path / f"{os.getppid()}-live.json")
+        # One that has exited, and an earlier process that had this worker's pid
+        (tmp_path / "999999999-dead.json").write_text(json.dumps({"test_games_total": 4, "test_connected": {"[]": 7}}))
+        (tmp_path / f"{os.getpid()}-old.json").write_text(json.dumps({"test_games_total": 5}))
+        games.inc()
+        with patch("app.metrics.worker_metrics", workers):
+            text = render_metrics()
+            again = render_metrics()
+    finally:
+        for metric in (games, phases, connected, queued):
+            REGISTRY.remove(metric)
+
+    assert "test_games_total 16" in text and "test_games_total 16" in again  # Exited workers count once
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == [f"{os.getppid()}-live.json", "retired.json"]
+    assert 'test_worker_seconds_count{phase="engine"} 2' in text
+    assert f'test_connected{{worker="{os.getpid()}"}} 2' in text
+    assert f'test_connected{{worker="{os.getppid()}"}} 2' in text
+    assert 'worker="999999999"' not in text
+    assert "test_queued 5" in text
+
+def test_file_snapshot_store(tmp_path):
+    from app.snapshot import FileSnapshotStore, snapshot_game
+
+    game = Mock(player1="player1", player2="player2", moves=["e4", "e5"], current_turn="player1")
+    game.get_status.return_value = "ongoing"
+    time_control = TimeControl(total_time=300, increment=2, game=game)
+    time_control.player1, time_control.player2 = "player1", "player2"
+    time_control.player2_time = 287.456
+    game_data = {"game": game, "players": {"player1": {"time": time_control}, "player2": {"time": time_control}}}
+
+    store = FileSnapshotStore(str(tmp_path))
+    store.save_many([snapshot_game("game1", game_data)])
+
+    snapshot = store.load("game1")
+    assert snapshot["moves"] == ["e4", "e5"]
+    assert snapshot["turn"] == "player1"
+    assert snapshot["times"] == {"player1": 300, "player2": 287.46}
+    assert store.load("../game1") is None
+
+    store.delete_many(["game1"])
+    assert store.load("game1") is None
+
+def make_test_session():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from app.model import Base
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)
+
+def test_migrate_games_from_before_history_columns(capsys):
+    from datetime import datetime
+    from sqlalchemy import create_engine, inspect, text
+    from sqlalchemy.pool import StaticPool
+    from app.migrate import upgrade_games
+
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE games (game_id VARCHAR PRIMARY KEY, player1 VARCHAR NOT NULL, "
+                                "player2 VARCHAR NOT NULL, status VARCHAR NOT NULL, winner VARCHAR, moves JSON NOT NULL)"))
+        connection.execute(text("INSERT INTO games VALUES ('logged', 'a', 'b', 'checkmate', 'a', '[]'), "
+                                "('old', 'a', 'b', 'draw', NULL, '[]')"))
+    upgrade_games(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO move_log VALUES ('logged', 1, 'e4', NULL, '2024-01-01 00:00:00')"))
+        connection.execute(text("UPDATE games SET ended_at = NULL"))
+    upgrade_games(engine)  # Idempotent
+
+    with engine.connect() as connection:
+        ended = dict(connection.execute(text("SELECT game_id, ended_at FROM games")).all())
+    assert ended["logged"].startswith("2024-01-01")
+    assert ended["old"] is not None
+    indexes = {index["name"] for index in inspect(engine).get_indexes("games")}
+    assert {"ix_games_player1_ended_at", "ix_games_player2_ended_at"} <= indexes
+    assert "backfilled ended_at for 2 games" in capsys.readouterr().out
+
+def test_game_writer_batches_and_flushes():
+    from datetime import datetime
+    from app.model import GameDB, MoveLogDB
+    from app.persistence import GameWriter
+
+    Session = make_test_session()
+    writer = GameWriter(session_factory=Session)
+    for ply, move in enumerate(["f3", "e5", "g4", "Qh4#"], start=1):
+        writer.submit_move({"game_id": "game0", "ply": ply, "move": move, "clock_remaining": 290.0, "created_at": datetime.utcnow()})
+    writer.submit_game({"game_id": "game0", "player1": "a", "player2": "b", "moves": [], "winner": "b", "status": "checkmate"})
+    writer.submit_game({"game_id": "game1", "player1": "a", "player2": "b", "moves": ["e4"], "winner": "a", "status": "timeout"})
+    # A duplicate must not take the rest of its batch down with it
+    writer.submit_game({"game_id": "game0", "player1": "a", "player2": "b", "moves": [], "winner": "a", "status": "timeout"})
+    writer.close()
+
+    db = Session()
+    assert db.query(MoveLogDB).count() == 4
+    game = db.query(GameDB).filter(GameDB.game_id == "game0").one()
+    # The finished game is rebuilt from the move log
+    assert game.moves == ["f3", "e5", "g4", "Qh4#"]
+    assert game.status == "checkmate"
+    # Without a logged history the in-memory moves are kept
+    assert db.query(GameDB).filter(GameDB.game_id == "game1").one().moves == ["e4"]
+    db.close()
+
+def test_resume_from_snapshot_older_than_move_log():
+    from datetime import datetime
+    from app.model import GameDB, MoveLogDB
+    from app.persistence import GameWriter
+    from app.snapshot import restore_game
+
+    Session = make_test_session()
+    writer = GameWriter(session_factory=Session)
+
+    def log(ply, move):
+        writer.submit_move({"game_id": "resumed", "ply": ply, "move": move, "clock_remaining": 290.0, "created_at": datetime.utcnow()})
+
+    for ply, move in enumerate(["e4", "e5", "Nf3", "Nc6"], start=1):
+        log(ply, move)
+    # The worker died after the snapshot at ply 2; the resumed game replays plies 3 and 4 differently
+    snapshot = {
+        "game_id": "resumed", "player1": "a", "player2": "b", "moves": ["e4", "e5"], "turn": "a", "status": "ongoing",
+        "total_time": 300, "increment": 0, "times": {"a": 290.0, "b": 290.0}
+    }
+    active_games = {}
+    with patch("app.snapshot.game_writer", writer):
+        game_data = restore_game(snapshot, active_games)
+    game_data["players"]["a"]["time"].timer_active = False
+    game = game_data["game"]
+    for ply, move in enumerate(["d4", "d5"], start=3):
+        game.move(move)
+        log(ply, move)
+    writer.submit_game({"game_id": "resumed", "player1": "a", "player2": "b", "moves": game.moves, "winner": None, "status": "draw"})
+    writer.close()
+
+    db = Session()
+    logged = db.query(MoveLogDB).filter(MoveLogDB.game_id == "resumed").order_by(MoveLogDB.ply)
+    assert [row.move for row in logged] == ["e4", "e5", "d4", "d5"]
+    assert db.query(GameDB).filter(GameDB.game_id == "resumed").one().moves == ["e4", "e5", "d4", "d5"]
+    db.close()
+
+def make_test_client(Session):
+    from fastapi import FastAPI
+    from app.game_route import router
+    from db.db import get_db
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_db] = override_get_db
+    return TestClient(app)
+
+def test_user_games_pagination():
+    from datetime import datetime, timedelta
+    from app.model import GameDB
+
+    Session = make_test_session()
+    db = Session()
+    start = datetime(2024, 1, 1)
+    for i in range(5):
+        db.add(GameDB(game_id=f"game{i}", player1="alice" if i % 2 else "bob", player2="bob" if i % 2 else "alice",
+                      status="stalemate" if i == 4 else "checkmate", winner="alice", moves=["e4"],
+                      ended_at=start + timedelta(minutes=i), total_time=300, increment=2))
+    db.commit()
+    db.close()
+
+    client = make_test_client(Session)
+
+    first = client.get("/user/alice/games", params={"limit": 3})
+    assert [game["game_id"] for game in first.json()] == ["game4", "game3", "game2"]
+    second = client.get("/user/alice/games", params={"limit": 3, "cursor": first.headers["X-Next-Cursor"]})
+    assert [game["game_id"] for game in second.json()] == ["game1", "game0"]
+    assert "X-Next-Cursor" not in second.headers
+
+    wins = client.get("/user/alice/games", params={"result": "win", "time_control": "300+2"})
+    assert [game["game_id"] for game in wins.json()] == ["game3", "game2", "game1", "game0"]
+    assert client.get("/user/alice/games", params={"result": "draw"}).json()[0]["game_id"] == "game4"
+    assert client.get("/user/carol/games").status_code == 404
+
+def test_export_user_games(monkeypatch):
+    from datetime import datetime, timedelta
+    import json
+    import chess.pgn
+    import io
+    import app.game_route as game_route
+    from app.model import GameDB
+
+    monkeypatch.setattr(game_route, "EXPORT_CHUNK", 2)  # Force several chunks
+    Session = make_test_session()
+    db = Session()
+    for i in range(5):
+        db.add(GameDB(game_id=f"game{i}", player1="alice", player2="bob", status="checkmate", winner="bob",
+                      moves=["f3", "e5", "g4", "Qh4#"], ended_at=datetime(2024, 1, 1) + timedelta(minutes=i),
+                      total_time=60, increment=0))
+    db.commit()
+    db.close()
+    client = make_test_client(Session)
+
+    lines = client.get("/user/alice/games/export", params={"format": "ndjson"}).text.splitlines()
+    assert [json.loads(line)["game_id"] for line in lines] == ["game4", "game3", "game2", "game1", "game0"]
+
+    response = client.get("/user/alice/games/export")
+    assert "attachment" in response.headers["Content-Disposition"]
+    pgn = io.StringIO(response.text)
+    games = []
+    while (game := chess.pgn.read_game(pgn)) is not None:
+        games.append(game)
+    assert len(games) == 5
+    assert games[0].headers["Result"] == "0-1"
+    assert games[0].headers["TimeControl"] == "60+0"
+    assert games[0].end().board().is_checkmate()
+
+def test_finished_game_etag_and_cache():
+    from app.game_route import finished_games
+    from app.model import GameDB
+
+    Session = make_test_session()
+    db = Session()
+    db.add(GameDB(game_id="cached", player1="a", player2="b", status="checkmate", winner="a", moves=["f3", "e5"]))
+    db.commit()
+    client = make_test_client(Session)
+    finished_games.clear()
+
+    response = client.get("/game/cached")
+    assert response.json()["moves"] == ["f3", "e5"]
+    assert "immutable" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    # Served from memory once cached, and revalidated without a body
+    db.query(GameDB).delete()
+    db.commit()
+    db.close()
+    assert client.get("/game/cached").json()["game_id"] == "cached"
+    revalidated = client.get("/game/cached", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == etag
+    assert client.get("/game/cached", headers={"If-None-Match": "*"}).status_code == 304
+    assert client.get("/game/missing").status_code == 404
+    assert client.get("/game/missing", headers={"If-None-Match": "*"}).status_code == 404
+
+def test_player_stats_incremental_and_recompute():
+    from datetime import datetime, timedelta
+    from app.model import PlayerStatsDB
+    from app.persistence import GameWriter
+    from app.ratings import recompute
+
+    Session = make_test_session()
+    writer = GameWriter(session_factory=Session)
+    start = datetime(2024, 1, 1)
+    results = [("a", "b", "a", "checkmate"), ("b", "c", None, "stalemate"), ("a", "c", "c", "timeout"),
+               ("c", "a", "c", "Disconnect"), ("a", "b", "a", "checkmate"), ("b", "a", "a", "timeout")]
+    for i, (white, black, winner, status) in enumerate(results):
+        writer.submit_game({"game_id": f"g{i}", "player1": white, "player2": black, "moves": [], "winner": winner,
+                            "status": status, "ended_at": start + timedelta(minutes=i),
+                            "total_time": 180 if i % 2 else 600, "increment": 2})
+    writer.close()
+
+    client = make_test_client(Session)
+    stats = client.get("/user/a/stats").json()
+    assert stats["overall"]["games"] == 5
+    assert (stats["overall"]["wins"], stats["overall"]["losses"], stats["overall"]["draws"]) == (3, 2, 0)
+    assert stats["overall"]["rating"] > 1500
+    assert sum(control["games"] for control in stats["time_controls"].values()) == 5
+    assert client.get("/user/nobody/stats").status_code == 404
+
+    # The vectorized rebuild replays the history to exactly the incremental ratings
+    db = Session()
+    incremental = {(row.username, row.time_control): (row.games, row.wins, row.draws, row.rating, row.deviation)
+                   for row in db.query(PlayerStatsDB)}
+    assert recompute(db) == len(incremental)
+    rebuilt = {(row.username, row.time_control): (row.games, row.wins, row.draws, row.rating, row.deviation)
+               for row in db.query(PlayerStatsDB)}
+    db.close()
+    assert rebuilt.keys() == incremental.keys()
+    for key, values in incremental.items():
+        assert rebuilt[key][:3] == values[:3]
+        assert rebuilt[key][3:] == pytest.approx(values[3:])
+
+def test_position_index_and_backfill():
+    from app.model import PositionDB
+    from app.persistence import GameWriter
+    from app.positions import backfill
+
+    Session = make_test_session()
+    writer = GameWriter(session_factory=Session)
+    for game_id, moves in (("a", ["e4", "e5", "Nf3"]), ("b", ["Nf3", "e5", "e4"]), ("c", ["d4"])):
+        writer.submit_game({"game_id": game_id, "player1": "x", "player2": "y", "moves": moves, "winner": "x", "status": "timeout"})
+    writer.close()
+
+    client = make_test_client(Session)
+    # Both move orders transpose into the same position
+    fen = "rnbqkbnr/pppp1ppp/8/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2"
+    games = client.get(f"/positions/{fen}/games").json()
+    assert [(game["game_id"], game["ply"]) for game in games] == [("a", 3), ("b", 3)]
+    first = client.get(f"/positions/{fen}/games", params={"limit": 1})
+    assert client.get(f"/positions/{fen}/games", params={"cursor": first.headers["X-Next-Cursor"]}).json()[0]["game_id"] == "b"
+    assert len(client.get(f"/positions/{chess.STARTING_FEN}/games").json()) == 3
+    assert client.get("/positions/not a fen/games").status_code == 400
+
+    # A backfill rebuilds exactly what the writer indexed
+    db = Session()
+    indexed = sorted((row.zobrist, row.game_id, row.ply) for row in db.query(PositionDB))
+    db.query(PositionDB).filter(PositionDB.game_id != "a").delete()
+    db.commit()
+    backfill(db.get_bind(), workers=1, chunk=2)
+    assert sorted((row.zobrist, row.game_id, row.ply) for row in db.query(PositionDB)) == indexed
+    db.close()
+
+def test_opening_explorer():
+    from app.game_route import explorer_positions
+    from app.model import OpeningMoveDB
+    from app.openings import rebuild
+    from app.persistence import GameWriter
+
+    Session = make_test_session()
+    writer = GameWriter(session_factory=Session)
+    for game_id, moves, winner, status in (("a", ["e4", "e5", "Nf3"], "x", "timeout"), ("b", ["e4", "c5"], None, "draw"),
+                                           ("c", ["d4", "d5"], "y", "checkmate"), ("d", ["e4"], None, "ongoing")):
+        writer.submit_game({"game_id": game_id, "player1": "x", "player2": "y", "moves": moves, "winner": winner, "status": status})
+    writer.close()
+
+    explorer_positions.clear()
+    client = make_test_client(Session)
+    start = client.get(f"/explorer/{chess.STARTING_FEN}").json()
+    assert (start["white"], start["draws"], start["black"]) == (1, 1, 1)
+    assert [(move["san"], move["games"]) for move in start["moves"]] == [("e4", 2), ("d4", 1)]
+    after_e4 = client.get("/explorer/rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1").json()
+    assert sorted(move["san"] for move in after_e4["moves"]) == ["c5", "e5"]
+
+    # Served from the hot tier until it expires
+    db = Session()
+    counts = sorted((row.zobrist, row.move, row.white_wins, row.draws, row.black_wins) for row in db.query(OpeningMoveDB))
+    db.query(OpeningMoveDB).delete()
+    db.commit()
+    assert client.get(f"/explorer/{chess.STARTING_FEN}").json() == start
+
+    # A rebuild recounts exactly what was added incrementally
+    rebuild(db.get_bind(), workers=1, chunk=2)
+    assert sorted((row.zobrist, row.move, row.white_wins, row.draws, row.black_wins) for row in db.query(OpeningMoveDB)) == counts
+    db.close()
+
+def test_batch_analysis():
+    import json
+    from datetime import timedelta
+    from fastapi import FastAPI
+    from app import analysis
+    from app.auth import create_access_token
+
+    stub = StubEngine()
+    searches = []
+    stub.analyse = Mock(side_effect=lambda board, limit: searches.append(board.fen()) or StubEngine.analyse(stub, board, limit))
+    engines = EnginePool(size=2, factory=lambda: stub)
+    analysis.analysed_positions.clear()
+    app = FastAPI()
+    app.include_router(analysis.router)
+    client = TestClient(app)
+    token = create_access_token({"sub": "alice"}, timedelta(minutes=5))
+    after_e4 = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+
+    def analyse(body):
+        response = client.post(f"/analysis?token={token}", json=body)
+        assert response.headers["content-type"] == "application/x-ndjson"
+        return {line["fen"]: line for line in map(json.loads, response.text.splitlines())}
+
+    with patch("app.analysis.engine_pool", engines):
+        # The same position with other move counters is searched once
+        first = analyse({"positions": [chess.STARTING_FEN, after_e4, after_e4.replace("0 1", "4 7"), "not a fen"], "depth": 8})
+        assert len(searches) == 2
+        assert first["not a fen"] == {"fen": "not a fen", "error": "Invalid FEN"}
+        assert first[after_e4]["score"] == {"cp": 0} and first[after_e4]["best_move"] == "a7a5"
+        assert first[after_e4]["pv"] == ["a7a5"] and not first[after_e4]["cached"]
+
+        second = analyse({"positions": [after_e4], "depth": 8})
+        assert second[after_e4]["cached"] and len(searches) == 2
+        # Another limit is another search
+        analyse({"positions": [after_e4], "time": 0.1})
+        assert len(searches) == 3
+
+        assert client.post("/analysis?token=forged", json={"positions": [after_e4]}).status_code == 401
+        too_many = {"positions": [after_e4] * (analysis.MAX_ANALYSIS_POSITIONS + 1)}
+        assert client.post(f"/analysis?token={token}", json=too_many).status_code == 400
+    engines.close()
+
+class GreedyEngine(StubEngine):
+    """Looks one move ahead for material, enough to see a hanging piece."""
+
+    def analyse(self, board, limit, multipv=None, **kwargs):
+        lines = []
+        for move in board.legal_moves:
+            board.push(move)
+            lines.append((-material(board), move.uci(), move))
+            board.pop()
+        lines.sort(key=lambda line: (-line[0], line[1]))
+        infos = [
+            {"depth": 1, "score": chess.engine.PovScore(chess.engine.Cp(score), board.turn), "pv": [move]}
+            for score, _, move in lines[:multipv or 1]
+        ]
+        return infos if multipv else infos[0]
+
+def test_puzzle_mining():
+    from app.model import GameDB, PlayerStatsDB, PuzzleDB
+    from app.puzzles import mine
+
+    Session = make_test_session()
+    db = Session()
+    missed = ["e4", "e5", "Nf3", "Qg5", "a3", "Qxg2"]  # White misses the queen left on g5
+    for game_id, moves in (("a", missed), ("b", missed), ("c", ["e4", "e5"])):
+        db.add(GameDB(game_id=game_id, player1=f"white-{game_id}", player2="black", status="resigned", winner="black", moves=moves))
+    db.add(PlayerStatsDB(username="white-a", time_control="all", rating=1720, deviation=80, volatility=0.06))
+    db.commit()
+
+    stats = mine(db.get_bind(), workers=1, chunk=2, nice=0, factory=GreedyEngine, min_ply=0)
+    assert (stats.games, stats.scanned) == (3, 7 + 7 + 3)
+    # Both games reach the same position: one puzzle, rated like the player who missed it
+    [puzzle] = db.query(PuzzleDB).all()
+    assert (puzzle.game_id, puzzle.ply, puzzle.solution, puzzle.rating) == ("a", 4, ["f3g5"], 1720)
+    assert puzzle.fen == "rnb1kbnr/pppp1ppp/8/4p1q1/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"
+
+    # Resuming after a game skips it and everything before it
+    assert mine(db.get_bind(), workers=1, after="b", nice=0, factory=GreedyEngine, min_ply=0).games == 1
+    assert db.query(PuzzleDB).count() == 1
+    db.close()
+
+def test_token_cache_and_websocket_auth():
+    from datetime import timedelta
+    from fastapi import FastAPI
+    from jose import JWTError
+    from starlette.websockets import WebSocketDisconnect
+    from app import auth
+    from app.websocket_handlers import websocket_endpoint
+
+    auth.verified_tokens.clear()
+    token = auth.create_access_token({"sub": "alice"}, timedelta(minutes=5))
+    assert auth.verify_token(token) == "alice"
+    with patch("app.auth.jwt.decode") as decode:
+        assert auth.verify_token(token) == "alice"  # Cached, no signature check
+        decode.assert_not_called()
+    with pytest.raises(JWTError):
+        auth.verify_token(auth.create_access_token({"sub": "alice"}, timedelta(seconds=-1)))
+    # Cached tokens are dropped once they expire
+    with patch("app.cache.time.monotonic", return_value=time_module.monotonic() + 301):
+        assert auth.verified_tokens.get(token) is None
+
+    app = FastAPI()
+    app.state.lobby = InMemoryLobbyStore()
+    app.state.active_games = {}
+    app.add_api_websocket_route("/ws", websocket_endpoint)
+    client = TestClient(app)
+
+    # The verified user replaces whatever name the client claims
+    with client.websocket_connect(f"/ws?token={token}") as websocket:
+        websocket.send_json({"event": "CREATE_GAME", "data": {"player_name": "mallory", "total_time": 60, "increment": 0}})
+        game_id = websocket.receive_json()["data"]["game_id"]
+        assert app.state.lobby.joining_games[game_id]["player_name"] == "alice"
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/ws?token=forged") as websocket:
+            websocket.receive_json()
+
+def test_password_offload_rehash_and_shedding(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import FastAPI
+    from passlib.context import CryptContext
+    from app import auth
+    from app.model import UserDB
+    from db.db import get_db
+
+    Session = make_test_session()
+    app = FastAPI()
+    app.include_router(auth.router)
+    app.dependency_overrides[get_db] = lambda: Session()
+    client = TestClient(app)
+    # Cheap scheme on threads so the test stays fast; the pool and rehash paths are the same
+    monkeypatch.setattr(auth, "password_pool", ThreadPoolExecutor(1))
+    monkeypatch.setattr(auth, "pwd_context", CryptContext(schemes=["sha256_crypt"], sha256_crypt__default_rounds=1000))
+    credentials = {"username": "alice", "email": "alice@example.com", "password": "secret"}
+
+    assert client.post("/register", json=credentials).status_code == 200
+    assert client.post("/register", json=credentials).status_code == 400
+    assert client.post("/login", json=dict(credentials, password="wrong")).status_code == 401
+    assert client.post("/login", json=credentials).json()["user"] == "alice"
+
+    # Raising the cost makes the stored hash outdated; the next login upgrades it
+    monkeypatch.setattr(auth, "pwd_context", CryptContext(
+        schemes=["sha256_crypt"], sha256_crypt__default_rounds=2000, sha256_crypt__min_rounds=2000
+    ))
+    db = Session()
+    old_hash = db.query(UserDB).one().password
+    assert client.post("/login", json=credentials).status_code == 200
+    db.expire_all()
+    new_hash = db.query(UserDB).one().password
+    db.close()
+    assert new_hash != old_hash and "rounds=2000" in new_hash
+
+    monkeypatch.setattr(auth, "PASSWORD_QUEUE_LIMIT", 0)
+    shed = client.post("/login", json=credentials)
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == str(auth.PASSWORD_RETRY_AFTER)
+
+def test_pgn_import_parse_and_resume(tmp_path):
+    from app.pgn_import import iter_games, parse_game
+
+    pgn = tmp_path / "games.pgn"
+    pgn.write_text(
+        '[White "alice"]\n[Black "bob"]\n[Result "1-0"]\n[TimeControl "180+2"]\n\n'
+        '1. e4 e5 2. Bc4 Nc6 3. Qh5 Nf6 4. Qxf7# 1-0\n\n'
+        '[White "carol"]\n[Black "dave"]\n[Result "0-1"]\n\n1. e4 Ke7 2. Ke2 Kf6 0-1\n\n'
+        '[White "erin"]\n[Black "frank"]\n[Result "*"]\n\n1. d4 *\n'
+    )
+    games = list(iter_games(str(pgn)))
+    assert len(games) == 3
+
+    mate = parse_game(games[0][0])
+    assert mate["status"] == "checkmate"
+    assert mate["winner"] == "alice"
+    assert mate["moves"] == ["e4", "e5", "Bc4", "Nc6", "Qh5", "Nf6", "Qxf7"]
+    assert (mate["total_time"], mate["increment"]) == (180, 2)
+    assert mate["game_id"] == parse_game(games[0][0])["game_id"]
+
+    assert parse_game(games[1][0]) is None  # Illegal move
+    assert parse_game(games[2][0]) is None  # Unfinished
+
+    # Resuming from a checkpointed offset picks up at the next game
+    resumed = list(iter_games(str(pgn), games[0][1]))
+    assert [text for text, _ in resumed] == [text for text, _ in games[1:]]
+
+def test_log_context_sampling_and_dropping():
+    import logging
+    import queue
+    from app.log import ContextFilter, DroppingQueueHandler, LOG_RECORDS_DROPPED, game_id_var
+
+    def record(name, level=logging.INFO, game_id=None):
+        record = logging.LogRecord(name, level, __file__, 1, "message", None, None)
+        if game_id:
+            record.game_id = game_id
+        return record
+
+    log_filter = ContextFilter({"app.chatty": 0.5})
+    token = game_id_var.set("game-1")
+    try:
+        stamped = record("app.quiet")
+        assert log_filter.filter(stamped) and stamped.game_id == "game-1"
+    finally:
+        game_id_var.reset(token)
+
+    # Whole games are kept or dropped, for every logger under the sampled one
+    kept = [f"game{i}" for i in range(1000) if log_filter.filter(record("app.chatty", game_id=f"game{i}"))]
+    assert 400 < len(kept) < 600
+    assert all(log_filter.filter(record("app.chatty.sub", logging.DEBUG, game_id)) for game_id in kept)
+    assert all(log_filter.filter(record("app.chatty", logging.WARNING, f"game{i}")) for i in range(100))
+
+    handler = DroppingQueueHandler(queue.Queue(1))
+    dropped = LOG_RECORDS_DROPPED.value
+    handler.handle(record("app.quiet"))
+    handler.handle(record("app.quiet"))
+    assert handler.queue.qsize() == 1 and LOG_RECORDS_DROPPED.value == dropped + 1
+
+@pytest.mark.asyncio
+async def test_loop_watchdog_and_profiler(caplog):
+    import threading
+    from app.watchdog import LOOP_STALL_SECONDS, LoopWatchdog, handling, sample_stacks
+
+    def blocking_search():
+        time_module.sleep(0.3)
+
+    watchdog = LoopWatchdog(threshold=0.1, interval=0.01)
+    watchdog.start()
+    stalls = sum(LOOP_STALL_SECONDS.labels("MOVE").counts)
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level("WARNING", logger="app.watchdog"):
+            with handling("MOVE", "game-1"):
+                blocking_search()
+            await asyncio.sleep(0.1)
+    finally:
+        watchdog.stop()
+    assert sum(LOOP_STALL_SECONDS.labels("MOVE").counts) == stalls + 1
+    assert LOOP_STALL_SECONDS.labels("MOVE").sum >= 0.2
+    [record] = [record for record in caplog.records if "blocked" in record.getMessage()]
+    assert "handling MOVE" in record.getMessage() and "blocking_search" in record.getMessage()
+    assert record.game_id == "game-1"
+
+    # The profiler samples the loop thread from another thread, rooted at the event being handled
+    loop = asyncio.get_running_loop()
+    profile = asyncio.create_task(asyncio.to_thread(sample_stacks, 0.2, 0.005, loop, threading.get_ident()))
+    await asyncio.sleep(0.02)
+    with handling("MOVE"):
+        blocking_search()
+    samples = await profile
+    assert any(stack.split(";")[1] == "MOVE" and "blocking_search" in stack for stack in samples)
+
+@pytest.mark.asyncio
+async def test_only_players_resume_a_snapshot():
+    from app.connection_handlers import handle_reconnect
+
+    snapshot = {"game_id": "g", "player1": "a", "player2": "b", "status": "ongoing"}
+    snapshots = Mock(load=Mock(return_value=snapshot))
+    lobby = Mock(take_over_game=AsyncMock())
+    websocket = AsyncMock()
+    active_games = {}
+    event = Event(event="RECONNECT", data={"game_id": "g", "player_name": "mallory"})
+
+    await handle_reconnect(websocket, event, active_games, lobby, snapshots)
+
+    lobby.take_over_game.assert_not_awaited()
+    assert active_games == {}
+    assert websocket.send_json.await_args.args[0]["data"]["message"] == "Game not found!"
+
+@pytest.mark.asyncio
+async def test_premoves():
+    from app.game_handlers import handle_cancel_premove, handle_move, handle_premove
+    from app.persistence import game_writer
+
+    class SlowEngine(StubEngine):
+        def analyse(self, *args, **kwargs):
+            time_module.sleep(0.05)
+            return super().analyse(*args, **kwargs)
+
+        def play(self, *args, **kwargs):
+            time_module.sleep(0.05)
+            return super().play(*args, **kwargs)
+
+    game = Game(game_id="premoves", engines=EnginePool(size=1, factory=SlowEngine))
+    game.start("white", "black")
+    game.current_turn = "white"
+    clock = TimeControl(total_time=60, increment=0, game=game, game_id=game.id)
+    clock.player1, clock.player2, clock.current_player = "white", "black", "white"
+    clock.last_move_time = time_module.time() - 5
+    clock.timer_active = True
+    white, black = AsyncMock(spec=WebSocket), AsyncMock(spec=WebSocket)
+    active_games = {game.id: {"players": {"white": {"websocket": white, "time": clock}, "black": {"websocket": black, "time": clock}}, "game": game}}
+
+    def event(name, move=None):
+        return Event(event=name, data={"game_id": game.id, "move": move})
+
+    def sent(socket):
+        messages = [call.args[0] for call in socket.send_json.call_args_list]
+        socket.send_json.reset_mock()
+        return [(message["event"], message["data"].get("move")) for message in messages]
+
+    with patch.object(game_writer, "start"):
+        await handle_premove(black, event("PREMOVE", "e2e4"), active_games)  # Not black's piece
+        await handle_premove(black, event("PREMOVE", "e7e5"), active_games)
+        assert sent(black) == [("ERROR", None), ("PREMOVE_SET", "e7e5")]
+
+        # The premove is played and broadcast in the same pass as white's move, before any engine work
+        await handle_move(white, event("MOVE", "e4"), active_games)
+        assert sent(white) == sent(black) == [("MOVE", "e4"), ("MOVE", "e5")]
+        assert game.moves == ["e4", "e5"] and game.current_turn == "white"
+        assert clock.player1_time < 56 and 60 - clock.player2_time < 0.005
+
+        await handle_premove(black, event("PREMOVE", "d8h4"), active_games)
+        await handle_cancel_premove(black, event("CANCEL_PREMOVE"), active_games)
+        await handle_move(white, event("MOVE", "Nf3"), active_games)
+        assert sent(black) == [("PREMOVE_SET", "d8h4"), ("PREMOVE_CANCELLED", "d8h4"), ("MOVE", "Nf3")]
+        await handle_move(black, event("MOVE", "Nc6"), active_games)
+
+        # Dropped when the opponent's move makes it illegal
+        await handle_premove(black, event("PREMOVE", "e5d4"), active_games)
+        await handle_move(white, event("MOVE", "Nc3"), active_games)
+        assert sent(black)[-2:] == [("MOVE", "Nc3"), ("PREMOVE_CANCELLED", "e5d4")]
+        assert game.current_turn == "black" and "premove" not in active_games[game.id]["players"]["black"]
+    game_writer.queue.queue.clear()
+    game.engines.close()
+
+@pytest.mark.asyncio
+async def test_multiplexed_connection():
+    from app.connection_handlers import handle_disconnect
+    from app.log import game_id_var
+    from app.multiplex import Connection
+
+    written = []
+    client_reading = asyncio.Event()
+
+    async def send_json(message):
+        await client_reading.wait()
+        written.append((message["data"].get("game_id"), message["event"]))
+
+    socket = Mock(send_json=send_json)
+    slow_game_moves = asyncio.Event()
+    handled = []
+
+    async def handler(websocket, event):
+        game_id_var.set(event.data["game_id"])
+        if event.data["game_id"] == "slow":
+            await slow_game_moves.wait()
+        handled.append((event.data["game_id"], event.data["move"]))
+        await websocket.send_json({"event": "MOVE", "data": {"game_id": event.data["game_id"]}})
+
+    connection = Connection(socket, handler)
+    # A slow game holds up neither the other games nor the order of its own events
+    for game_id, move in (("slow", "e4"), ("a", "d4"), ("slow", "Nf3"), ("a", "c4"), ("b", "g3")):
+        await connection.route(Event(event="MOVE", data={"game_id": game_id, "move": move}))
+    await asyncio.sleep(0.01)
+    assert handled == [("a", "d4"), ("a", "c4"), ("b", "g3")]
+    slow_game_moves.set()
+    await asyncio.sleep(0.01)
+    assert handled[3:] == [("slow", "e4"), ("slow", "Nf3")]
+
+    client_reading.set()
+    await asyncio.sleep(0.01)
+    assert sorted(written) == [("a", "MOVE")] * 2 + [("b", "MOVE")] + [("slow", "MOVE")] * 2
+
+    # Games take turns on the socket
+    client_reading.clear()
+    written.clear()
+    for game_id in ("a", "a", "a", "b"):
+        game_id_var.set(game_id)
+        await connection.send_json({"event": "MOVE", "data": {"game_id": game_id}})
+    client_reading.set()
+    await asyncio.sleep(0.01)
+    assert written == [("a", "MOVE"), ("b", "MOVE"), ("a", "MOVE"), ("a", "MOVE")]
+
+    # A game the client stops reading is told to resync instead of queueing without bound
+    client_reading.clear()
+    written.clear()
+    with patch("app.multiplex.OUTBOX_LIMIT", 2):
+        await connection.send_json({"event": "WAITING", "data": {}})
+        game_id_var.set("a")
+        for _ in range(5):
+            await connection.send_json({"event": "MOVE", "data": {}})
+        game_id_var.set(None)
+    client_reading.set()
+    await asyncio.sleep(0.01)
+    assert written == [(None, "WAITING"), ("a", "RESYNC")]
+    await connection.route(Event(event="RECONNECT", data={"game_id": "a", "move": None}))
+    await asyncio.sleep(0.01)
+    assert written[-1] == ("a", "MOVE")
+    await connection.close()
+
+    # A closed connection leaves every game it played, not just the first
+    opponents = {name: AsyncMock(spec=WebSocket) for name in ("x", "y")}
+    active_games = {
+        game_id: {"game": Mock(), "players": {"me": {"websocket": socket}, name: {"websocket": opponents[name]}}}
+        for game_id, name in (("g1", "x"), ("g2", "y"))
+    }
+    with patch("app.connection_handlers.handle_disconnect_timeout", AsyncMock()) as timeout:
+        await handle_disconnect(socket, active_games)
+        await asyncio.sleep(0)
+    assert all(opponent.send_json.call_args.args[0]["event"] == "OPPONENT_DISCONNECTED" for opponent in opponents.values())
+    assert sorted(call.args[0] for call in timeout.call_args_list) == ["g1", "g2"]
+    assert active_games["g2"]["game"].disconnected_player == "me"
+
 @pytest.mark.asyncio
 async def test_websocket_endpoint():
     from Backend.app.main import app
@@ -198,8 +1097,154 @@ async def test_websocket_endpoint():
         assert "300s + 2s increment" in response["data"]["message"]
         assert "players in queue" in response["data"]["message"]
 
+@pytest.mark.asyncio
+async def test_bot_game_and_fair_scheduling():
+    import threading
+    from app.game_handlers import handle_init_game, handle_move
+    from app.persistence import game_writer
+
+    class Recorder:
+        def __init__(self):
+            self.order = []
+            self.gate = threading.Event()
+
+        def record(self, tag):
+            self.gate.wait(5)
+            self.order.append(tag)
+
+        def quit(self):
+            pass
+
+    # While the only engine is busy, a flow of weight 4 queued last overtakes a backlogged flow of weight 1
+    recorder = Recorder()
+    pool = EnginePool(size=1, factory=lambda: recorder)
+    first = asyncio.create_task(pool.run("record", "first"))
+    await asyncio.sleep(0.05)
+    queued = [asyncio.create_task(pool.run("record", f"bot{i}", flow="bot", weight=1)) for i in range(3)]
+    queued += [asyncio.create_task(pool.run("record", f"live{i}", flow="live", weight=4)) for i in range(2)]
+    await asyncio.sleep(0.05)
+    recorder.gate.set()
+    await asyncio.gather(first, *queued)
+    assert recorder.order == ["first", "live0", "live1", "bot0", "bot1", "bot2"]
+    pool.close()
+
+    engines = EnginePool(size=1, factory=StubEngine)
+    player = AsyncMock(spec=WebSocket)
+    active_games = {}
+
+    def init(bot):
+        data = {"player_name": "alice", "total_time": 60, "increment": 0, "bot": bot, "color": "black"}
+        return Event(event="INIT_GAME", data=data)
+
+    with patch("app.Game.engine_pool", engines), patch.object(game_writer, "start"):
+        await handle_init_game(player, init({"skill": 30}), AsyncMock(), active_games)
+        assert player.send_json.call_args.args[0]["event"] == "ERROR" and not active_games
+
+        # The bot has white, moves at once and answers every move
+        await handle_init_game(player, init({"skill": 3}), AsyncMock(), active_games)
+        game_id, game_data = next(iter(active_games.items()))
+        bot = game_data["players"]["Stockfish level 3"]["websocket"]
+        await bot.task
+        await handle_move(player, Event(event="MOVE", data={"game_id": game_id, "move": "e5"}), active_games)
+        await bot.task
+        game = game_data["game"]
+        assert game.moves[:2] == ["a3", "e5"] and len(game.moves) == 3 and game.current_turn == "alice"
+        events = [call.args[0]["event"] for call in player.send_json.call_args_list]
+        assert events == ["ERROR", "GAME_STARTED", "MOVE", "MOVE", "MOVE"]
+    game_data["players"]["alice"]["time"].timer_active = False
+    game_writer.queue.queue.clear()
+    engines.close()
+
+@pytest.mark.asyncio
+async def test_engine_priorities_and_preemption():
+    import threading
+    from app.engine_pool import BOT, DEADLINES, LIVE, OFFLINE, PV, DeadlineExceeded, QuotaExceeded
+
+    class Search:
+        """An offline analysis that runs until stopped the first time, and finishes at once after."""
+
+        def __init__(self, engine):
+            engine.searches += 1
+            self.engine = engine
+            self.first = engine.searches == 1
+            self.stopped = threading.Event()
+            self.info = {"depth": engine.searches}
+
+        def wait(self):
+            if self.first:
+                self.stopped.wait(5)
+            self.engine.log.append("offline stopped" if self.first else "offline")
+
+        def stop(self):
+            self.stopped.set()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    class Engine:
+        """Records the tag passed instead of a board; play() waits for the gate."""
+        options = {}
+
+        def __init__(self):
+            self.log = []
+            self.searches = 0
+            self.gate = threading.Event()
+
+        def analysis(self, tag, limit, **kwargs):
+            return Search(self)
+
+        def analyse(self, tag, limit, **kwargs):
+            self.log.append(tag)
+            return {"depth": 1}
+
+        def play(self, tag, limit, **kwargs):
+            self.gate.wait(5)
+            self.log.append(tag)
+
+        def quit(self):
+            pass
+
+    engine = Engine()
+    pool = EnginePool(size=1, factory=lambda: engine, quota=1.0)
+    limit = chess.engine.Limit(time=0.1)
+
+    # Waiting requests are served by class, not arrival; a live one gives up at its deadline
+    busy = asyncio.create_task(pool.run("play", "bot", limit, priority=BOT))
+    await asyncio.sleep(0.05)
+    with patch.dict(DEADLINES, {LIVE: 0.05}):
+        late = asyncio.create_task(pool.run("analyse", "late", limit, priority=LIVE))
+        await asyncio.sleep(0.1)
+    waiting = [
+        asyncio.create_task(pool.run(operation, tag, limit, priority=priority))
+        for operation, tag, priority in [("play", "bot2", BOT), ("analyse", "pv", PV), ("analyse", "live", LIVE)]
+    ]
+    await asyncio.sleep(0.05)
+    engine.gate.set()
+    await asyncio.gather(busy, *waiting)
+    with pytest.raises(DeadlineExceeded):
+        await late
+    assert engine.log == ["bot", "live", "pv", "bot2"]
+
+    # A live request stops a long offline search, which starts over once the engine is free
+    engine.log.clear()
+    offline = asyncio.create_task(pool.run("analyse", "offline", chess.engine.Limit(depth=30), priority=OFFLINE))
+    await asyncio.sleep(0.05)
+    assert await pool.run("analyse", "live", limit, priority=LIVE) == {"depth": 1}
+    assert await offline == {"depth": 2}
+    assert engine.log == ["offline stopped", "live", "offline"]
+
+    # Searches requested for a user count against their quota only
+    await pool.run("analyse", "mine", chess.engine.Limit(time=0.6), priority=OFFLINE, user="bob")
+    with pytest.raises(QuotaExceeded):
+        await pool.run("analyse", "more", chess.engine.Limit(time=0.6), priority=OFFLINE, user="bob")
+    await pool.run("analyse", "other", chess.engine.Limit(time=0.6), priority=OFFLINE, user="carol")
+    pool.close()
+
 def main():
     unittest.main()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
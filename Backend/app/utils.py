@@ -1,20 +1,44 @@
-import asyncio
-from sqlalchemy.orm import Session
-from app.model import GameDB
+from datetime import datetime
+from app.metrics import Histogram
+from app.persistence import game_writer
 
-def save_game(game_id: str, player1: str, player2: str, moves: list, winner: str, status: str, db_generator):
-    db = next(db_generator)
-    try:
-        new_game = GameDB(
-            game_id=game_id,
-            player1=player1,
-            player2=player2,
-            moves=moves,
-            winner=winner,
-            status=status
-        )
-        db.add(new_game)
-        db.commit()
-        db.refresh(new_game)
-    finally:
-        db.close()
\ No newline at end of file
+# Time save_game holds its caller (a handler or the clock thread); the write itself is game_writer_commit_seconds
+SAVE_GAME_SECONDS = Histogram("save_game_seconds", "Time save_game blocks its caller")
+
+def player_for(game_data: dict, websocket, on_turn: bool = True) -> str:
+    """
+    Name of the player a connection plays in a game, or None.
+
+    A multiplexed connection can hold both seats of a game; the seat on turn
+    is the one acting then, or the other one when `on_turn` is False.
+    """
+    seats = [name for name, details in game_data["players"].items() if details["websocket"] == websocket]
+    if len(seats) > 1:
+        turn = game_data["game"].current_turn
+        return next((name for name in seats if (name == turn) == on_turn), seats[0])
+    return seats[0] if seats else None
+
+def log_move(game_id: str, ply: int, move: str, clock_remaining: float):
+    """Append a move to the persistent move log; returns immediately."""
+    game_writer.submit_move({
+        "game_id": game_id,
+        "ply": ply,
+        "move": move,
+        "clock_remaining": clock_remaining,
+        "created_at": datetime.utcnow()
+    })
+
+def save_game(game_id: str, player1: str, player2: str, moves: list, winner: str, status: str, total_time: int = None, increment: int = None):
+    """Queue a finished game for the background writer; returns immediately."""
+    with SAVE_GAME_SECONDS.time():
+        game_writer.submit_game({
+            "game_id": game_id,
+            "player1": player1,
+            "player2": player2,
+            "moves": moves,
+            "winner": winner,
+            "status": status,
+            "ended_at": datetime.utcnow(),
+            "total_time": total_time,
+            "increment": increment
+        })
@@ -0,0 +1,165 @@
+"""
+Event loop stall detection and on-demand profiling.
+
+LoopWatchdog runs a heartbeat on the event loop and a thread watching it.
+When a heartbeat is STALL_THRESHOLD late, the thread logs the loop
+thread's stack and the websocket event being handled, once per stall. The
+stall's length is recorded per event once the loop comes back. This makes
+blocking calls hidden in async handlers visible: engine searches,
+password hashing and synchronous I/O.
+
+GET /debug/profile samples the worker's stacks for a few seconds. It
+returns them in collapsed format, ready for flamegraph.pl or speedscope.
+Event loop samples are rooted at the event being handled. The endpoint
+only exists when DEBUG_ENDPOINTS=1.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import Histogram
+
+STALL_THRESHOLD = float(os.getenv("STALL_THRESHOLD", "0.1"))  # Seconds the loop may be unresponsive
+HEARTBEAT_INTERVAL = 0.02
+DEBUG_ENDPOINTS = os.getenv("DEBUG_ENDPOINTS") == "1"
+MAX_PROFILE_SECONDS = 60
+
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late the event loop runs a callback scheduled for a fixed time")
+LOOP_STALL_SECONDS = Histogram(
+    "event_loop_stall_seconds", "Event loop stalls longer than the threshold, by the event being handled",
+    labelnames=("handler",)
+)
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/debug")
+
+running_handlers = {}  # asyncio task -> (event, game_id) it is handling
+profile_lock = threading.Lock()
+
+
+@contextmanager
+def handling(event: str, game_id: str = None):
+    """Attribute stalls and profile samples in the current task to this event."""
+    task = asyncio.current_task()
+    previous = running_handlers.get(task)
+    running_handlers[task] = (event, game_id)
+    try:
+        yield
+    finally:
+        if previous:
+            running_handlers[task] = previous
+        else:
+            running_handlers.pop(task, None)
+
+
+def current_handler(loop) -> tuple:
+    """(event, game_id) being handled on `loop` right now; callable from any thread."""
+    task = asyncio.current_task(loop)
+    return running_handlers.get(task, ("other", None))
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = STALL_THRESHOLD, interval: float = HEARTBEAT_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.loop_thread = None
+        self.last_beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._task = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            scheduled = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            LOOP_LAG_SECONDS.observe(max(0.0, now - scheduled))
+            self.last_beat = now
+
+    def _watch(self):
+        stall = None  # (last beat before the stall, event) while one is in progress
+        while not self._stopped.wait(self.threshold / 4):
+            beat = self.last_beat
+            if stall and beat != stall[0]:
+                # The loop is back; the stall lasted from the missed beat to this one
+                LOOP_STALL_SECONDS.labels(stall[1]).observe(max(0.0, beat - stall[0] - self.interval))
+                stall = None
+            late = time.monotonic() - beat - self.interval
+            if stall is None and late >= self.threshold:
+                event, game_id = current_handler(self.loop)
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                logger.warning(
+                    "Event loop blocked for %.0fms handling %s:\n%s", late * 1000, event, stack,
+                    extra={"game_id": game_id}
+                )
+                stall = (beat, event)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    path = "/".join(code.co_filename.replace("\\", "/").split("/")[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float, loop, loop_thread: int, all_threads: bool = False) -> Counter:
+    """Collapsed stack -> samples, sampling the loop thread (or every thread) every `interval` seconds."""
+    samples = Counter()
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_thread or (ident != loop_thread and not all_threads):
+                continue
+            stack = []
+            while frame:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            root = [names.get(ident, str(ident))]
+            if ident == loop_thread:
+                root.append(current_handler(loop)[0])
+            samples[";".join(root + stack[::-1])] += 1
+        time.sleep(interval)
+    return samples
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile(
+    seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS),
+    interval: float = Query(0.005, ge=0.001, le=1),
+    all_threads: bool = False
+):
+    """Sample this worker and return collapsed stacks (`frame;frame;... count` per line)."""
+    if not DEBUG_ENDPOINTS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        samples = await asyncio.to_thread(
+            sample_stacks, seconds, interval, asyncio.get_running_loop(), threading.get_ident(), all_threads
+        )
+    finally:
+        profile_lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
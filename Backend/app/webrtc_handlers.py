@@ -1,4 +1,5 @@
 from fastapi import WebSocket
+from app.utils import player_for
 
 
 async def handle_offer(websocket: WebSocket, event, active_games):
@@ -22,11 +23,7 @@ async def handle_offer(websocket: WebSocket, event, active_games):
     players = game_data["players"]
     
     # Find the player who sent the offer
-    player_name = None
-    for name, details in players.items():
-        if details["websocket"] == websocket:
-            player_name = name
-            break
+    player_name = player_for(game_data, websocket)
     
     if not player_name:
         await websocket.send_json({
@@ -78,11 +75,7 @@ async def handle_answer(websocket: WebSocket, event, active_games):
     players = game_data["players"]
     
     # Find the player who sent the answer
-    player_name = None
-    for name, details in players.items():
-        if details["websocket"] == websocket:
-            player_name = name
-            break
+    player_name = player_for(game_data, websocket)
     
     if not player_name:
         await websocket.send_json({
@@ -134,11 +127,7 @@ async def handle_ice_candidate(websocket: WebSocket, event, active_games):
     players = game_data["players"]
     
     # Find the player who sent the ICE candidate
-    player_name = None
-    for name, details in players.items():
-        if details["websocket"] == websocket:
-            player_name = name
-            break
+    player_name = player_for(game_data, websocket)
     
     if not player_name:
         await websocket.send_json({
@@ -1,49 +1,111 @@
+import logging
+from uuid import uuid4
 from fastapi import WebSocket, WebSocketDisconnect
-from app.game_handlers import handle_init_game, handle_join_game, handle_create_game, handle_move
+from app.game_handlers import (
+    handle_init_game, handle_join_game, handle_create_game, handle_move, handle_premove, handle_cancel_premove
+)
 from app.connection_handlers import handle_reconnect, handle_disconnect
 from app.webrtc_handlers import handle_offer, handle_answer, handle_ice_candidate
+from app.auth import authenticate_websocket
+from app.log import connection_id_var, game_id_var
+from app.metrics import Histogram, timed_send
 from app.model import Event
+from app.multiplex import Connection
+from app.watchdog import handling
+
+# Events that act on an existing game and must run on the worker hosting it
+GAME_EVENTS = {"RECONNECT", "OFFER", "ANSWER", "ICE_CANDIDATE", "MOVE", "PREMOVE", "CANCEL_PREMOVE"}
+# Events whose player_name is replaced by the verified user on authenticated connections
+PLAYER_EVENTS = {"INIT_GAME", "JOIN_GAME", "CREATE_GAME", "RECONNECT"}
+
+WEBSOCKET_SEND_SECONDS = Histogram("websocket_send_seconds", "Time to hand one message to a player's websocket")
+
+logger = logging.getLogger(__name__)
+
+async def handle_event(websocket, event, app, forwarded=False):
+    """Run the handler for an event, forwarding game events to the worker that owns the game."""
+    game_id_var.set(event.data.get("game_id"))
+    # Event loop stalls and profile samples are attributed to the event
+    with handling(event.event, event.data.get("game_id")):
+        await dispatch_event(websocket, event, app, forwarded)
+
+async def dispatch_event(websocket, event, app, forwarded):
+    lobby = app.state.lobby
+    active_games = app.state.active_games
+
+    if event.event in GAME_EVENTS and not forwarded:
+        game_id = event.data.get("game_id")
+        if game_id and game_id not in active_games:
+            owner = await lobby.game_owner(game_id)
+            if owner and owner != lobby.worker_id:
+                await lobby.forward_event(owner, websocket, event)
+                return
+
+    if event.event == "INIT_GAME":
+        await handle_init_game(websocket, event, lobby, active_games)
+
+    elif event.event == "JOIN_GAME":
+        await handle_join_game(websocket, event, lobby, active_games)
+
+    elif event.event == "CREATE_GAME":
+        await handle_create_game(websocket, event, lobby, active_games)
+
+    elif event.event == "RECONNECT":
+        await handle_reconnect(websocket, event, active_games, lobby, app.state.snapshots)
+
+    elif event.event == "OFFER":
+        await handle_offer(websocket, event, active_games)
+
+    elif event.event == "ANSWER":
+        await handle_answer(websocket, event, active_games)
+
+    elif event.event == "ICE_CANDIDATE":
+        await handle_ice_candidate(websocket, event, active_games)
+
+    elif event.event == "MOVE":
+        await handle_move(websocket, event, active_games)
+
+    elif event.event == "PREMOVE":
+        await handle_premove(websocket, event, active_games)
+
+    elif event.event == "CANCEL_PREMOVE":
+        await handle_cancel_premove(websocket, event, active_games)
+
+    elif event.event == "DISCONNECT" and forwarded:
+        # A player of one of our games dropped off another worker
+        await handle_disconnect(websocket, active_games)
 
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket entry point for handling events."""
     
     app = websocket.app
-    waiting_users = app.state.waiting_users
-    active_games = app.state.active_games
-    joining_games = app.state.joining_games
+    lobby = app.state.lobby
 
+    connection_id_var.set(uuid4().hex[:12])
+    if not await authenticate_websocket(websocket):
+        return
     await websocket.accept()
+    websocket.send_json = timed_send(WEBSOCKET_SEND_SECONDS, websocket.send_json)
+    lobby.register(websocket)
+    user = websocket.state.user
+    # Any number of games share the connection, each with its own event task and send queue
+    connection = Connection(websocket, lambda websocket, event: handle_event(websocket, event, app))
 
     try:
         while True:
             data = await websocket.receive_json()
             event = Event(**data)
 
-            print(f"Received event: {event.event}")
-
-            if event.event == "INIT_GAME":
-                await handle_init_game(websocket, event, waiting_users, active_games)
-
-            elif event.event == "JOIN_GAME":
-                await handle_join_game(websocket, event, joining_games, active_games)
-
-            elif event.event == "CREATE_GAME":
-                await handle_create_game(websocket, event, joining_games)
-
-            elif event.event == "RECONNECT":
-                await handle_reconnect(websocket, event, active_games)
-
-            elif event.event == "OFFER":
-                await handle_offer(websocket, event, active_games)
-
-            elif event.event == "ANSWER":
-                await handle_answer(websocket, event, active_games)
+            logger.debug("Received event %s", event.event)
 
-            elif event.event == "ICE_CANDIDATE":
-                await handle_ice_candidate(websocket, event, active_games)
+            if user and event.event in PLAYER_EVENTS:
+                # Verified once at handshake; never trust the name in the payload
+                event.data["player_name"] = user
 
-            elif event.event == "MOVE":
-                await handle_move(websocket, event, active_games)
+            await connection.route(event)
 
     except WebSocketDisconnect:
-        await handle_disconnect(websocket, waiting_users, active_games)
+        with handling("DISCONNECT"):
+            await connection.close()
+            await lobby.disconnect(websocket)
+            await handle_disconnect(websocket, app.state.active_games)
@@ -0,0 +1,149 @@
+"""
+Micro-benchmarks of the per-move hot paths, using pytest-benchmark.
+
+The engine is benchmarks/stub_engine.py's in-process StubEngine, so these
+time the server's own work around the engine and not the search. Results
+are saved under .benchmarks/ per commit and compared against the last
+saved run; the compare step fails on regressions:
+
+    pytest benchmarks/bench_hot_paths.py --benchmark-autosave
+    pytest benchmarks/bench_hot_paths.py --benchmark-autosave --benchmark-compare --benchmark-compare-fail=median:20%
+
+The file is not named test_*.py so the regular test run skips it.
+"""
+import asyncio
+import json
+import time
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from fastapi import WebSocket
+
+from app.Game import Game
+from app.engine_pool import EnginePool
+from app.TimeControl import TimeControl
+from app.game_handlers import handle_move
+from app.model import Event
+from app.persistence import game_writer
+from benchmarks.stub_engine import StubEngine
+
+# Morphy's Opera Game: castling, captures, checks and a mate in 33 plies
+OPERA_GAME = [
+    "e4", "e5", "Nf3", "d6", "d4", "Bg4", "dxe5", "Bxf3", "Qxf3", "dxe5", "Bc4", "Nf6", "Qb3", "Qe7",
+    "Nc3", "c6", "Bg5", "b5", "Nxb5", "cxb5", "Bxb5+", "Nbd7", "O-O-O", "Rd8", "Rxd7", "Rxd7", "Rd1", "Qe6",
+    "Bxd7+", "Nxd7", "Qb8+", "Nxb8", "Rd8#"
+]
+MIDDLEGAME_PLIES = 20
+BACKGROUND_GAMES = 10_000  # Other games hosted by the worker while a move is handled
+
+
+@pytest.fixture(scope="module")
+def game():
+    game = Game(game_id="bench", engines=EnginePool(size=1, factory=StubEngine))
+    game.start("white", "black")
+    return game
+
+
+def play(game, moves):
+    game.start("white", "black")
+    for move in moves:
+        game.move(move)
+
+
+def test_validate_and_move(benchmark, game):
+    def replay():
+        game.start("white", "black")
+        for move in OPERA_GAME:
+            if game.isValidMove(move):
+                game.move(move)
+
+    benchmark(replay)
+    assert game.moves == OPERA_GAME
+
+
+def test_update_status(benchmark, game):
+    play(game, OPERA_GAME[:MIDDLEGAME_PLIES])
+    benchmark(game.update_status)
+    assert game.get_status() == "ongoing"
+
+
+def test_winning_chances(benchmark, game):
+    chances = benchmark(game.get_winning_chances, 1.5)
+    assert chances["white"] + chances["black"] == pytest.approx(100)
+
+
+def test_process_move(benchmark):
+    clock = TimeControl(total_time=300, increment=2)
+    clock.player1, clock.player2, clock.current_player = "white", "black", "white"
+    clock.last_move_time = time.time()
+
+    times = benchmark(lambda: clock.process_move(clock.current_player))
+    assert set(times) == {"white", "black"}
+
+
+@pytest.fixture
+def hosted_game(game):
+    """The benchmark game hosted among many others, with clocks running but no timer thread."""
+    sockets = {"white": AsyncMock(spec=WebSocket), "black": AsyncMock(spec=WebSocket)}
+    clock = TimeControl(total_time=300, increment=2, game=game, game_id=game.id)
+    clock.player1, clock.player2, clock.current_player = "white", "black", "white"
+    clock.last_move_time = time.time()
+    clock.timer_active = True
+    active_games = {f"other{i}": {"players": {}, "game": None} for i in range(BACKGROUND_GAMES)}
+    active_games[game.id] = {
+        "players": {name: {"websocket": socket, "time": clock} for name, socket in sockets.items()},
+        "game": game
+    }
+    # Move log rows are queued as in production, but nothing writes them out
+    with patch.object(game_writer, "start"):
+        yield active_games, sockets
+    game_writer.queue.queue.clear()
+
+
+def test_handle_move(benchmark, game, hosted_game):
+    active_games, sockets = hosted_game
+    loop = asyncio.new_event_loop()
+    move = OPERA_GAME[MIDDLEGAME_PLIES]
+    event = Event(event="MOVE", data={"game_id": game.id, "move": move})
+
+    def setup():
+        play(game, OPERA_GAME[:MIDDLEGAME_PLIES])
+        game.current_turn = "white"
+
+    benchmark.pedantic(lambda: loop.run_until_complete(handle_move(sockets["white"], event, active_games)),
+                       setup=setup, rounds=500)
+    loop.close()
+    assert sockets["black"].send_json.call_args.args[0]["data"]["move"] == move
+
+
+def test_handle_move_rejected(benchmark, game, hosted_game):
+    """Session lookup and turn check only: the sender is not on move."""
+    active_games, sockets = hosted_game
+    loop = asyncio.new_event_loop()
+    play(game, OPERA_GAME[:MIDDLEGAME_PLIES])
+    game.current_turn = "white"
+    event = Event(event="MOVE", data={"game_id": game.id, "move": "e5"})
+
+    benchmark(lambda: loop.run_until_complete(handle_move(sockets["black"], event, active_games)))
+    loop.close()
+    assert sockets["black"].send_json.call_args.args[0]["event"] == "ERROR"
+
+
+def test_decode_event(benchmark):
+    # As websocket.receive_json followed by Event(**data)
+    text = json.dumps({"event": "MOVE", "data": {"game_id": "0" * 32, "move": "Nxe5"}})
+    event = benchmark(lambda: Event(**json.loads(text)))
+    assert event.data["move"] == "Nxe5"
+
+
+def test_encode_move_response(benchmark):
+    # As websocket.send_json
+    response = {
+        "event": "MOVE",
+        "data": {"move": "Nxe5", "turn": "black", "game_id": "0" * 32},
+        "winning_chance": {"white": 61.54, "black": 38.46},
+        "suggest": "d7d6",
+        "time": {"white": 287.13, "black": 296.4}
+    }
+    text = benchmark(json.dumps, response, separators=(",", ":"), ensure_ascii=False)
+    assert json.loads(text) == response
@@ -0,0 +1,109 @@
+"""
+Benchmark the game history query against a large games table.
+
+Seeds DATABASE_URL with --games synthetic finished games (10M by default,
+skipped if the table already holds that many) spread over --players users
+with a skewed distribution, so some users have very long histories. It then
+times the first page and deep keyset pages for the heaviest users.
+
+    python -m benchmarks.game_history --games 10000000 --players 100000
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+from app.game_route import encode_cursor, user_games_query
+from app.model import Base, GameDB
+from db.db import SessionLocal, engine
+
+STATUSES = ["checkmate", "timeout", "Disconnect", "stalemate", "draw"]
+TIME_CONTROLS = [(60, 0), (180, 2), (300, 0), (600, 10)]
+SEED_BATCH = 50_000
+
+
+def player_name(index: int) -> str:
+    return f"player{index}"
+
+
+def seed(total: int, players: int):
+    db = SessionLocal()
+    existing = db.execute(select(func.count()).select_from(GameDB)).scalar()
+    if existing >= total:
+        print(f"Table already holds {existing} games, skipping seeding")
+        db.close()
+        return
+
+    rng = random.Random(42)
+    start = datetime(2020, 1, 1)
+    seeded = existing
+    started = time.perf_counter()
+    while seeded < total:
+        rows = []
+        for i in range(seeded, min(seeded + SEED_BATCH, total)):
+            # Pareto-ish skew: low player numbers play far more games
+            white = player_name(int(players * rng.random() ** 3))
+            black = player_name(rng.randrange(players))
+            total_time, increment = rng.choice(TIME_CONTROLS)
+            rows.append({
+                "game_id": f"bench{i:010d}",
+                "player1": white,
+                "player2": black,
+                "status": rng.choice(STATUSES),
+                "winner": rng.choice((white, black)),
+                "moves": [],
+                "ended_at": start + timedelta(seconds=i * 7),
+                "total_time": total_time,
+                "increment": increment,
+            })
+        db.execute(insert(GameDB), rows)
+        db.commit()
+        seeded += len(rows)
+        rate = (seeded - existing) / (time.perf_counter() - started)
+        print(f"Seeded {seeded}/{total} games ({rate:.0f} games/sec)")
+    db.close()
+
+
+def time_pages(username: str, pages: int, limit: int, **filters):
+    """Walk `pages` pages of a user's history; returns per-page latencies in ms."""
+    db = SessionLocal()
+    cursor = None
+    latencies = []
+    for _ in range(pages):
+        started = time.perf_counter()
+        games = db.execute(user_games_query(username, limit, cursor, **filters)).all()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if len(games) < limit:
+            break
+        cursor = encode_cursor(games[-1].ended_at, games[-1].game_id)
+    db.close()
+    return latencies
+
+
+def report(label: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{label:<32} pages={len(latencies):<5} p50={statistics.median(latencies):7.2f}ms p99={p99:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=10_000_000)
+    parser.add_argument("--players", type=int, default=100_000)
+    parser.add_argument("--pages", type=int, default=200, help="Pages walked per user")
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    seed(args.games, args.players)
+
+    for username in (player_name(0), player_name(1), player_name(args.players // 2)):
+        report(f"{username} all", time_pages(username, args.pages, args.limit))
+        report(f"{username} wins 600+10", time_pages(username, args.pages, args.limit, result="win", time_control="600+10"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+End-to-end load test of the game websocket.
+
+Starts the app under uvicorn with benchmarks/stub_engine.py as its engine
+(or targets a running server with --url), then drives --players simulated
+players through /ws: they pair up with INIT_GAME, replay games from a PGN
+corpus move by move, reconnect, in a storm at --storm-at seconds and at
+random with --reconnect-rate, and abandon games with --abandon-rate.
+
+Reports moves/sec, MOVE round-trip percentiles (from sending a move to
+receiving its MOVE broadcast) and the server's memory per active game,
+engine processes included. Runs with the same --seed, corpus and engine
+latency are comparable:
+
+    python -m benchmarks.load_test --players 200 --pgn games.pgn --engine-latency 0.02 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import zlib
+
+import chess
+import websockets
+
+from benchmarks.stub_engine import STUB_PATH
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIME_CONTROL = (3600, 0)  # Long enough that nobody flags during a run
+RANDOM_GAME_PLIES = 120
+
+
+class GameOver(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
+def load_corpus(paths: list, limit: int, seed: int) -> list:
+    """SAN move lists from PGN files, or seeded random legal games when no files are given."""
+    corpus = []
+    if paths:
+        # pgn_import binds a database engine on import; only its parser is used here
+        os.environ.setdefault("DATABASE_URL", "sqlite://")
+        from app.pgn_import import iter_games, parse_game
+    for path in paths:
+        for text, _ in iter_games(path):
+            game = parse_game(text)
+            if game and game["moves"]:
+                corpus.append(game["moves"])
+            if len(corpus) >= limit:
+                return corpus
+    if paths:
+        return corpus
+
+    rng = random.Random(seed)
+    for _ in range(limit):
+        board = chess.Board()
+        moves = []
+        while not board.is_game_over() and len(moves) < RANDOM_GAME_PLIES:
+            move = rng.choice(sorted(board.legal_moves, key=lambda move: move.uci()))
+            moves.append(board.san(move))
+            board.push(move)
+        corpus.append(moves)
+    return corpus
+
+
+def percentile_ms(seconds: list, fraction: float) -> float:
+    if not seconds:
+        return None
+    seconds = sorted(seconds)
+    return round(seconds[min(len(seconds) - 1, int(len(seconds) * fraction))] * 1000, 2)
+
+
+def tree_rss(pid: int) -> int:
+    """Resident memory in bytes of a process and all its descendants (Linux /proc)."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue  # Exited while we were looking
+    return total
+
+
+def active_games(metrics_url: str) -> int:
+    """The server's active_games gauge."""
+    with urllib.request.urlopen(metrics_url, timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("active_games "):
+                return int(float(line.split()[1]))
+    return 0
+
+
+class Results:
+    def __init__(self):
+        self.started = None
+        self.finished = None
+        self.move_seconds = []
+        self.reconnect_seconds = []
+        self.games_started = 0
+        self.games_finished = 0
+        self.abandoned = 0
+        self.errors = {}
+        self.baseline_rss = None
+        self.peak = None  # (active games, rss) when the most games were active
+
+    def error(self, error: Exception):
+        key = f"{type(error).__name__}: {error}"[:120]
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self) -> dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        summary = {
+            "elapsed_seconds": round(elapsed, 2),
+            "games_started": self.games_started,
+            "games_finished": self.games_finished,
+            "games_abandoned": self.abandoned,
+            "moves": len(self.move_seconds),
+            "moves_per_second": round(len(self.move_seconds) / elapsed, 1),
+            "move_p50_ms": percentile_ms(self.move_seconds, 0.5),
+            "move_p99_ms": percentile_ms(self.move_seconds, 0.99),
+            "reconnects": len(self.reconnect_seconds),
+            "reconnect_p50_ms": percentile_ms(self.reconnect_seconds, 0.5),
+            "reconnect_p99_ms": percentile_ms(self.reconnect_seconds, 0.99),
+            "errors": self.errors,
+        }
+        if self.peak and self.baseline_rss is not None:
+            games, rss = self.peak
+            summary["peak_active_games"] = games
+            summary["memory_per_game_mb"] = round((rss - self.baseline_rss) / max(games, 1) / 2 ** 20, 2)
+        return summary
+
+
+class Player:
+    def __init__(self, index: int, args, corpus: list, results: Results, storm: asyncio.Event):
+        self.name = f"load{index:05d}"
+        self.args = args
+        self.corpus = corpus
+        self.results = results
+        self.storm = storm
+        self.rng = random.Random(args.seed * 1_000_003 + index)
+        self.websocket = None
+        self.game_id = None
+        self.stormed = False
+
+    async def send(self, event: str, **data):
+        await self.websocket.send(json.dumps({"event": event, "data": data}))
+
+    async def expect(self, accept):
+        """Next message accepted by `accept`, skipping the rest; raises on GAME_OVER and ERROR."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.args.timeout
+        while True:
+            message = json.loads(await asyncio.wait_for(self.websocket.recv(), deadline - loop.time()))
+            if message["event"] == "GAME_OVER":
+                raise GameOver(message["data"].get("status"))
+            if message["event"] == "ERROR":
+                raise ServerError(message["data"].get("message"))
+            if accept(message):
+                return message
+
+    async def reconnect(self) -> int:
+        """Drop the connection and RECONNECT to the game; returns the ply the server is at."""
+        await self.websocket.close()
+        started = time.perf_counter()
+        self.websocket = await websockets.connect(self.args.url, max_size=None)
+        await self.send("RECONNECT", player_name=self.name, game_id=self.game_id)
+        state = await self.expect(lambda message: message["event"] == "GAME_STATE")
+        self.results.reconnect_seconds.append(time.perf_counter() - started)
+        return len(state["data"]["moves"])
+
+    async def play(self):
+        self.websocket = await websockets.connect(self.args.url, max_size=None)
+        try:
+            await self.send("INIT_GAME", player_name=self.name, total_time=TIME_CONTROL[0], increment=TIME_CONTROL[1])
+            started = await self.expect(lambda message: message["event"] == "GAME_STARTED")
+            self.game_id = started["data"]["game_id"]
+            white = started["turn"] == self.name
+            self.results.games_started += white  # Count each game once
+
+            # Both players derive the same game from the id
+            moves = self.corpus[zlib.crc32(self.game_id.encode()) % len(self.corpus)][:self.args.max_plies]
+            ply = 0
+            while ply < len(moves):
+                move = moves[ply]
+                if (ply % 2 == 0) == white:
+                    if self.rng.random() < self.args.abandon_rate:
+                        self.results.abandoned += 1
+                        return
+                    if (self.storm.is_set() and not self.stormed) or self.rng.random() < self.args.reconnect_rate:
+                        self.stormed = self.stormed or self.storm.is_set()
+                        ply = await self.reconnect()
+                        continue
+                    sent = time.perf_counter()
+                    await self.send("MOVE", game_id=self.game_id, move=move)
+                    await self.expect(lambda message: message["event"] == "MOVE" and message["data"]["move"] == move)
+                    self.results.move_seconds.append(time.perf_counter() - sent)
+                else:
+                    await self.expect(lambda message: message["event"] == "MOVE" and message["data"]["move"] == move)
+                ply += 1
+            self.results.games_finished += white
+        except GameOver:
+            self.results.games_finished += white
+        except (asyncio.TimeoutError, ServerError, websockets.ConnectionClosed, OSError) as e:
+            self.results.error(e)
+        finally:
+            await self.websocket.close()
+
+
+async def monitor(args, results: Results, server_pid: int, done: asyncio.Event):
+    """Sample the server's memory and active games until the run is over."""
+    metrics_url = args.url.replace("ws", "http", 1).rsplit("/ws", 1)[0] + "/metrics"
+    while not done.is_set():
+        games, rss = await asyncio.gather(
+            asyncio.to_thread(active_games, metrics_url),
+            asyncio.to_thread(tree_rss, server_pid)
+        )
+        if games and (results.peak is None or games >= results.peak[0]):
+            results.peak = (games, rss)
+        try:
+            await asyncio.wait_for(done.wait(), args.sample_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args, corpus: list, server_pid: int = None) -> Results:
+    results = Results()
+    storm = asyncio.Event()
+    done = asyncio.Event()
+    if server_pid:
+        results.baseline_rss = await asyncio.to_thread(tree_rss, server_pid)
+        sampler = asyncio.create_task(monitor(args, results, server_pid, done))
+
+    results.started = time.perf_counter()
+    players = [Player(index, args, corpus, results, storm) for index in range(args.players)]
+    tasks = []
+    for player in players:
+        tasks.append(asyncio.create_task(player.play()))
+        await asyncio.sleep(args.ramp_up / max(args.players, 1))
+    if args.storm_at is not None:
+        asyncio.get_running_loop().call_later(max(0, args.storm_at - (time.perf_counter() - results.started)), storm.set)
+    await asyncio.gather(*tasks)
+    results.finished = time.perf_counter()
+
+    done.set()
+    if server_pid:
+        await sampler
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, directory: str):
+    """Run the app under uvicorn with the stub engine and a throwaway SQLite database."""
+    port = free_port()
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(directory, 'load_test.db')}")
+    env.setdefault("SECRET_KEY", "load-test")
+    env.setdefault("ALGORITHM", "HS256")
+    env.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    env["SNAPSHOT_DIR"] = os.path.join(directory, "snapshots")
+    env["STOCKFISH_PATH"] = STUB_PATH
+    env["STUB_ENGINE_LATENCY"] = str(args.engine_latency)
+    log = open(args.server_log or os.devnull, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("Server failed to start, rerun with --server-log to see why")
+            time.sleep(0.2)
+    return process, f"ws://127.0.0.1:{port}/ws"
+
+
+def stop_server(process):
+    """Shutdown can hang on games still in progress, so fall back to killing the server."""
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="Websocket of a running server (default: start one with the stub engine)")
+    parser.add_argument("--server-pid", type=int, default=None, help="Process to measure memory of when using --url")
+    parser.add_argument("--players", type=int, default=100, help="Concurrent players, two per game")
+    parser.add_argument("--pgn", nargs="*", default=[], help="PGN corpus (default: seeded random games)")
+    parser.add_argument("--corpus-size", type=int, default=1000, help="Games taken from the corpus")
+    parser.add_argument("--max-plies", type=int, default=80, help="Half-moves played per game")
+    parser.add_argument("--engine-latency", type=float, default=0.01, help="Seconds per stub engine search")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which players connect")
+    parser.add_argument("--storm-at", type=float, default=None, help="Every player reconnects at its first turn after this many seconds")
+    parser.add_argument("--reconnect-rate", type=float, default=0.0, help="Chance a player reconnects before each of its moves")
+    parser.add_argument("--abandon-rate", type=float, default=0.0, help="Chance a player leaves its game for good before each of its moves")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for any expected message")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="Seconds between memory samples")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server-log", default=None, help="Write the started server's output here")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        server_pid = args.server_pid
+        if args.url is None:
+            # Started before the corpus is loaded so it does not inherit the parser's DATABASE_URL
+            server, args.url = start_server(args, directory)
+            server_pid = server.pid
+        try:
+            corpus = load_corpus(args.pgn, args.corpus_size, args.seed)
+            if not corpus:
+                raise SystemExit("No usable games in the corpus")
+            results = asyncio.run(run(args, corpus, server_pid))
+        finally:
+            if server:
+                stop_server(server)
+
+    summary = results.summary()
+    summary["config"] = {
+        key: getattr(args, key)
+        for key in ("players", "pgn", "corpus_size", "max_plies", "engine_latency", "storm_at", "reconnect_rate", "abandon_rate", "seed")
+    }
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
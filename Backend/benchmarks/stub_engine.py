@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for Stockfish, speaking just enough UCI for Game.
+
+Every search takes a fixed latency instead of the requested time limit, so
+load tests measure the server rather than the engine, and answers the same
+way for the same position: the legal move first in UCI order, scored by
+material from the side to move's point of view.
+
+    STOCKFISH_PATH=benchmarks/stub_engine.py STUB_ENGINE_LATENCY=0.02 uvicorn app.main:app
+
+StubEngine gives the same answers in process, without latency, for
+benchmarks of the code around the engine.
+"""
+import os
+import sys
+import time
+
+import chess
+import chess.engine
+
+STUB_PATH = os.path.abspath(__file__)
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+
+def material(board: chess.Board) -> int:
+    """Material balance in centipawns for the side to move."""
+    return sum(
+        PIECE_VALUES[piece.piece_type] * (1 if piece.color == board.turn else -1)
+        for piece in board.piece_map().values()
+    )
+
+
+def set_position(tokens: list) -> chess.Board:
+    """Board for the arguments of a `position` command."""
+    if tokens[0] == "fen":
+        end = tokens.index("moves") if "moves" in tokens else len(tokens)
+        board = chess.Board(" ".join(tokens[1:end]))
+    else:
+        board = chess.Board()
+    if "moves" in tokens:
+        for move in tokens[tokens.index("moves") + 1:]:
+            board.push_uci(move)
+    return board
+
+
+def best_move(board: chess.Board) -> chess.Move:
+    return min(board.legal_moves, key=lambda move: move.uci(), default=None)
+
+
+def search(board: chess.Board) -> list:
+    """Reply lines for a `go` command."""
+    best = best_move(board)
+    if best is None:
+        score = "mate 0" if board.is_checkmate() else "cp 0"
+        return [f"info depth 1 score {score}", "bestmove (none)"]
+    return [f"info depth 1 score cp {material(board)} pv {best.uci()}", f"bestmove {best.uci()}"]
+
+
+class StubAnalysis:
+    """A finished chess.engine.SimpleAnalysisResult."""
+
+    def __init__(self, lines: list):
+        self.multipv = lines
+        self.info = lines[0]
+
+    def wait(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class StubEngine:
+    """The subset of chess.engine.SimpleEngine that Game and the engine pool use."""
+
+    options = {}
+
+    def analyse(self, board: chess.Board, limit, multipv: int = None, **kwargs):
+        best = best_move(board)
+        if best is None:
+            score = chess.engine.Mate(0) if board.is_checkmate() else chess.engine.Cp(0)
+            info = {"depth": 1, "score": chess.engine.PovScore(score, board.turn), "pv": []}
+        else:
+            info = {"depth": 1, "score": chess.engine.PovScore(chess.engine.Cp(material(board)), board.turn), "pv": [best]}
+        return [info] if multipv else info  # A single line, however many are asked for
+
+    def analysis(self, board: chess.Board, limit, multipv: int = None, **kwargs) -> StubAnalysis:
+        if multipv:
+            return StubAnalysis(self.analyse(board, limit, multipv=multipv))
+        return StubAnalysis([self.analyse(board, limit)])
+
+    def play(self, board: chess.Board, limit, **kwargs) -> chess.engine.PlayResult:
+        return chess.engine.PlayResult(best_move(board), None)
+
+    def configure(self, options: dict):
+        pass
+
+    def quit(self):
+        pass
+
+
+def main():
+    latency = float(sys.argv[1] if len(sys.argv) > 1 else os.getenv("STUB_ENGINE_LATENCY", "0.01"))
+    board = chess.Board()
+
+    def reply(*lines):
+        sys.stdout.write("".join(f"{line}\n" for line in lines))
+        sys.stdout.flush()
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            reply(
+                "id name StubEngine", "id author benchmarks",
+                "option name MultiPV type spin default 1 min 1 max 500",
+                "option name Skill Level type spin default 20 min 0 max 20",
+                "option name UCI_LimitStrength type check default false",
+                "option name UCI_Elo type spin default 1320 min 1320 max 3190",
+                "uciok"
+            )
+        elif command == "isready":
+            reply("readyok")
+        elif command == "ucinewgame":
+            board = chess.Board()
+        elif command == "position" and len(tokens) > 1:
+            board = set_position(tokens[1:])
+        elif command == "go":
+            time.sleep(latency)
+            reply(*search(board))
+        elif command == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
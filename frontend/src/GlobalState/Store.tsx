@@ -1,5 +1,12 @@
 import { create  } from "zustand";
 
+// The server binds the connection to the logged-in user at handshake
+const socketUrl = () => {
+    const token = sessionStorage.getItem("token");
+    const url = import.meta.env.VITE_API_WEBSOCKET_URL;
+    return token ? `${url}${url.includes("?") ? "&" : "?"}token=${encodeURIComponent(token)}` : url;
+};
+
 interface GlobalState {
     socket: WebSocket | null;
     time: number | null;
@@ -31,7 +38,7 @@ export const useGlobalState = create<GlobalState>((set, get) => ({
         let socket = get().socket;
     
         if (!socket || socket.readyState === WebSocket.CLOSED) {
-            socket = new WebSocket(import.meta.env.VITE_API_WEBSOCKET_URL);
+            socket = new WebSocket(socketUrl());
 
     
             // Wrap the WebSocket connection in a Promise to await onopen
@@ -103,7 +110,7 @@ export const useGlobalState = create<GlobalState>((set, get) => ({
         let socket = get().socket;
     
         if (!socket || socket.readyState === WebSocket.CLOSED) {
-            socket = new WebSocket(import.meta.env.VITE_API_WEBSOCKET_URL);
+            socket = new WebSocket(socketUrl());
         }
         
         await new Promise<void>((resolve, reject) => {
@@ -152,7 +159,7 @@ export const useGlobalState = create<GlobalState>((set, get) => ({
     
         // Ensure we only create a new WebSocket if the previous one is closed
         if (!socket || socket.readyState === WebSocket.CLOSED) {
-            socket = new WebSocket(import.meta.env.VITE_API_WEBSOCKET_URL);
+            socket = new WebSocket(socketUrl());
     
             socket.onopen = () => {
                 console.log("✅ WebSocket connection established");
@@ -219,7 +226,7 @@ export const useGlobalState = create<GlobalState>((set, get) => ({
         let socket = get().socket;
     
         if (!socket || socket.readyState === WebSocket.CLOSED) {
-            socket = new WebSocket(import.meta.env.VITE_API_WEBSOCKET_URL);
+            socket = new WebSocket(socketUrl());
         }
     
         await new Promise<void>((resolve, reject) => {